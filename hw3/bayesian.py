@@ -21,10 +21,29 @@ where I is the unit matrix, and the vector φ(x) is defined as:
 """
 
 import click
+import collections
+import concurrent.futures
 import csv
+import glob
+import hashlib
+import itertools
+import json
 import logging
 import math
 import numpy
+import os
+import time
+
+# number of rows read, cached and accumulated at a time
+CHUNK_SIZE = 64 * 1024
+
+# binary sidecar cache: raw little-endian float64 (x, t) pairs, and the source file metadata
+CACHE_SUFFIX = '.f64'
+CACHE_META_SUFFIX = '.f64.json'
+
+# series up to this many bytes are fitted together, in stacked batches of at most BATCH_ROWS rows
+SMALL_SERIES_SIZE = 256 * 1024
+BATCH_ROWS = 1024 * 1024
 
 
 def get_phi(x, m):
@@ -35,21 +54,701 @@ def get_phi(x, m):
     return phi
 
 
+def get_design_matrix(x, m):
+    """Generates the (N x M) design matrix Φ, one row Φ(xn)^T per sample"""
+    return numpy.vander(numpy.asarray(x, dtype=float), m, increasing=True)
+
+
+def solve_triangular(L, b, transpose=False):
+    """Solves L x = b, or L^T x = b, for a lower triangular L by forward/back substitution
+
+    b can be a vector or a matrix holding one right hand side per column,
+    and both may be stacked along leading dimensions to solve many systems at once.
+    """
+    m = L.shape[-1]
+    x = numpy.array(b, dtype=float)
+    vector = x.ndim == L.ndim - 1
+    if vector:
+        x = x[..., None]
+
+    # L^T is upper triangular, so it is solved from the last row up
+    U = numpy.swapaxes(L, -1, -2) if transpose else L
+    for i in (range(m - 1, -1, -1) if transpose else range(m)):
+        done = slice(i + 1, m) if transpose else slice(0, i)
+        x[..., i, :] -= numpy.matmul(U[..., i:i + 1, done], x[..., done, :])[..., 0, :]
+        x[..., i, :] /= U[..., i, i, None]
+    return x[..., 0] if vector else x
+
+
+def get_checksum(filename):
+    """Calculates the sha256 checksum of a file"""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _householder_r(a):
+    """Calculates R of the QR factorization of a stack of matrices with Householder reflections,
+    numpy.linalg.qr only factorizes one matrix at a time
+    """
+    a = numpy.array(a, dtype=float)
+    columns = a.shape[-1]
+    for j in range(columns):
+        v = a[:, j:, j].copy()
+        norm = numpy.linalg.norm(v, axis=1)
+        v[:, 0] += numpy.where(v[:, 0] < 0, -norm, norm)
+        v_norm = numpy.sum(numpy.square(v), axis=1)
+        tau = numpy.divide(2.0, v_norm, out=numpy.zeros_like(v_norm), where=v_norm > 0)
+
+        # a = (I - τ v v^T) a, for the columns not reduced yet
+        projection = numpy.matmul(v[:, None, :], a[:, j:, j:])
+        a[:, j:, j:] -= tau[:, None, None] * v[:, :, None] * projection
+    return numpy.triu(a[:, :columns, :])
+
+
+def accumulate_r(chunks, alpha, beta, m):
+    """Folds blocks of (x, t) samples into R of the QR factorization of
+    [√α I, 0; √β Φ, √β t], returns R and the number of samples
+    """
+    R = numpy.zeros((m + 1, m + 1), float)
+    R[:m, :m] = math.sqrt(alpha) * numpy.identity(m)
+    n = 0
+    for x, t in chunks:
+        block = math.sqrt(beta) * numpy.column_stack((get_design_matrix(x, m), t))
+        R = numpy.linalg.qr(numpy.vstack((R, block)), mode='r')
+        n += len(t)
+    return R, n
+
+
+def reduce_r(R, alpha, beta, m):
+    """R of the stacked least squares problem [√α I, 0; √β Φ, √β t] for polynomial m <= M,
+    from R of the data alone [Φ, t] for polynomial M (accumulate_r with α = 0 and β = 1),
+    returns it and R of the data for polynomial m
+
+    The leading m columns of Φ are Φ for polynomial m, so their R is the leading block of R
+    and the rest of the t column only adds to the residual. α and β are folded in with a small
+    QR factorization, without reading the data again or forming (Φ^T Φ).
+    """
+    last = R.shape[-1] - 1
+    data = numpy.zeros((m + 1, m + 1), float)
+    data[:m, :m] = R[:m, :m]
+    data[:m, m] = R[:m, last]
+    data[m, m] = numpy.linalg.norm(R[m:, last])
+    prior = numpy.zeros((m, m + 1), float)
+    prior[:, :m] = math.sqrt(alpha) * numpy.identity(m)
+    return numpy.linalg.qr(numpy.vstack((prior, math.sqrt(beta) * data)), mode='r'), data
+
+
+def _solve_r(R):
+    """Splits R of the stacked least squares problem into the scaled factor of S^-1 and mN,
+    R can be stacked along the leading dimensions
+
+    R^T R = S^-1 and R mN = Q^T (√β t)
+    """
+    m = R.shape[-1] - 1
+    R, z = R[..., :m, :m], R[..., :m, m]
+    scale = 1.0 / numpy.linalg.norm(R, axis=-2)
+    factor = numpy.swapaxes(R * scale[..., None, :], -1, -2)
+    weights = scale * solve_triangular(factor, z, transpose=True)
+    return factor, scale, weights
+
+
+class Posterior:
+    """Posterior distribution of the weights p(w | t) = N(w | mN, S)
+
+    S^-1 is kept factorized as D^-1 (L L^T) D^-1, where D scales S^-1 to a unit diagonal
+    and L is lower triangular, so predictions only need triangular solves and never invert S.
+    The scaling keeps the factor well conditioned for high M, where the powers of x
+    span many orders of magnitude.
+    """
+
+    def __init__(self, weights, factor, scale, alpha, beta, n=0, checksum=''):
+        self.weights = weights
+        self.factor = factor
+        self.scale = scale
+        self.alpha = alpha
+        self.beta = beta
+        self.n = n
+        self.checksum = checksum
+
+    @classmethod
+    def from_data(cls, chunks, alpha, beta, m):
+        """Fits the posterior from blocks of (x, t) samples
+
+        Uses a streaming QR factorization of the stacked least squares problem
+        [√α I; √β Φ] w = [0; √β t] instead of forming (Φ^T Φ), so the factor
+        only carries the square root of its condition number.
+        """
+        R, n = accumulate_r(chunks, alpha, beta, m)
+        return cls.from_r(R, alpha, beta, n)
+
+    @classmethod
+    def from_r(cls, R, alpha, beta, n):
+        """Fits the posterior from R of the stacked least squares problem, see accumulate_r"""
+        factor, scale, weights = _solve_r(R)
+        cls._check_factor(factor)
+        return cls(weights, factor, scale, alpha, beta, n)
+
+    @classmethod
+    def from_batch(cls, series, alpha, beta, m):
+        """Fits many small series at once from a list of (x, t) arrays
+
+        The series are zero padded to the same length and stacked, so a single batched QR
+        factorization fits all of them. Returns a Posterior per series, or None if it could not be fitted.
+        """
+        size = max(len(t) for x, t in series)
+        stacked = numpy.zeros((len(series), m + size, m + 1), float)
+        stacked[:, :m, :m] = math.sqrt(alpha) * numpy.identity(m)
+        for i, (x, t) in enumerate(series):
+            stacked[i, m:m + len(t), :m] = math.sqrt(beta) * get_design_matrix(x, m)
+            stacked[i, m:m + len(t), m] = math.sqrt(beta) * numpy.asarray(t, dtype=float)
+
+        # zero rows do not change R, so the padding does not change the fit
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            factors, scales, weights = _solve_r(_householder_r(stacked))
+
+        posteriors = []
+        for (x, t), factor, scale, w in zip(series, factors, scales, weights):
+            try:
+                cls._check_factor(factor)
+            except numpy.linalg.LinAlgError:
+                posteriors.append(None)
+                continue
+            posteriors.append(cls(w, factor, scale, alpha, beta, len(t)))
+        return posteriors
+
+    @staticmethod
+    def _check_factor(factor):
+        diagonal = numpy.abs(numpy.diag(factor))
+        if not numpy.all(diagonal > len(diagonal) * numpy.finfo(float).eps):
+            raise numpy.linalg.LinAlgError('S^-1 is singular, try a larger α or a smaller M')
+
+    @property
+    def m(self):
+        return len(self.weights)
+
+    @property
+    def log_determinant(self):
+        """ln |S^-1|"""
+        return float(
+            2 * numpy.sum(numpy.log(numpy.abs(numpy.diag(self.factor))))
+            - 2 * numpy.sum(numpy.log(self.scale)))
+
+    @property
+    def trace(self):
+        """Trace of S"""
+        return float(numpy.sum(numpy.square(
+            solve_triangular(self.factor, numpy.diag(self.scale)))))
+
+    def predict(self, x):
+        """Calculates the predictive mean m(x) and variance s^2(x) for an array of x"""
+        phi = get_design_matrix(numpy.atleast_1d(x), self.m)
+        mean = numpy.dot(phi, self.weights)
+        y = solve_triangular(self.factor, (phi * self.scale).T)
+        variance = 1.0 / self.beta + numpy.sum(numpy.square(y), axis=0)
+        return mean, variance
+
+    def save(self, filename):
+        """Saves the posterior to a .npz file"""
+        with open(filename, 'wb') as f:
+            numpy.savez(
+                f, weights=self.weights, factor=self.factor, scale=self.scale,
+                alpha=self.alpha, beta=self.beta, n=self.n, checksum=self.checksum)
+
+    @classmethod
+    def load(cls, filename):
+        """Loads a posterior saved with save"""
+        with numpy.load(filename) as data:
+            return cls(
+                data['weights'], data['factor'], data['scale'], float(data['alpha']),
+                float(data['beta']), int(data['n']), str(data['checksum']))
+
+
+class OnlinePosterior:
+    """Bayesian posterior kept up to date with rank-1 updates, one (x, t) sample at a time
+
+    Keeps R of the stacked least squares problem (see Posterior.from_data) as state,
+    R^T R is the precision S^-1 and its last column carries (Φ^T t). Adding or removing
+    a sample is a rank-1 update or downdate of R, so it costs O(M^2) instead of a full
+    refit, and so does every prediction.
+    """
+
+    def __init__(self, alpha, beta, m, data=()):
+        if alpha <= 0:
+            raise ValueError('alpha must be positive for online updates')
+        self.alpha = alpha
+        self.beta = beta
+        self.m = m
+        self.n = 0
+        self.R = numpy.zeros((m + 1, m + 1), float)
+        self.R[:m, :m] = math.sqrt(alpha) * numpy.identity(m)
+        for x, t in data:
+            self.update(x, t)
+
+    def _rotate(self, x, t, sign):
+        """Adds (sign=1) or removes (sign=-1) the row √β (Φ(x)^T, t) to or from R"""
+        R = self.R.copy()
+        v = math.sqrt(self.beta) * numpy.append(get_design_matrix([x], self.m)[0], t)
+        last = len(v) - 1
+        for k in range(len(v)):
+            r = R[k, k] ** 2 + sign * v[k] ** 2
+            if r <= 0 and k < last:
+                raise numpy.linalg.LinAlgError('downdate lost positive definiteness')
+            r = math.sqrt(max(r, 0.0))
+            if k == last or R[k, k] == 0:
+                R[k, k] = r
+                continue
+            c = r / R[k, k]
+            s = v[k] / R[k, k]
+            R[k, k] = r
+            R[k, k + 1:] = (R[k, k + 1:] + sign * s * v[k + 1:]) / c
+            v[k + 1:] = c * v[k + 1:] - s * R[k, k + 1:]
+        self.R = R
+
+    def update(self, x, t):
+        """Adds the sample (x, t) to the posterior"""
+        self._rotate(x, t, 1)
+        self.n += 1
+
+    def downdate(self, x, t):
+        """Removes the sample (x, t) from the posterior,
+        raises LinAlgError and leaves the posterior unchanged if rounding makes that impossible
+        """
+        self._rotate(x, t, -1)
+        self.n -= 1
+
+    def predict(self, x):
+        """Calculates the predictive mean and variance for an array of x"""
+        factor, scale, weights = _solve_r(self.R)
+        return Posterior(weights, factor, scale, self.alpha, self.beta, self.n).predict(x)
+
+
+def run_backtest(chunks, alpha, beta, m, window):
+    """Predicts every sample from the previous window samples, sliding the window with
+    rank-1 updates and downdates of the posterior
+
+    Returns the number of predictions, the hit rate of the [mean - 3 var, mean + 3 var] range,
+    the RMSE of the mean and the calibration: the fraction of samples within 1, 2 and 3
+    standard deviations, next to the fraction expected from a normal distribution.
+    """
+    posterior = OnlinePosterior(alpha, beta, m)
+    samples = collections.deque()
+    count = 0
+    hits = 0
+    squared_error = 0.0
+    within = numpy.zeros(3, int)
+    deviations = numpy.arange(1, 4)
+    for x_chunk, t_chunk in chunks:
+        for x, t in zip(x_chunk.tolist(), t_chunk.tolist()):
+            if len(samples) == window:
+                means, variances = posterior.predict(x)
+                mean, variance = float(means[0]), float(variances[0])
+                count += 1
+                hits += mean - 3 * variance <= t <= mean + 3 * variance
+                squared_error += (t - mean) ** 2
+                within += abs(t - mean) <= deviations * math.sqrt(variance)
+
+            posterior.update(x, t)
+            samples.append((x, t))
+            if len(samples) > window:
+                try:
+                    posterior.downdate(*samples.popleft())
+                except numpy.linalg.LinAlgError:
+                    logging.debug(f'Downdate failed at sample {count + window}, refitting the window')
+                    posterior = OnlinePosterior(alpha, beta, m, samples)
+
+    return {
+        'predictions': count,
+        'hit_rate': hits / count if count else float('nan'),
+        'rmse': math.sqrt(squared_error / count) if count else float('nan'),
+        'calibration': [
+            (int(z), float(w) / count if count else float('nan'), math.erf(z / math.sqrt(2)))
+            for z, w in zip(deviations, within)],
+    }
+
+
+def expand_paths(ctx, param, value):
+    """Expands the DATA paths and glob patterns into a sorted list of files"""
+    paths = []
+    for pattern in value:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise click.BadParameter(f'no files match: {pattern}')
+        for path in matches:
+            if not os.path.isfile(path):
+                raise click.BadParameter(f'not a file: {path}')
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def parse_range(ctx, param, value):
+    """Parses a START:STOP:STEP string into an array of x values"""
+    if not value:
+        return None
+    try:
+        start, stop, step = (float(v) for v in value.split(':'))
+    except ValueError:
+        raise click.BadParameter(f'expected START:STOP:STEP, got: {value}')
+    if step <= 0:
+        raise click.BadParameter('STEP must be positive')
+    return numpy.arange(start, stop, step)
+
+
+def parse_values(ctx, param, value):
+    """Parses a comma separated list of numbers"""
+    try:
+        values = [float(v) for v in value.split(',') if v.strip()]
+    except ValueError:
+        raise click.BadParameter(f'expected a comma separated list of numbers, got: {value}')
+    if not values or min(values) <= 0:
+        raise click.BadParameter('values must be positive')
+    return values
+
+
+def parse_orders(ctx, param, value):
+    """Parses a comma separated list of polynomial orders, or an inclusive START:STOP range"""
+    try:
+        if ':' in value:
+            start, stop = (int(v) for v in value.split(':'))
+            values = list(range(start, stop + 1))
+        else:
+            values = [int(v) for v in value.split(',') if v.strip()]
+    except ValueError:
+        raise click.BadParameter(f'expected a list like 1,3,5 or a range like 1:9, got: {value}')
+    if not values or min(values) < 0:
+        raise click.BadParameter('orders must not be negative')
+    return values
+
+
 def generate(n):
     """Generates random data array of N entries"""
     return numpy.random.rand(n)
 
 
-def read_data(filename):
+def log_evidence(R, n, alpha, beta, m):
+    """Calculates the log marginal likelihood ln p(t | α, β) for polynomial m,
+    from R of the N samples (see reduce_r)
+
+    ln p(t | α, β) = (M/2) ln α + (N/2) ln β - E(mN) - (1/2) ln |S^-1| - (N/2) ln 2π
+    E(mN) = (β/2) ||t - Φ mN||^2 + (α/2) mN^T mN
+
+    2 E(mN) is the residual of the stacked least squares problem: the last diagonal entry of
+    its R squared, and ln |S^-1| comes from the diagonal of the leading block.
+    """
+    stacked, _ = reduce_r(R, alpha, beta, m)
+    try:
+        posterior = Posterior.from_r(stacked, alpha, beta, n)
+    except numpy.linalg.LinAlgError:
+        return float('nan')
+
+    energy = stacked[m, m] ** 2 / 2
+    return float(
+        m / 2 * math.log(alpha) + n / 2 * math.log(beta) - energy
+        - posterior.log_determinant / 2 - n / 2 * math.log(2 * math.pi))
+
+
+def _squared_error(data, mean):
+    """||t - Φ mN||^2 from R of the data, ||[Φ, t] (mN, -1)^T|| = ||R (mN, -1)^T||"""
+    return float(numpy.sum(numpy.square(numpy.dot(data, numpy.append(mean, -1.0)))))
+
+
+def optimize_hyperparameters(R, n, alpha, beta, m, iterations=100, tolerance=1e-6):
+    """Re-estimates α and β by maximizing the evidence (type-II maximum likelihood),
+    from R of the N samples (see reduce_r)
+
+    γ = sum i: λi / (α + λi) = M - α trace(S), where λi are the eigenvalues of β (Φ^T Φ)
+    α = γ / (mN^T mN)
+    1/β = ||t - Φ mN||^2 / (N - γ)
+    """
+    for _ in range(iterations):
+        stacked, data = reduce_r(R, alpha, beta, m)
+        try:
+            posterior = Posterior.from_r(stacked, alpha, beta, n)
+        except numpy.linalg.LinAlgError:
+            break
+        mean = posterior.weights
+        gamma = m - alpha * posterior.trace
+        new_alpha = gamma / float(numpy.dot(mean, mean))
+        new_beta = (n - gamma) / _squared_error(data, mean)
+        if not (new_alpha > 0 and new_beta > 0 and math.isfinite(new_alpha + new_beta)):
+            break
+        converged = (
+            abs(new_alpha - alpha) <= tolerance * alpha and abs(new_beta - beta) <= tolerance * beta)
+        alpha, beta = new_alpha, new_beta
+        if converged:
+            break
+    return alpha, beta
+
+
+def _evaluate_candidate(args):
+    """Scores one (α, β, M) candidate, runs in the tune worker processes"""
+    R, n, alpha, beta, mth, optimize = args
+    if optimize:
+        alpha, beta = optimize_hyperparameters(R, n, alpha, beta, mth + 1)
+    return alpha, beta, mth, log_evidence(R, n, alpha, beta, mth + 1)
+
+
+def tune_hyperparameters(R, n, alphas, betas, mths, optimize=False, workers=None):
+    """Scores every (α, β, M) combination by its log evidence in a process pool,
+    from R of the N samples for the largest M (see reduce_r),
+    returns (α, β, M, log evidence) tuples ranked from best to worst
+    """
+    candidates = [
+        (R, n, alpha, beta, mth, optimize)
+        for mth in mths for alpha in alphas for beta in betas]
+    if workers == 1:
+        results = list(map(_evaluate_candidate, candidates))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, len(candidates) // (4 * (workers or os.cpu_count() or 1)))
+            results = list(executor.map(_evaluate_candidate, candidates, chunksize=chunksize))
+
+    # failed candidates (nan) go last
+    failed = sum(not math.isfinite(r[3]) for r in results)
+    if failed:
+        logging.warning(
+            f'{failed} of {len(results)} candidates could not be scored (S^-1 is singular),'
+            f' they are ranked last')
+    results = sorted(
+        results, key=lambda r: r[3] if math.isfinite(r[3]) else -math.inf, reverse=True)
+
+    # re-estimation converges to the same α and β from most starting points,
+    # keep the best one for every M
+    if optimize:
+        seen = set()
+        results = [r for r in results if not (r[2] in seen or seen.add(r[2]))]
+    return results
+
+
+def _fit_file(args):
+    """Fits one large series, runs in the predict worker processes"""
+    filename, alpha, beta, m, n, chunk_size, cache = args
+    return Posterior.from_data(read_chunks(filename, n, chunk_size, cache), alpha, beta, m)
+
+
+def fit_series(
+        filenames, alpha, beta, m, n=None, chunk_size=CHUNK_SIZE, cache=True,
+        small_size=SMALL_SERIES_SIZE, workers=None):
+    """Fits every file, small files are read whole and fitted together in stacked batches,
+    large files are streamed in worker processes
+
+    Returns a dict of file name to its Posterior, or to the error that kept it from being fitted.
+    """
+    results = {}
+    small = [f for f in filenames if os.path.getsize(f) <= small_size]
+    large = [f for f in filenames if f not in small]
+
+    # a single file is always streamed
+    if len(small) == 1:
+        small, large = [], small + large
+
+    executor = None
+    futures = {}
+    if len(large) > 1 and workers != 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    try:
+        for filename in large:
+            args = (filename, alpha, beta, m, n, chunk_size, cache)
+            if executor:
+                futures[filename] = executor.submit(_fit_file, args)
+            else:
+                try:
+                    results[filename] = _fit_file(args)
+                except numpy.linalg.LinAlgError as e:
+                    results[filename] = e
+
+        # fit the small series while the workers run, grouped by length to limit padding
+        series = sorted(((f, read_data(f, n, cache)) for f in small), key=lambda s: len(s[1][1]))
+        while series:
+            count = 1
+            while count < len(series) and (count + 1) * len(series[count][1][1]) <= BATCH_ROWS:
+                count += 1
+            batch, series = series[:count], series[count:]
+            posteriors = Posterior.from_batch([data for f, data in batch], alpha, beta, m)
+            for (filename, data), posterior in zip(batch, posteriors):
+                results[filename] = posterior or numpy.linalg.LinAlgError(
+                    'S^-1 is singular, try a larger α or a smaller M')
+            logging.debug(f'Fitted a batch of {count} series, up to {len(batch[-1][1][1])} rows')
+
+        for filename, future in futures.items():
+            try:
+                results[filename] = future.result()
+            except numpy.linalg.LinAlgError as e:
+                results[filename] = e
+    finally:
+        if executor:
+            executor.shutdown()
+    return {f: results[f] for f in filenames}
+
+
+def _parse_chunk(lines):
+    """Parses csv lines into (x, t) arrays, ignoring empty rows"""
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        return numpy.empty(0, float), numpy.empty(0, float)
+    data = numpy.loadtxt(lines, delimiter=',', usecols=(0, 1), ndmin=2, dtype=float)
+    return data[:, 0], data[:, 1]
+
+
+def _cache_valid(filename):
+    """Checks if the binary cache exists and was built from the current version of the file"""
+    try:
+        with open(f'{filename}{CACHE_META_SUFFIX}') as f:
+            meta = json.load(f)
+        stat = os.stat(filename)
+        cache_size = os.path.getsize(f'{filename}{CACHE_SUFFIX}')
+    except (OSError, ValueError):
+        return False
+    return (
+        meta.get('size') == stat.st_size and meta.get('mtime_ns') == stat.st_mtime_ns
+        and cache_size == meta.get('rows', -1) * 2 * 8)
+
+
+def _read_cache_chunks(filename, chunk_size):
+    """Yields (x, t) blocks from the memory-mapped binary cache"""
+    if os.path.getsize(f'{filename}{CACHE_SUFFIX}') == 0:
+        return
+    data = numpy.memmap(f'{filename}{CACHE_SUFFIX}', dtype='<f8', mode='r').reshape(-1, 2)
+    for start in range(0, len(data), chunk_size):
+        block = data[start:start + chunk_size]
+        yield block[:, 0], block[:, 1]
+
+
+def _read_csv_chunks(filename, chunk_size, cache):
+    """Yields (x, t) blocks parsed from the csv file, writing the binary cache along the way"""
+    stat = os.stat(filename)
+    tmp = f'{filename}{CACHE_SUFFIX}.{os.getpid()}.tmp'
+    out = None
+    if cache:
+        try:
+            out = open(tmp, 'wb')
+        except OSError as e:
+            logging.debug(f'Could not write cache for {filename}: {e}')
+
+    rows = 0
+    try:
+        with open(filename, newline='') as f:
+            while True:
+                lines = list(itertools.islice(f, chunk_size))
+                if not lines:
+                    break
+                x, t = _parse_chunk(lines)
+                if out:
+                    numpy.column_stack((x, t)).astype('<f8').tofile(out)
+                rows += len(x)
+                yield x, t
+
+        # the whole file was read, publish the cache
+        if out:
+            out.close()
+            os.replace(tmp, f'{filename}{CACHE_SUFFIX}')
+            with open(f'{filename}{CACHE_META_SUFFIX}', 'w') as f:
+                json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'rows': rows}, f)
+            out = None
+    finally:
+        # read was interrupted or failed, drop the partial cache
+        if out:
+            out.close()
+            os.remove(tmp)
+
+
+def read_chunks(filename, n=None, chunk_size=CHUNK_SIZE, cache=True):
+    """Reads the first n rows (all of them if n is empty) of a csv file in blocks of at most
+    chunk_size rows, yielding (x, t) arrays, uses the binary cache when it is up to date with
+    the csv file
+    """
+    if cache and _cache_valid(filename):
+        logging.debug(f'Reading cached data: {filename}{CACHE_SUFFIX}')
+        chunks = _read_cache_chunks(filename, chunk_size)
+    else:
+        chunks = _read_csv_chunks(filename, chunk_size, cache)
+
+    # stop after the first N rows, an empty (or 0) N uses the full data set
+    remaining = n if n else None
+    try:
+        for x, t in chunks:
+            if remaining is not None:
+                x, t = x[:remaining], t[:remaining]
+                remaining -= len(x)
+            yield x, t
+            if remaining is not None and remaining <= 0:
+                break
+    finally:
+        chunks.close()
+
+
+def read_data(filename, n=None, cache=True):
     """Read in a csv file"""
-    x = []
-    t = []
-    with open(filename, newline='') as f:
-        reader = csv.reader(f, delimiter=',')
-        for row in reader:
-            x.append(float(row[0]))
-            t.append(float(row[1]))
-    return x, t
+    chunks = list(read_chunks(filename, n, cache=cache))
+    if not chunks:
+        return numpy.empty(0, float), numpy.empty(0, float)
+    x, t = zip(*chunks)
+    return numpy.concatenate(x), numpy.concatenate(t)
+
+
+def follow_data(f, interval=None):
+    """Yields (x, t) rows from an open csv file,
+    if an interval is given keep polling the file for new rows instead of stopping at the end
+    """
+    line = ''
+    while True:
+        chunk = f.readline()
+        if chunk:
+            line += chunk
+            if not line.endswith('\n') and interval is not None:
+                # partially written row, wait for the rest of it
+                continue
+        elif interval is not None:
+            time.sleep(interval)
+            continue
+        elif not line:
+            return
+
+        row = line.strip()
+        line = ''
+        if not row:
+            continue
+        try:
+            x, t = (float(v) for v in row.split(',')[:2])
+        except ValueError:
+            # a header, or a row that is not x,t: skip it instead of stopping the stream
+            logging.warning(f'Skipping malformed row: {row}')
+            continue
+        yield x, t
+
+
+def _fit_posterior(alpha, beta, mth, n, chunk_size, cache, data):
+    """Fits the posterior for the predict and fit commands, exits if S^-1 can not be factorized"""
+    logging.debug(f'Parameters - α:{alpha}, β:{beta}, Data: {data}, Mth:{mth}')
+    try:
+        posterior = Posterior.from_data(read_chunks(data, n, chunk_size, cache), alpha, beta, mth + 1)
+    except numpy.linalg.LinAlgError as e:
+        logging.error(f'Could not fit the data: {e}')
+        exit(1)
+    logging.debug(f'Infered Parameters - N:{posterior.n}, Polynomial:{posterior.m}')
+    logging.debug(f'Weights: {posterior.weights}')
+    return posterior
+
+
+def _log_predictions(posterior, predict):
+    """Calculates and prints the mean and variance for every prediction"""
+    means, variances = posterior.predict(predict)
+    for x_new, mean, variance in zip(predict, means, variances):
+        if len(predict) > 1:
+            logging.info(f'Prediction: {x_new}')
+        _log_prediction(mean, variance)
+
+
+def _log_prediction(mean, variance):
+    logging.info(f'Mean: {round(mean, 3)}')
+    logging.info(f'Variance: {round(variance, 3)}')
+    logging.info(
+        f'The predicted range: [${round(mean - 3 * variance, 2)}'
+        f' - ${round(mean + 3 * variance, 2)}]'
+    )
 
 
 def _setup_logging(debug):
@@ -60,7 +759,12 @@ def _setup_logging(debug):
     logging.basicConfig(format=fmt, level=loglevel)
 
 
-@click.command()
+@click.group()
+def cli():
+    """Bayesian Curve Fitting"""
+
+
+@cli.command()
 @click.option('--debug', is_flag=True, help="Show debug data")
 @click.option(
     '--alpha', '-a', default=0.005, help='Alpha.', type=float, show_default=True)
@@ -72,50 +776,243 @@ def _setup_logging(debug):
     '--N', '-n', default=None,
     help='N. The number of input data to use from the data.csv. If empty, use the full data set',
     type=int)
-@click.argument('data', type=click.Path(exists=True))
-def predict(debug, alpha, beta, mth, n, data):
+@click.option(
+    '--predict-range', default=None, metavar='START:STOP:STEP', callback=parse_range,
+    help='Predict every x in the range. If empty, predict the next x (N + 1)')
+@click.option(
+    '--chunk-size', default=CHUNK_SIZE, help='Number of rows read at a time',
+    type=click.IntRange(min=1), show_default=True)
+@click.option(
+    '--cache/--no-cache', default=True,
+    help='Read and write the binary cache next to the data file', show_default=True)
+@click.option(
+    '--small-size', default=SMALL_SERIES_SIZE, type=click.IntRange(min=0), show_default=True,
+    help='Files up to this many bytes are fitted together in one stacked batch')
+@click.option(
+    '--workers', '-w', default=None, type=click.IntRange(min=1),
+    help='Number of worker processes for the larger files. If empty, use one per CPU')
+@click.option(
+    '--format', 'output_format', default='text', type=click.Choice(['text', 'csv', 'json']),
+    help='Output format', show_default=True)
+@click.option(
+    '--output', '-o', default='-', type=click.File('w'),
+    help='File to write the csv/json table to', show_default=True)
+@click.argument('data', nargs=-1, required=True, callback=expand_paths)
+def predict(
+        debug, alpha, beta, mth, n, predict_range, chunk_size, cache, small_size, workers,
+        output_format, output, data):
+    """Fit the DATA files (paths or glob patterns) and predict the next x, or a range of x"""
     _setup_logging(debug)
     logging.debug(f'Parameters - α:{alpha}, β:{beta}, Data: {data}, Mth:{mth}')
-    x, t = read_data(data)
-    N = n if n else len(t)
-
-    # prediction is the next X
-    predict = N + 1
-    polynomial = mth + 1
-    logging.debug(f'Infered Parameters - N:{N}, Polynomial:{polynomial}, x: {x}, t:{t}')
-
-    # Calculate sums (Φ(x).t) and (φ(x).φ(x)^T)
-    phi_sum = numpy.zeros((polynomial, 1), float)
-    phi_sum_t = numpy.zeros((polynomial, 1), float)
-    for i in range(N):
-        phi = get_phi(x[i], polynomial)
-        phi_sum = numpy.add(phi_sum, phi)
-        phi_sum_t = numpy.add(phi_sum_t, (phi * t[i]))
-
-    logging.debug(f'Phi Sum: {phi_sum}')
-    logging.debug(f'Phi Sum T: {phi_sum_t}')
-
-    # Get phi for 'prediction'
-    phi = get_phi(predict, polynomial)
-    logging.debug(f'Phi: {phi}')
-
-    # Calculate the variance / standard deviation
-    S = alpha * numpy.identity(polynomial) + beta * numpy.dot(phi_sum, phi.T)
-    S = numpy.linalg.inv(S)
-    variance = (float(1.0 / beta) + numpy.dot(numpy.dot(phi.T, S), phi))[0][0]
-
-    # Calculate the mean
-    mean = (beta * numpy.dot(phi.T, numpy.dot(S, phi_sum_t)))[0][0]
-
-    # Print prediction values
-    logging.debug(f'Data mean: {numpy.mean(t[:N])}')
-    logging.info(f'Mean: {round(mean, 3)}')
-    logging.info(f'Variance: {round(variance, 3)}')
-    logging.info(
-        f'The predicted range: [${round(mean - 3 * variance, 2)}'
-        f' - ${round(mean + 3 * variance, 2)}]'
-    )
+    posteriors = fit_series(
+        data, alpha, beta, mth + 1, n, chunk_size, cache, small_size, workers)
+
+    table = []
+    failed = False
+    for filename, posterior in posteriors.items():
+        if isinstance(posterior, Exception):
+            logging.error(f'Could not fit the data: {filename}: {posterior}')
+            failed = True
+            continue
+        logging.debug(f'Infered Parameters - Data: {filename}, N:{posterior.n}')
+
+        # prediction is the next X, unless a range was requested
+        predict = predict_range if predict_range is not None else numpy.array([posterior.n + 1], float)
+        if output_format == 'text':
+            if len(data) > 1:
+                logging.info(f'Series: {filename}')
+            _log_predictions(posterior, predict)
+            continue
+
+        means, variances = posterior.predict(predict)
+        for x_new, mean, variance in zip(predict, means, variances):
+            table.append({
+                'series': filename, 'x': float(x_new), 'mean': float(mean),
+                'variance': float(variance), 'low': float(mean - 3 * variance),
+                'high': float(mean + 3 * variance)})
+
+    if output_format == 'json':
+        json.dump(table, output, indent=2)
+        output.write('\n')
+    elif output_format == 'csv':
+        writer = csv.DictWriter(
+            output, fieldnames=['series', 'x', 'mean', 'variance', 'low', 'high'], lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(table)
+    if failed:
+        exit(1)
+
+
+@cli.command()
+@click.option('--debug', is_flag=True, help="Show debug data")
+@click.option(
+    '--alpha', '-a', default=0.005, help='Alpha.', type=float, show_default=True)
+@click.option(
+    '--beta', '-b', default=11.100, help='Precision, (1/variance).', type=float, show_default=True)
+@click.option(
+    '--mth', '-m', default=6, help='M. The Mth order polynomial.', type=int, show_default=True)
+@click.option(
+    '--N', '-n', default=None,
+    help='N. The number of input data to use from the data.csv. If empty, use the full data set',
+    type=int)
+@click.option(
+    '--chunk-size', default=CHUNK_SIZE, help='Number of rows read at a time',
+    type=click.IntRange(min=1), show_default=True)
+@click.option(
+    '--cache/--no-cache', default=True,
+    help='Read and write the binary cache next to the data file', show_default=True)
+@click.option(
+    '--model', '-o', default='model.npz', help='File to save the fitted model to',
+    type=click.Path(dir_okay=False, writable=True), show_default=True)
+@click.argument('data', type=click.Path(exists=True))
+def fit(debug, alpha, beta, mth, n, chunk_size, cache, model, data):
+    """Fit the data and save the posterior to a model file"""
+    _setup_logging(debug)
+    posterior = _fit_posterior(alpha, beta, mth, n, chunk_size, cache, data)
+    posterior.checksum = get_checksum(data)
+    posterior.save(model)
+    logging.info(f'Model saved to: {model}, N:{posterior.n}, checksum: {posterior.checksum}')
+
+
+@cli.command()
+@click.option('--debug', is_flag=True, help="Show debug data")
+@click.option(
+    '--predict-range', default=None, metavar='START:STOP:STEP', callback=parse_range,
+    help='Predict every x in the range')
+@click.option(
+    '--data', default=None, type=click.Path(exists=True),
+    help='Warn if the model was not fitted with the current version of this data file')
+@click.argument('model', type=click.Path(exists=True, dir_okay=False))
+@click.argument('x', nargs=-1, type=float)
+def query(debug, predict_range, data, model, x):
+    """Predict X values with a saved model. If no X is given, predict the next x (N + 1)"""
+    _setup_logging(debug)
+    posterior = Posterior.load(model)
+    logging.debug(
+        f'Model - α:{posterior.alpha}, β:{posterior.beta}, Mth:{posterior.m - 1}, N:{posterior.n}')
+    if data and get_checksum(data) != posterior.checksum:
+        logging.warning(f'Model {model} was not fitted with the current {data}')
+
+    predict = numpy.array(x, float)
+    if predict_range is not None:
+        predict = numpy.concatenate((predict, predict_range))
+    if not len(predict):
+        predict = numpy.array([posterior.n + 1], float)
+    _log_predictions(posterior, predict)
+
+
+@cli.command()
+@click.option('--debug', is_flag=True, help="Show debug data")
+@click.option(
+    '--alpha', '-a', default=0.005, help='Alpha.', type=float, show_default=True)
+@click.option(
+    '--beta', '-b', default=11.100, help='Precision, (1/variance).', type=float, show_default=True)
+@click.option(
+    '--mth', '-m', default=6, help='M. The Mth order polynomial.', type=int, show_default=True)
+@click.option(
+    '--follow', '-f', is_flag=True, help='Keep waiting for new rows at the end of the file')
+@click.option(
+    '--interval', default=1.0, help='Seconds between polls when following a file',
+    type=float, show_default=True)
+@click.argument('data', type=click.File('r'))
+def stream(debug, alpha, beta, mth, follow, interval, data):
+    """Update the fit one row at a time and predict the next x after each row,
+    use '-' as DATA to read rows from stdin
+    """
+    _setup_logging(debug)
+    logging.debug(f'Parameters - α:{alpha}, β:{beta}, Data: {data.name}, Mth:{mth}')
+    if alpha <= 0:
+        raise click.BadParameter('must be positive for online updates', param_hint='alpha')
+
+    posterior = OnlinePosterior(alpha, beta, mth + 1)
+    try:
+        for x, t in follow_data(data, interval if follow else None):
+            posterior.update(x, t)
+            logging.debug(f'Row {posterior.n} - x: {x}, t: {t}')
+
+            # prediction is the next X
+            means, variances = posterior.predict(x + 1)
+            logging.info(f'Prediction: {x + 1}')
+            _log_prediction(means[0], variances[0])
+    except KeyboardInterrupt:
+        logging.info(f'\nStopped after {posterior.n} rows.')
+
+
+@cli.command()
+@click.option('--debug', is_flag=True, help="Show debug data")
+@click.option(
+    '--alphas', default='0.0001,0.001,0.005,0.01,0.1,1', callback=parse_values,
+    help='Comma separated alphas to try.', show_default=True)
+@click.option(
+    '--betas', default='0.1,1,5,11.1,20,50', callback=parse_values,
+    help='Comma separated precisions to try.', show_default=True)
+@click.option(
+    '--mths', default='1:9', callback=parse_orders,
+    help='Polynomial orders to try, a list (1,3,5) or an inclusive range (1:9).', show_default=True)
+@click.option(
+    '--optimize', is_flag=True,
+    help='Re-estimate α and β by evidence maximization, starting from every candidate')
+@click.option(
+    '--workers', '-w', default=None, type=click.IntRange(min=1),
+    help='Number of worker processes. If empty, use one per CPU')
+@click.option(
+    '--top', default=10, help='Number of candidates to show', type=int, show_default=True)
+@click.option(
+    '--N', '-n', default=None,
+    help='N. The number of input data to use from the data.csv. If empty, use the full data set',
+    type=int)
+@click.option(
+    '--cache/--no-cache', default=True,
+    help='Read and write the binary cache next to the data file', show_default=True)
+@click.argument('data', type=click.Path(exists=True))
+def tune(debug, alphas, betas, mths, optimize, workers, top, n, cache, data):
+    """Rank α, β and M candidates by their log marginal likelihood"""
+    _setup_logging(debug)
+    logging.debug(f'Parameters - αs:{alphas}, βs:{betas}, Data: {data}, Mths:{mths}')
+
+    # one pass over the data gives R for every M, α and β
+    R, count = accumulate_r(read_chunks(data, n, cache=cache), 0.0, 1.0, max(mths) + 1)
+    logging.debug(f'Infered Parameters - N:{count}, Candidates: {len(alphas) * len(betas) * len(mths)}')
+
+    results = tune_hyperparameters(R, count, alphas, betas, mths, optimize, workers)
+    logging.info('Rank\tMth\tα\t\tβ\t\tLog evidence')
+    for rank, (alpha, beta, mth, evidence) in enumerate(results[:top], 1):
+        logging.info(f'{rank}\t{mth}\t{alpha:<10.6g}\t{beta:<10.6g}\t{round(evidence, 3)}')
+
+
+@cli.command()
+@click.option('--debug', is_flag=True, help="Show debug data")
+@click.option(
+    '--alpha', '-a', default=0.005, help='Alpha.', type=float, show_default=True)
+@click.option(
+    '--beta', '-b', default=11.100, help='Precision, (1/variance).', type=float, show_default=True)
+@click.option(
+    '--mth', '-m', default=6, help='M. The Mth order polynomial.', type=int, show_default=True)
+@click.option(
+    '--window', '-w', default=30, type=click.IntRange(min=1), show_default=True,
+    help='Number of previous data used for every prediction')
+@click.option(
+    '--chunk-size', default=CHUNK_SIZE, help='Number of rows read at a time',
+    type=click.IntRange(min=1), show_default=True)
+@click.option(
+    '--cache/--no-cache', default=True,
+    help='Read and write the binary cache next to the data file', show_default=True)
+@click.argument('data', type=click.Path(exists=True))
+def backtest(debug, alpha, beta, mth, window, chunk_size, cache, data):
+    """Predict every x from the previous window of data and score the predictions"""
+    _setup_logging(debug)
+    logging.debug(f'Parameters - α:{alpha}, β:{beta}, Data: {data}, Mth:{mth}, Window:{window}')
+    if alpha <= 0:
+        raise click.BadParameter('must be positive for online updates', param_hint='alpha')
+
+    results = run_backtest(read_chunks(data, None, chunk_size, cache), alpha, beta, mth + 1, window)
+    logging.info(f'Predictions: {results["predictions"]}')
+    logging.info(f'Hit rate: {round(results["hit_rate"], 3)}')
+    logging.info(f'RMSE: {round(results["rmse"], 3)}')
+    logging.info('Calibration:')
+    for z, observed, expected in results['calibration']:
+        logging.info(f'  within {z}σ: {round(observed, 3)} (expected {round(expected, 3)})')
 
 
 if __name__ == '__main__':
-    predict()
+    cli()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+"""
+Bayesian Curve Fitting Benchmark:
+
+Times the curve fitting path on synthetic data generated with bayesian.generate(n),
+for a grid of data sizes N and polynomial orders M, and splits the time between:
+
+parse: reading the csv file into arrays (bayesian.read_data)
+accumulate: folding the data into R (bayesian.accumulate_r)
+solve: factorizing the posterior and predicting (bayesian.Posterior)
+
+The results are saved as JSON and can be compared against a previous run (the baseline).
+"""
+
+import bayesian
+import click
+import datetime
+import json
+import logging
+import math
+import numpy
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+# parameters of the fitted model and number of predictions per fit
+ALPHA = 0.005
+BETA = 11.1
+PREDICTIONS = 1000
+
+
+def generate_data(filename, n):
+    """Writes N synthetic samples, t = sin(2πx) + gaussian noise, to a csv file"""
+    x = bayesian.generate(n)
+    t = numpy.sin(2 * math.pi * x) + numpy.random.normal(scale=1 / math.sqrt(BETA), size=n)
+    numpy.savetxt(filename, numpy.column_stack((x, t)), delimiter=',', fmt='%.17g')
+
+
+def _timed(repeat, function, *args):
+    """Runs function repeat times, returns the best wall time and the last result"""
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _peak_memory(function, *args):
+    """Runs function once, returns the peak memory it allocated in bytes"""
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _chunks(x, t):
+    """Splits the data in blocks, like bayesian.read_chunks"""
+    return [
+        (x[i:i + bayesian.CHUNK_SIZE], t[i:i + bayesian.CHUNK_SIZE])
+        for i in range(0, len(x), bayesian.CHUNK_SIZE)]
+
+
+def _fit(chunks, m, predict):
+    R, n = bayesian.accumulate_r(chunks, ALPHA, BETA, m)
+    return bayesian.Posterior.from_r(R, ALPHA, BETA, n).predict(predict)
+
+
+def run_benchmark(sizes, orders, repeat=3):
+    """Benchmarks every (N, M) pair, returns a list of results"""
+    results = []
+    predict = numpy.linspace(0, 1, PREDICTIONS)
+    with tempfile.TemporaryDirectory() as directory:
+        for n in sizes:
+            filename = os.path.join(directory, f'data_{n}.csv')
+            generate_data(filename, n)
+
+            # parsing does not depend on M, it is measured once for every N
+            parse, (x, t) = _timed(repeat, bayesian.read_data, filename, None, False)
+            parse_memory = _peak_memory(bayesian.read_data, filename, None, False)
+            chunks = _chunks(x, t)
+            logging.debug(f'N:{n} - parse: {parse:.6f}s')
+
+            for m in orders:
+                accumulate, (R, count) = _timed(
+                    repeat, bayesian.accumulate_r, chunks, ALPHA, BETA, m + 1)
+                solve, _ = _timed(
+                    repeat, lambda: bayesian.Posterior.from_r(R, ALPHA, BETA, count).predict(predict))
+                result = {
+                    'n': n,
+                    'm': m,
+                    'parse': parse,
+                    'accumulate': accumulate,
+                    'solve': solve,
+                    'total': parse + accumulate + solve,
+                    'parse_peak_memory': parse_memory,
+                    'peak_memory': _peak_memory(_fit, chunks, m + 1, predict),
+                }
+                logging.info(
+                    f'N:{n:<10} M:{m:<4} total: {result["total"]:.6f}s'
+                    f' (parse: {parse:.6f}s, accumulate: {accumulate:.6f}s, solve: {solve:.6f}s)'
+                    f' peak memory: {result["peak_memory"] / 1024:.1f} KiB')
+                results.append(result)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Compares the total time of every (N, M) pair against the baseline,
+    returns the pairs that are slower than baseline * tolerance
+    """
+    previous = {(r['n'], r['m']): r for r in baseline['results']}
+    regressions = []
+    compared = 0
+    for result in results:
+        old = previous.get((result['n'], result['m']))
+        if not old:
+            continue
+        compared += 1
+        ratio = result['total'] / old['total'] if old['total'] else math.inf
+        status = 'REGRESSION' if ratio > tolerance else 'ok'
+        logging.info(
+            f'N:{result["n"]:<10} M:{result["m"]:<4} {old["total"]:.6f}s -> {result["total"]:.6f}s'
+            f' ({ratio:.2f}x) {status}')
+        if ratio > tolerance:
+            regressions.append(result)
+    if not compared:
+        logging.warning('No results to compare, the baseline was run with other parameters')
+    return regressions
+
+
+def _parse_list(ctx, param, value):
+    """Parses a comma separated list of integers, accepts scientific notation (1e6)"""
+    try:
+        values = [int(float(v)) for v in value.split(',') if v.strip()]
+    except ValueError:
+        raise click.BadParameter(f'expected a comma separated list of numbers, got: {value}')
+    if not values or min(values) < 1:
+        raise click.BadParameter('values must be positive')
+    return values
+
+
+def _setup_logging(debug):
+    fmt = '%(message)s'
+    loglevel = logging.INFO
+    if debug:
+        loglevel = logging.DEBUG
+    logging.basicConfig(format=fmt, level=loglevel)
+
+
+@click.command()
+@click.option('--debug', is_flag=True, help="Show debug data")
+@click.option(
+    '--sizes', '-n', default='1e2,1e3,1e4,1e5,1e6,1e7', callback=_parse_list,
+    help='Comma separated data sizes N.', show_default=True)
+@click.option(
+    '--orders', '-m', default='1,2,5,10,15,20', callback=_parse_list,
+    help='Comma separated polynomial orders M.', show_default=True)
+@click.option(
+    '--repeat', '-r', default=3, type=click.IntRange(min=1), show_default=True,
+    help='Runs per measurement, the best time is kept')
+@click.option(
+    '--seed', default=0, type=int, help='Random seed for the data', show_default=True)
+@click.option(
+    '--output', '-o', default='benchmark.json', type=click.Path(dir_okay=False, writable=True),
+    help='File to save the results to', show_default=True)
+@click.option(
+    '--baseline', default=None, type=click.Path(exists=True, dir_okay=False),
+    help='Results of a previous run to compare against')
+@click.option(
+    '--tolerance', default=1.2, type=float, show_default=True,
+    help='Slowdown against the baseline reported as a regression')
+def benchmark(debug, sizes, orders, repeat, seed, output, baseline, tolerance):
+    """Benchmark the Bayesian curve fitting path on synthetic data"""
+    _setup_logging(debug)
+    numpy.random.seed(seed)
+    results = run_benchmark(sizes, orders, repeat)
+
+    with open(output, 'w') as f:
+        json.dump({
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'machine': platform.platform(),
+            'repeat': repeat,
+            'seed': seed,
+            'results': results,
+        }, f, indent=2)
+    logging.info(f'Results saved to: {output}')
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), tolerance)
+        if regressions:
+            logging.error(f'{len(regressions)} regressions against the baseline: {baseline}')
+            exit(1)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+"""
+MNN Training Benchmark:
+
+Times MNN training on synthetic data (XOR of two uniform inputs), for a grid of
+batch sizes, hidden layer widths, depths (number of hidden layers) and dtypes,
+and splits the time between the training phases recorded by mnn.Profile:
+
+forward: forward_propagate
+backward: compute_gradients (the back propagation in backward_propagate_error)
+update: update_weights
+
+The results are saved as JSON and can be compared against a previous run (the baseline).
+"""
+
+import click
+import datetime
+import itertools
+import json
+import logging
+import math
+import mnn
+import numpy as np
+import platform
+import time
+
+logger = logging.getLogger(__name__)
+
+# learning rate of the benchmarked training
+LEARNING_RATE = 0.5
+
+
+def generate_data(rows):
+    """ rows samples of two uniform inputs, and their XOR (rounded) as output"""
+    inputs = np.random.uniform(size=(rows, 2))
+    outputs = np.logical_xor(inputs[:, 0] > 0.5, inputs[:, 1] > 0.5).astype(float)
+    return inputs, outputs[:, None]
+
+
+def _batches(inputs, outputs, batch_size):
+    """ the training data as a fit data function, in batches of batch_size rows"""
+    if batch_size >= len(inputs):
+        return inputs, outputs
+    starts = range(0, len(inputs), batch_size)
+    batches = [(inputs[i:i + batch_size], outputs[i:i + batch_size]) for i in starts]
+    return lambda: batches
+
+
+def _train(inputs, outputs, batch_size, width, depth, dtype, epochs, memory=False):
+    """ trains a new network for epochs epochs, returns its profile"""
+    network = mnn.MNN(
+        input_layers=inputs.shape[1], hidden_layers=[width] * depth,
+        output_layers=outputs.shape[1], dtype=dtype)
+    network.profile = mnn.Profile(memory=memory)
+    data = _batches(inputs.astype(dtype), outputs.astype(dtype), batch_size)
+
+    # the error is only checked at the end, like training with a large check_every
+    network.fit(data, LEARNING_RATE, epochs, error=0.0, check_every=epochs)
+    return network.profile
+
+
+def run_benchmark(rows, batch_sizes, widths, depths, dtypes, epochs, repeat=3):
+    """ Benchmarks every (batch size, width, depth, dtype), returns a list of results"""
+    inputs, outputs = generate_data(rows)
+    results = []
+    for batch_size, width, depth, dtype in itertools.product(batch_sizes, widths, depths, dtypes):
+        batch_size = min(batch_size, rows)
+
+        # keep the fastest run, the peak memory is measured in a run of its own
+        best = None
+        for _ in range(repeat):
+            profile = _train(inputs, outputs, batch_size, width, depth, dtype, epochs)
+            if best is None or profile.elapsed < best.elapsed:
+                best = profile
+        memory = _train(inputs, outputs, batch_size, width, depth, dtype, 1, memory=True)
+
+        summary = best.summary()
+        result = {
+            'rows': rows,
+            'batch_size': batch_size,
+            'width': width,
+            'depth': depth,
+            'dtype': dtype,
+            'epochs': epochs,
+            'total': summary['elapsed'],
+            'epochs_per_second': summary['epochs_per_second'],
+            'rows_per_second': summary['epochs_per_second'] * rows,
+            'forward': summary['times'].get('forward', 0.0),
+            'backward': summary['times'].get('backward', 0.0),
+            'update': summary['times'].get('update', 0.0),
+            'peak_memory': memory.peak_memory,
+        }
+        logger.info(
+            f'batch:{batch_size:<8} width:{width:<5} depth:{depth:<3} {dtype:<8}'
+            f' {result["epochs_per_second"]:.1f} epochs/sec'
+            f' (forward: {result["forward"]:.6f}s, backward: {result["backward"]:.6f}s,'
+            f' update: {result["update"]:.6f}s)'
+            f' peak memory: {result["peak_memory"] / 1024:.1f} KiB')
+        results.append(result)
+    return results
+
+
+def _key(result):
+    return (
+        result['rows'], result['batch_size'], result['width'], result['depth'], result['dtype'],
+        result['epochs'])
+
+
+def compare(results, baseline, tolerance):
+    """ Compares the total time of every configuration against the baseline,
+    returns the configurations that are slower than baseline * tolerance
+    """
+    previous = {_key(r): r for r in baseline['results']}
+    regressions = []
+    compared = 0
+    for result in results:
+        old = previous.get(_key(result))
+        if not old:
+            continue
+        compared += 1
+        ratio = result['total'] / old['total'] if old['total'] else math.inf
+        status = 'REGRESSION' if ratio > tolerance else 'ok'
+        logger.info(
+            f'batch:{result["batch_size"]:<8} width:{result["width"]:<5}'
+            f' depth:{result["depth"]:<3} {result["dtype"]:<8}'
+            f' {old["total"]:.6f}s -> {result["total"]:.6f}s ({ratio:.2f}x) {status}')
+        if ratio > tolerance:
+            regressions.append(result)
+    if not compared:
+        logger.warning('No results to compare, the baseline was run with other parameters')
+    return regressions
+
+
+def _parse_list(ctx, param, value):
+    """ Parses a comma separated list of integers, accepts scientific notation (1e6)"""
+    try:
+        values = [int(float(v)) for v in value.split(',') if v.strip()]
+    except ValueError:
+        raise click.BadParameter(f'expected a comma separated list of numbers, got: {value}')
+    if not values or min(values) < 1:
+        raise click.BadParameter('values must be positive')
+    return values
+
+
+def _parse_dtypes(ctx, param, value):
+    """ Parses a comma separated list of float32/float64"""
+    dtypes = [v.strip() for v in value.split(',') if v.strip()]
+    if not dtypes or any(d not in ('float32', 'float64') for d in dtypes):
+        raise click.BadParameter(f'expected float32 and/or float64, got: {value}')
+    return dtypes
+
+
+@click.command()
+@click.option('--debug', is_flag=True, help="Show debug data")
+@click.option(
+    '--rows', '-n', default=10000, type=click.IntRange(min=1), show_default=True,
+    help='Rows of synthetic training data')
+@click.option(
+    '--batch-sizes', '-b', default='32,256,1e4', callback=_parse_list, show_default=True,
+    help='Comma separated batch sizes, the number of rows for full batch training')
+@click.option(
+    '--widths', '-w', default='2,8,32,128', callback=_parse_list, show_default=True,
+    help='Comma separated hidden layer widths')
+@click.option(
+    '--depths', '-d', default='1,2', callback=_parse_list, show_default=True,
+    help='Comma separated numbers of hidden layers')
+@click.option(
+    '--dtypes', default='float64,float32', callback=_parse_dtypes, show_default=True,
+    help='Comma separated floating point types')
+@click.option(
+    '--epochs', '-r', default=10, type=click.IntRange(min=1), show_default=True,
+    help='Epochs trained per run')
+@click.option(
+    '--repeat', default=3, type=click.IntRange(min=1), show_default=True,
+    help='Runs per measurement, the best time is kept')
+@click.option(
+    '--seed', default=0, type=int, help='Random seed for the data', show_default=True)
+@click.option(
+    '--output', '-o', default='benchmark.json', type=click.Path(dir_okay=False, writable=True),
+    help='File to save the results to', show_default=True)
+@click.option(
+    '--baseline', default=None, type=click.Path(exists=True, dir_okay=False),
+    help='Results of a previous run to compare against')
+@click.option(
+    '--tolerance', default=1.2, type=float, show_default=True,
+    help='Slowdown against the baseline reported as a regression')
+def benchmark(
+        debug, rows, batch_sizes, widths, depths, dtypes, epochs, repeat, seed, output,
+        baseline, tolerance):
+    """ Benchmark MNN training on synthetic data"""
+    mnn.setup_logging(debug)
+    np.random.seed(seed)
+    start = time.perf_counter()
+    results = run_benchmark(rows, batch_sizes, widths, depths, dtypes, epochs, repeat)
+    logger.info(f'Benchmark took {time.perf_counter() - start:.1f}s')
+
+    with open(output, 'w') as f:
+        json.dump({
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.platform(),
+            'repeat': repeat,
+            'seed': seed,
+            'results': results,
+        }, f, indent=2)
+    logger.info(f'Results saved to: {output}')
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), tolerance)
+        if regressions:
+            logger.error(f'{len(regressions)} regressions against the baseline: {baseline}')
+            exit(1)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,7 +1,19 @@
 import click
-import csv
+import collections
+import concurrent.futures
+import contextlib
+import itertools
+import json
 import logging
+import math
+import multiprocessing
 import numpy as np
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
 
 logger = logging.getLogger(__name__)
 
@@ -9,76 +21,912 @@ logger = logging.getLogger(__name__)
 LOW = -1
 HIGH = 1
 
+# Rows read from the training file, and shuffled together, at a time
+BUFFER_ROWS = 64 * 1024
+
+# Binary copy of the training data next to the CSV file, and its metadata (size and mtime)
+CACHE_SUFFIX = '.npy'
+CACHE_META_SUFFIX = '.npy.json'
+
+
+class SGD:
+    """ Plain gradient descent: w += learning_rate * g
+
+    The optimizers get the descent direction g (the negative gradient of the error, as computed by
+    backward_propagate_error) and update the parameters in place, their state is kept in arrays
+    allocated once next to the parameters.
+    """
+
+    def setup(self, parameters):
+        """ allocate the optimizer state for the parameters"""
+
+    def select(self, index):
+        """ keep the state of the stacked ensemble members in index"""
+        for name, state in vars(self).items():
+            if isinstance(state, list):
+                setattr(self, name, [s[index] for s in state])
+
+    def step(self, parameters, gradients, learning_rate):
+        for parameter, gradient in zip(parameters, gradients):
+            gradient *= learning_rate
+            parameter += gradient
+
+
+class Momentum(SGD):
+    """ Momentum: v = momentum * v + learning_rate * g, w += v"""
+
+    def __init__(self, momentum=0.9):
+        self.momentum = momentum
+        self.velocities = None
+
+    def setup(self, parameters):
+        self.velocities = [np.zeros_like(p) for p in parameters]
+
+    def step(self, parameters, gradients, learning_rate):
+        for parameter, gradient, velocity in zip(parameters, gradients, self.velocities):
+            velocity *= self.momentum
+            gradient *= learning_rate
+            velocity += gradient
+            parameter += velocity
+
+
+class Nesterov(Momentum):
+    """ Nesterov momentum: v = momentum * v + learning_rate * g, w += momentum * v + learning_rate * g"""
+
+    def step(self, parameters, gradients, learning_rate):
+        for parameter, gradient, velocity in zip(parameters, gradients, self.velocities):
+            velocity *= self.momentum
+            gradient *= learning_rate
+            velocity += gradient
+            parameter += gradient
+            np.multiply(velocity, self.momentum, out=gradient)
+            parameter += gradient
+
+
+class RMSProp(SGD):
+    """ RMSProp: s = decay * s + (1 - decay) * g^2, w += learning_rate * g / (sqrt(s) + epsilon)"""
+
+    def __init__(self, decay=0.9, epsilon=1e-8):
+        self.decay = decay
+        self.epsilon = epsilon
+        self.squares = None
+        self.scratch = None
+
+    def setup(self, parameters):
+        self.squares = [np.zeros_like(p) for p in parameters]
+        self.scratch = [np.empty_like(p) for p in parameters]
+
+    def step(self, parameters, gradients, learning_rate):
+        for parameter, gradient, square, scratch in zip(
+                parameters, gradients, self.squares, self.scratch):
+            square *= self.decay
+            np.multiply(gradient, gradient, out=scratch)
+            scratch *= 1 - self.decay
+            square += scratch
+            np.sqrt(square, out=scratch)
+            scratch += self.epsilon
+            gradient *= learning_rate
+            gradient /= scratch
+            parameter += gradient
+
+
+class Adam(SGD):
+    """ Adam: m = beta1 * m + (1 - beta1) * g, v = beta2 * v + (1 - beta2) * g^2,
+    w += learning_rate * m_hat / (sqrt(v_hat) + epsilon), with the bias corrected m_hat and v_hat
+    """
+
+    def __init__(self, beta1=0.9, beta2=0.999, epsilon=1e-8):
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self.t = 0
+        self.means = None
+        self.squares = None
+        self.scratch = None
+
+    def setup(self, parameters):
+        self.t = 0
+        self.means = [np.zeros_like(p) for p in parameters]
+        self.squares = [np.zeros_like(p) for p in parameters]
+        self.scratch = [np.empty_like(p) for p in parameters]
+
+    def step(self, parameters, gradients, learning_rate):
+        # fold the bias correction into the step size
+        self.t += 1
+        step_size = (
+            learning_rate * np.sqrt(1 - self.beta2 ** self.t) / (1 - self.beta1 ** self.t))
+        for parameter, gradient, mean, square, scratch in zip(
+                parameters, gradients, self.means, self.squares, self.scratch):
+            mean *= self.beta1
+            square *= self.beta2
+            np.multiply(gradient, gradient, out=scratch)
+            scratch *= 1 - self.beta2
+            square += scratch
+            gradient *= 1 - self.beta1
+            mean += gradient
+            np.sqrt(square, out=scratch)
+            scratch += self.epsilon
+            np.divide(mean, scratch, out=gradient)
+            gradient *= step_size
+            parameter += gradient
+
+
+OPTIMIZERS = {
+    'sgd': SGD,
+    'momentum': Momentum,
+    'nesterov': Nesterov,
+    'rmsprop': RMSProp,
+    'adam': Adam,
+}
+
+
+class Schedule:
+    """ Constant learning rate, the base of the learning rate schedules
+
+    A schedule is called with the epoch to get its learning rate, and is told the error
+    every time it is checked.
+    """
+
+    def __init__(self, learning_rate):
+        self.learning_rate = learning_rate
+
+    def __call__(self, epoch):
+        return self.learning_rate
+
+    def observe(self, error):
+        """ the error at the last check"""
+
+
+class StepSchedule(Schedule):
+    """ Multiplies the learning rate by gamma every step_size epochs"""
+
+    def __init__(self, learning_rate, step_size=1000, gamma=0.5):
+        super().__init__(learning_rate)
+        self.step_size = step_size
+        self.gamma = gamma
+
+    def __call__(self, epoch):
+        return self.learning_rate * self.gamma ** (epoch // self.step_size)
+
+
+class CosineSchedule(Schedule):
+    """ Anneals the learning rate from learning_rate to min_learning_rate over epochs epochs"""
+
+    def __init__(self, learning_rate, epochs, min_learning_rate=0.0):
+        super().__init__(learning_rate)
+        self.epochs = epochs
+        self.min_learning_rate = min_learning_rate
+
+    def __call__(self, epoch):
+        progress = min(epoch / max(self.epochs, 1), 1.0)
+        return self.min_learning_rate + (self.learning_rate - self.min_learning_rate) * (
+            1 + math.cos(math.pi * progress)) / 2
+
+
+class PlateauSchedule(Schedule):
+    """ Multiplies the learning rate by gamma when the error has not improved in patience checks"""
+
+    def __init__(self, learning_rate, gamma=0.5, patience=10, min_learning_rate=0.0):
+        super().__init__(learning_rate)
+        self.gamma = gamma
+        self.patience = patience
+        self.min_learning_rate = min_learning_rate
+        self.best = np.inf
+        self.waited = 0
+
+    def observe(self, error):
+        if error < self.best:
+            self.best = error
+            self.waited = 0
+            return
+        self.waited += 1
+        if self.waited >= self.patience:
+            self.learning_rate = max(self.learning_rate * self.gamma, self.min_learning_rate)
+            self.waited = 0
+            logger.debug('Learning rate reduced to %s', self.learning_rate)
+
+
+# Training stats returned by MNN.fit
+History = collections.namedtuple('History', ['first_error', 'error', 'epochs'])
+
+
+class EarlyStopping:
+    """ Fit callback that stops the training when the error has not improved by min_delta
+    in patience checks
+    """
+
+    def __init__(self, patience=10, min_delta=0.0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = np.inf
+        self.waited = 0
+
+    def __call__(self, mnn, epoch, error):
+        if error < self.best - self.min_delta:
+            self.best = error
+            self.waited = 0
+            return False
+        self.waited += 1
+        if self.waited >= self.patience:
+            logger.info(f'Early stopping at epoch {epoch}, best error: {self.best}')
+            return True
+        return False
+
+
+class Checkpoint:
+    """ Fit callback that saves the network (see MNN.save) every `every` checks"""
+
+    def __init__(self, path, every=1):
+        self.path = path
+        self.every = every
+        self.checks = 0
+
+    def __call__(self, mnn, epoch, error):
+        self.checks += 1
+        if self.checks % self.every == 0:
+            mnn.save(self.path, epoch=epoch, error=error)
+            logger.debug('Checkpoint saved at epoch %d: %s', epoch, self.path)
+        return False
+
+
+class Profile:
+    """ Time spent in every phase of training (forward, backward and update, the rest is
+    reading the data and checking the error), epochs/sec and the peak memory allocated
+    while training (with tracemalloc, if memory is set)
+
+    Pass it to MNN (profile=) or set it as MNN.profile, tracing the memory slows training
+    down a lot. It is a context manager fit enters for every call.
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.times = collections.defaultdict(float)
+        self.epochs = 0
+        self.elapsed = 0.0
+        self.peak_memory = None
+        self._start = None
+        self._tracing = False
+
+    def add(self, phase, seconds):
+        self.times[phase] += seconds
+
+    def __enter__(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed += time.perf_counter() - self._start
+        if self._tracing:
+            peak = tracemalloc.get_traced_memory()[1]
+            self.peak_memory = max(self.peak_memory or 0, peak)
+            tracemalloc.stop()
+            self._tracing = False
+
+    def summary(self):
+        """ the profile as a dict"""
+        return {
+            'epochs': self.epochs,
+            'elapsed': self.elapsed,
+            'epochs_per_second': self.epochs / self.elapsed if self.elapsed else 0.0,
+            'times': dict(self.times),
+            'peak_memory': self.peak_memory,
+        }
+
+    def log(self):
+        """ Log the time of every phase, epochs/sec and peak memory"""
+        logger.info(f'--------- Profile -----------')
+        logger.info(
+            f'Epochs: {self.epochs} in {self.elapsed:.6f}s'
+            f' ({self.epochs / self.elapsed if self.elapsed else 0.0:.1f} epochs/sec)')
+        times = dict(self.times, other=max(self.elapsed - sum(self.times.values()), 0.0))
+        for phase, seconds in times.items():
+            share = seconds / self.elapsed if self.elapsed else 0.0
+            logger.info(f'{phase}: {seconds:.6f}s ({share:.1%})')
+        if self.peak_memory is not None:
+            logger.info(f'Peak memory: {self.peak_memory / 1024:.1f} KiB')
+        logger.info(f'-----------------------------')
+
 
 class MNN:
-    def __init__(self, input_layers=2, hidden_layers=2, output_layers=1):
+    def __init__(
+            self, input_layers=2, hidden_layers=2, output_layers=1, bias=True, dtype=np.float64,
+            optimizer=None, profile=None):
         self.network = []
         self.input_size = input_layers
-        self.hidden_size = hidden_layers
         self.output_size = output_layers
+        self.bias = bias
+        self.dtype = np.dtype(dtype)
+
+        # hidden layers can be a single width or a list of widths, one per hidden layer
+        if isinstance(hidden_layers, int):
+            hidden_layers = [hidden_layers]
+        self.hidden_size = list(hidden_layers)
+        self.sizes = [self.input_size] + self.hidden_size + [self.output_size]
+
+        # Create one (inputs x outputs) weight matrix, and bias vector, from every layer to the next
+        self.weights = [
+            np.random.uniform(low=LOW, high=HIGH, size=(n_in, n_out)).astype(self.dtype)
+            for n_in, n_out in zip(self.sizes[:-1], self.sizes[1:])]
+        self.biases = [
+            np.random.uniform(low=LOW, high=HIGH, size=n_out).astype(self.dtype)
+            if bias else np.zeros(n_out, self.dtype)
+            for n_out in self.sizes[1:]]
+
+        # gradient buffers do not depend on the batch size
+        self.weight_gradients = [np.empty_like(w) for w in self.weights]
+        self.bias_gradients = [np.empty_like(b) for b in self.biases]
 
-        # Create hidden layers first: (input x hidden) weight matrix from input to hidden layer
-        self.hidden = (
-            np.random.uniform(low=LOW, high=HIGH, size=(self.input_size, self.hidden_size)))
+        # activation and delta buffers, allocated once per batch size
+        self._buffers = {}
 
-        # Create output layers: (hidden x output) weight matrix from hidden to output layer
-        self.output = (
-            np.random.uniform(low=LOW, high=HIGH, size=(self.hidden_size, self.output_size)))
+        # optimizer state is allocated next to the weights
+        self.optimizer = optimizer or SGD()
+        self.optimizer.setup(self.parameters)
 
-    def activate(self, activation):
-        return 1.0 / (1.0 + np.exp(-activation))
+        # training instrumentation, off unless set (see Profile)
+        self.profile = profile
 
-    def activate_derivative(self, activation):
-        return activation * (1 - activation)
+    @property
+    def parameters(self):
+        """ weights (and biases) updated by the optimizer"""
+        return self.weights + self.biases if self.bias else self.weights
+
+    @property
+    def gradients(self):
+        """ gradient buffers, in the same order as parameters"""
+        return (
+            self.weight_gradients + self.bias_gradients if self.bias else self.weight_gradients)
+
+    @property
+    def hidden(self):
+        """ (input x hidden) weight matrix from input to the first hidden layer"""
+        return self.weights[0]
+
+    @property
+    def output(self):
+        """ (hidden x output) weight matrix from the last hidden layer to output layer"""
+        return self.weights[-1]
+
+    def buffers(self, batch_size):
+        """ Preallocated (activations, deltas, scratch) arrays for batches of batch_size rows"""
+        if batch_size not in self._buffers:
+            self._buffers[batch_size] = (
+                [np.empty((batch_size, n), self.dtype) for n in self.sizes[1:]],
+                [np.empty((batch_size, n), self.dtype) for n in self.sizes[1:]],
+                [np.empty((batch_size, n), self.dtype) for n in self.sizes[1:]])
+        return self._buffers[batch_size]
+
+    def activate(self, activation, out=None):
+        """ Sigmoid, computed in place when out is activation"""
+        out = np.negative(activation, out=out)
+        with np.errstate(over='ignore'):
+            np.exp(out, out=out)
+        out += 1.0
+        return np.reciprocal(out, out=out)
+
+    def activate_derivative(self, activation, out=None):
+        """ Sigmoid derivative from the sigmoid output: activation * (1 - activation)"""
+        out = np.subtract(1.0, activation, out=out)
+        out *= activation
+        return out
 
     def forward_propagate(self, training_inputs):
+        """ forward propagate through the network, the returned array is reused by the next call"""
+        training_inputs = np.asarray(training_inputs, dtype=self.dtype)
+        activations, _, _ = self.buffers(len(training_inputs))
 
-        # dot product of training_inputs and the hidden layers
-        self.z = np.dot(training_inputs, self.hidden)
+        outputs = training_inputs
+        for weights, bias, activation in zip(self.weights, self.biases, activations):
+            # dot product of the previous layer outputs and the layer weights, plus the bias
+            np.dot(outputs, weights, out=activation)
+            if self.bias:
+                activation += bias
 
-        # activation function of first putput
-        self.z2 = self.activate(self.z)
+            # activation function of the layer output
+            outputs = self.activate(activation, out=activation)
 
-        # dot product of hidden layers and output layers
-        self.z3 = np.dot(self.z2, self.output)
+        return outputs
 
-        # final activation function last output
-        return self.activate(self.z3)
+    def backward_propagate_error(
+            self, training_inputs, training_ouputs, outputs, learning_rate, loss=True):
+        """ backward propgate through the network and update the weights,
+        returns the sum of squared errors of outputs (if loss is set)
+        """
+        squared_error = self.compute_gradients(training_inputs, training_ouputs, outputs, loss)
+        self.update_weights(learning_rate)
+        return squared_error
 
-    def backward_propagate_error(self, training_inputs, training_ouputs, outputs, learning_rate):
-        """ backward propgate through the network"""
+    def compute_gradients(self, training_inputs, training_ouputs, outputs, loss=True):
+        """ backward propgate through the network into the gradient buffers,
+        returns the sum of squared errors of outputs (if loss is set)
+        """
+        training_inputs = np.asarray(training_inputs, dtype=self.dtype)
+        activations, deltas, scratch = self.buffers(len(training_inputs))
+        layer_inputs = [training_inputs] + activations[:-1]
 
         # error in output
-        self.outputs_error = training_ouputs - outputs
+        np.subtract(training_ouputs, outputs, out=deltas[-1])
+        squared_error = None
+        if loss:
+            error = deltas[-1].ravel()
+            squared_error = float(np.dot(error, error))
 
         # applying derivative of sigmoid to error
-        self.outputs_delta = self.outputs_error * self.activate_derivative(outputs)
+        deltas[-1] *= self.activate_derivative(outputs, out=scratch[-1])
 
-        # how much the hidden layers weights contributed to the output error
-        self.z2_error = self.outputs_delta.dot(self.output.T)
+        for i in range(len(self.weights) - 1, -1, -1):
+            # how much the previous layer contributed to the error, before its weights change
+            if i > 0:
+                np.dot(deltas[i], self.weights[i].T, out=deltas[i - 1])
+                deltas[i - 1] *= self.activate_derivative(activations[i - 1], out=scratch[i - 1])
 
-        # applying activation derivative to z2 error
-        self.z2_delta = self.z2_error*self.activate_derivative(self.z2)
+            # weight (and bias) gradients of the layer
+            np.dot(layer_inputs[i].T, deltas[i], out=self.weight_gradients[i])
+            np.sum(deltas[i], axis=0, out=self.bias_gradients[i])
 
-        # updates weights for the hidden layers
-        self.hidden += self.update_weights(
-            training_inputs, self.hidden, self.z2_delta, learning_rate)
+        return squared_error
 
-        # updates weights for the output layers
-        self.output += self.update_weights(
-            self.z2, self.output, self.outputs_delta, learning_rate)
+    def update_weights(self, learning_rate):
+        """ updates the weights (and biases) in place with the gradients"""
+        self.optimizer.step(self.parameters, self.gradients, learning_rate)
 
-    def update_weights(self, inputs, layer, delta, learning_rate):
-        return inputs.T.dot(delta) * learning_rate
+    def train_network(self, training_inputs, training_ouputs, learning_rate, loss=True):
+        """ one training step, returns the sum of squared errors of the forward pass
+        it trained on (if loss is set)
+        """
+        if self.profile is not None:
+            return self._profiled_train_network(
+                training_inputs, training_ouputs, learning_rate, loss)
+        o = self.forward_propagate(training_inputs)
+        return self.backward_propagate_error(
+            training_inputs, training_ouputs, o, learning_rate, loss)
 
-    def train_network(self, training_inputs, training_ouputs, learning_rate):
+    def _profiled_train_network(self, training_inputs, training_ouputs, learning_rate, loss):
+        """ train_network timing every phase into the profile"""
+        start = time.perf_counter()
         o = self.forward_propagate(training_inputs)
-        self.backward_propagate_error(training_inputs, training_ouputs, o, learning_rate)
+        forward = time.perf_counter()
+        squared_error = self.compute_gradients(training_inputs, training_ouputs, o, loss)
+        backward = time.perf_counter()
+        self.update_weights(learning_rate)
+        update = time.perf_counter()
+        self.profile.add('forward', forward - start)
+        self.profile.add('backward', backward - forward)
+        self.profile.add('update', update - backward)
+        return squared_error
+
+    def fit(
+            self, data, learning_rate=0.5, epochs=10000, error=0.02, check_every=1,
+            callbacks=()):
+        """ train until the mean squared error reaches error, or for epochs epochs
+
+        data is either (inputs, outputs) arrays, trained on as a single batch,
+        or a function returning an iterable of (inputs, outputs) batches for one epoch.
+        learning_rate is either a number or a Schedule.
+        The error is only computed, checked and passed to the callbacks every check_every epochs,
+        a callback(mnn, epoch, error) returning True stops the training.
+        """
+        if not callable(data):
+            batch = data
+            data = lambda: (batch,)  # noqa: E731
+        schedule = learning_rate if isinstance(learning_rate, Schedule) else Schedule(learning_rate)
+
+        if self.profile is None:
+            return self._fit(data, schedule, epochs, error, check_every, callbacks)
+        with self.profile:
+            history = self._fit(data, schedule, epochs, error, check_every, callbacks)
+        self.profile.epochs += history.epochs
+        return history
+
+    def _fit(self, data, schedule, epochs, error, check_every, callbacks):
+        """ the training loop of fit"""
+        it = 0
+        first_error = None
+        calculated_error = None
+        while it < epochs:
+            check = it == 0 or (it + 1) % check_every == 0 or it + 1 == epochs
+
+            # re-train network, accumulating the error of every batch before its update
+            squared_error = 0.0
+            count = 0
+            rate = schedule(it)
+            for inputs, outputs in data():
+                batch_error = self.train_network(inputs, outputs, rate, check)
+                if check:
+                    squared_error += batch_error
+                    count += np.size(outputs)
+            it += 1
+            if not check:
+                continue
+
+            # calculate mean sum squared error
+            calculated_error = self.checked_error(squared_error / count if count else 0.0)
+            logger.debug('Error for epoch %d: %s', it - 1, calculated_error)
+
+            # keep the first error around
+            if first_error is None:
+                first_error = calculated_error
+
+            schedule.observe(calculated_error)
+            stop = [callback(self, it - 1, calculated_error) for callback in callbacks]
+            if calculated_error <= error or any(stop):
+                break
+
+        return History(first_error, calculated_error, it)
+
+    def checked_error(self, error):
+        """ the mean squared error checked by fit"""
+        return error
 
     def predict(self, inputs):
         outputs = self.forward_propagate(inputs)
+        return outputs.copy()
+
+    def save(self, filename, **arrays):
+        """ Saves the architecture and weights to a .npz file,
+        arrays (the checkpoint epoch and error) are saved next to them
+        """
+        arrays.update({f'weights_{i}': w for i, w in enumerate(self.weights)})
+        arrays.update({f'bias_{i}': b for i, b in enumerate(self.biases)})
+        with open(filename, 'wb') as f:
+            np.savez(
+                f, sizes=self.sizes, bias=self.bias, dtype=self.dtype.str, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """ Loads a network saved with save"""
+        with np.load(filename) as data:
+            sizes = data['sizes'].tolist()
+            mnn = cls(
+                input_layers=sizes[0], hidden_layers=sizes[1:-1], output_layers=sizes[-1],
+                bias=bool(data['bias']), dtype=str(data['dtype']))
+            for i, (weights, bias) in enumerate(zip(mnn.weights, mnn.biases)):
+                weights[...] = data[f'weights_{i}']
+                bias[...] = data[f'bias_{i}']
+        return mnn
+
+
+class Ensemble(MNN):
+    """ members independently initialized networks trained at the same time
+
+    The weights of every layer are stacked in a (members x inputs x outputs) tensor, and the
+    biases in a (members x 1 x outputs) tensor, so one batched matmul advances all the members.
+    Members whose error is not finite, or has not improved by min_delta in patience checks,
+    are dropped (the best member is always kept). fit checks the error of the best member.
+    """
+
+    def __init__(
+            self, members=10, patience=100, min_delta=1e-4, input_layers=2, hidden_layers=2,
+            output_layers=1, bias=True, dtype=np.float64, optimizer=None, profile=None):
+        self.members = members
+        self.patience = patience
+        self.min_delta = min_delta
+        super().__init__(
+            input_layers, hidden_layers, output_layers, bias, dtype, optimizer, profile)
+
+        # stack the weights of members networks, drawn from the same distribution as MNN
+        self.weights = [
+            np.random.uniform(low=LOW, high=HIGH, size=(members, n_in, n_out)).astype(self.dtype)
+            for n_in, n_out in zip(self.sizes[:-1], self.sizes[1:])]
+        self.biases = [
+            np.random.uniform(low=LOW, high=HIGH, size=(members, 1, n_out)).astype(self.dtype)
+            if bias else np.zeros((members, 1, n_out), self.dtype)
+            for n_out in self.sizes[1:]]
+        self.weight_gradients = [np.empty_like(w) for w in self.weights]
+        self.bias_gradients = [np.empty_like(b) for b in self.biases]
+        self.optimizer.setup(self.parameters)
+
+        # last checked, and best, error of every member
+        self.errors = np.full(members, np.inf)
+        self.best_errors = np.full(members, np.inf)
+        self.waited = np.zeros(members, dtype=int)
+
+    def buffers(self, batch_size):
+        """ Preallocated (activations, deltas, scratch) arrays for batches of batch_size rows"""
+        if batch_size not in self._buffers:
+            self._buffers[batch_size] = (
+                [np.empty((self.members, batch_size, n), self.dtype) for n in self.sizes[1:]],
+                [np.empty((self.members, batch_size, n), self.dtype) for n in self.sizes[1:]],
+                [np.empty((self.members, batch_size, n), self.dtype) for n in self.sizes[1:]])
+        return self._buffers[batch_size]
+
+    def forward_propagate(self, training_inputs):
+        """ forward propagate through every member, returns a (members x batch x outputs) array
+        reused by the next call
+        """
+        training_inputs = np.asarray(training_inputs, dtype=self.dtype)
+        activations, _, _ = self.buffers(len(training_inputs))
+
+        outputs = training_inputs
+        for weights, bias, activation in zip(self.weights, self.biases, activations):
+            # the inputs are broadcast to every member
+            np.matmul(outputs, weights, out=activation)
+            if self.bias:
+                activation += bias
+            outputs = self.activate(activation, out=activation)
+
         return outputs
 
+    def compute_gradients(self, training_inputs, training_ouputs, outputs, loss=True):
+        """ backward propgate through every member into the gradient buffers,
+        returns the sum of squared errors of every member (if loss is set)
+        """
+        training_inputs = np.asarray(training_inputs, dtype=self.dtype)
+        activations, deltas, scratch = self.buffers(len(training_inputs))
+        layer_inputs = [training_inputs] + activations[:-1]
+
+        # error in output
+        np.subtract(training_ouputs, outputs, out=deltas[-1])
+        squared_error = None
+        if loss:
+            squared_error = np.einsum('kbo,kbo->k', deltas[-1], deltas[-1])
+
+        # applying derivative of sigmoid to error
+        deltas[-1] *= self.activate_derivative(outputs, out=scratch[-1])
+
+        for i in range(len(self.weights) - 1, -1, -1):
+            # how much the previous layer contributed to the error, before its weights change
+            if i > 0:
+                np.matmul(deltas[i], self.weights[i].swapaxes(1, 2), out=deltas[i - 1])
+                deltas[i - 1] *= self.activate_derivative(activations[i - 1], out=scratch[i - 1])
+
+            # weight (and bias) gradients of the layer
+            np.matmul(layer_inputs[i].swapaxes(-1, -2), deltas[i], out=self.weight_gradients[i])
+            np.sum(deltas[i], axis=1, keepdims=True, out=self.bias_gradients[i])
+
+        return squared_error
+
+    def checked_error(self, errors):
+        """ drops the diverged members, returns the error of the best member"""
+        self.errors = errors
+        with np.errstate(invalid='ignore'):
+            improved = errors < self.best_errors - self.min_delta
+        self.best_errors[improved] = errors[improved]
+        self.waited[improved] = 0
+        self.waited[~improved] += 1
+
+        finite = np.isfinite(errors)
+        if not finite.any():
+            return np.inf
+        diverged = ~finite
+        if self.patience:
+            diverged |= self.waited >= self.patience
+        diverged[np.argmin(np.where(finite, errors, np.inf))] = False
+        if diverged.any():
+            self.select(np.flatnonzero(~diverged))
+            logger.debug(
+                'Dropped %d diverged members, %d left', np.count_nonzero(diverged), self.members)
+        return float(np.min(self.errors[np.isfinite(self.errors)]))
+
+    def select(self, index):
+        """ keep the members in index"""
+        self.members = len(index)
+        self.weights = [w[index] for w in self.weights]
+        self.biases = [b[index] for b in self.biases]
+        self.weight_gradients = [g[index] for g in self.weight_gradients]
+        self.bias_gradients = [g[index] for g in self.bias_gradients]
+        self.errors = self.errors[index]
+        self.best_errors = self.best_errors[index]
+        self.waited = self.waited[index]
+        self.optimizer.select(index)
+        self._buffers = {}
+
+    def best(self):
+        """ a MNN with the weights of the member with the lowest error"""
+        member = int(np.argmin(self.errors))
+        mnn = MNN(
+            self.input_size, self.hidden_size, self.output_size, self.bias, self.dtype)
+        for weights, member_weights in zip(mnn.weights, self.weights):
+            weights[...] = member_weights[member]
+        for bias, member_bias in zip(mnn.biases, self.biases):
+            bias[...] = member_bias[member, 0]
+        mnn.profile = self.profile
+        return mnn
+
+    def save(self, filename, **arrays):
+        """ Saves the member with the lowest error"""
+        self.best().save(filename, **arrays)
+
+
+def _fit_ensemble(seed, members, patience, network, data, fit):
+    """ trains an Ensemble, returns the History and the best network"""
+    if seed is not None:
+        np.random.seed(seed)
+    ensemble = Ensemble(members, patience, **network)
+    history = ensemble.fit(data, **fit)
+    return history, ensemble.best()
+
+
+def fit_restarts(data, restarts, workers=1, patience=100, network=None, **fit):
+    """ trains restarts independently initialized networks, in an Ensemble or split in the
+    Ensembles of workers processes, returns the History and the network with the lowest error
+
+    network are the MNN arguments and fit the MNN.fit arguments, data must be arrays
+    (not a function) when workers > 1.
+    """
+    network = network or {}
+    if workers <= 1:
+        return _fit_ensemble(None, restarts, patience, network, data, fit)
+
+    # every process draws its own initial weights
+    members = [len(m) for m in np.array_split(np.arange(restarts), workers) if len(m)]
+    seeds = np.random.randint(2 ** 31 - 1, size=len(members))
+    with concurrent.futures.ProcessPoolExecutor(len(members)) as executor:
+        results = list(executor.map(
+            _fit_ensemble, seeds, members, itertools.repeat(patience), itertools.repeat(network),
+            itertools.repeat(data), itertools.repeat(fit)))
+    return min(results, key=lambda result: result[0].error)
+
+
+def _views(flat, shapes):
+    """ splits a flat array in views with shapes"""
+    views = []
+    start = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        views.append(flat[start:start + size].reshape(shape))
+        start += size
+    return views
+
+
+def _gradient_worker(memories, rows, shard, index, network, connection):
+    """ computes the gradients of a shard of the training data, every time the parent asks,
+    into the index gradient slot
+    """
+    data_memory, parameter_memory, gradient_memory = memories
+    mnn = MNN(**network)
+    layers = len(mnn.weights)
+    shapes = [w.shape for w in mnn.weights] + [b.shape for b in mnn.biases]
+    size = sum(int(np.prod(shape)) for shape in shapes)
+
+    # the data, weights and gradients are views of the shared memory
+    data = np.ndarray(rows * (mnn.input_size + mnn.output_size), mnn.dtype, data_memory.buf)
+    inputs = data[:rows * mnn.input_size].reshape(rows, mnn.input_size)[shard]
+    outputs = data[rows * mnn.input_size:].reshape(rows, mnn.output_size)[shard]
+    parameters = _views(np.ndarray(size, mnn.dtype, parameter_memory.buf), shapes)
+    mnn.weights, mnn.biases = parameters[:layers], parameters[layers:]
+    slots = np.ndarray((index + 1, size), mnn.dtype, gradient_memory.buf)
+    gradients = _views(slots[index], shapes)
+    mnn.weight_gradients, mnn.bias_gradients = gradients[:layers], gradients[layers:]
+
+    try:
+        while True:
+            loss = connection.recv()
+            if loss is None:
+                break
+            o = mnn.forward_propagate(inputs)
+            connection.send(mnn.compute_gradients(inputs, outputs, o, loss))
+    finally:
+        del data, inputs, outputs, parameters, slots, gradients, mnn
+        for memory in memories:
+            memory.close()
+        connection.close()
+
+
+class DataParallel(MNN):
+    """ MNN trained on full batches split in shards between worker processes
+
+    The training data, the weights and one gradient slot per worker live in shared memory
+    (multiprocessing.shared_memory, Python 3.8+), so every epoch the parent only sends each
+    worker a message: the workers compute the gradients of their shard into their slot,
+    the parent sums the slots and updates the weights.
+    """
+
+    def __init__(
+            self, workers=2, input_layers=2, hidden_layers=2, output_layers=1, bias=True,
+            dtype=np.float64, optimizer=None, profile=None):
+        self.workers = workers
+        self.connections = []
+        super().__init__(
+            input_layers, hidden_layers, output_layers, bias, dtype, optimizer, profile)
+
+    def fit(self, data, *args, **kwargs):
+        """ MNN.fit on (inputs, outputs) arrays, with the workers running"""
+        if callable(data):
+            raise ValueError('data parallel training needs (inputs, outputs) arrays')
+        with self.start(*data):
+            return super().fit(data, *args, **kwargs)
+
+    @contextlib.contextmanager
+    def start(self, inputs, outputs):
+        """ copies the data and weights to shared memory and starts the workers,
+        the weights are copied back when done
+        """
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:
+            raise RuntimeError('data parallel training needs Python 3.8+')
+
+        inputs = np.asarray(inputs, dtype=self.dtype)
+        outputs = np.asarray(outputs, dtype=self.dtype)
+        rows = len(inputs)
+        workers = max(min(self.workers, rows), 1)
+        layers = len(self.weights)
+        shapes = [w.shape for w in self.weights] + [b.shape for b in self.biases]
+        size = sum(int(np.prod(shape)) for shape in shapes)
+
+        itemsize = self.dtype.itemsize
+        memories = [
+            shared_memory.SharedMemory(
+                create=True, size=max(inputs.size + outputs.size, 1) * itemsize),
+            shared_memory.SharedMemory(create=True, size=size * itemsize),
+            shared_memory.SharedMemory(create=True, size=workers * size * itemsize)]
+        processes = []
+        try:
+            data = np.ndarray(inputs.size + outputs.size, self.dtype, memories[0].buf)
+            data[:inputs.size] = inputs.ravel()
+            data[inputs.size:] = outputs.ravel()
+            del data
+
+            # the weights become views of the shared memory, updated in place by the optimizer
+            parameters = _views(np.ndarray(size, self.dtype, memories[1].buf), shapes)
+            for parameter, value in zip(parameters, self.weights + self.biases):
+                parameter[...] = value
+            self.weights, self.biases = parameters[:layers], parameters[layers:]
+            self.slots = np.ndarray((workers, size), self.dtype, memories[2].buf)
+            self.flat_gradients = np.empty(size, self.dtype)
+            gradients = _views(self.flat_gradients, shapes)
+            self.weight_gradients, self.bias_gradients = gradients[:layers], gradients[layers:]
+
+            network = dict(
+                input_layers=self.input_size, hidden_layers=self.hidden_size,
+                output_layers=self.output_size, bias=self.bias, dtype=self.dtype)
+            bounds = np.linspace(0, rows, workers + 1).astype(int)
+            for index in range(workers):
+                parent, child = multiprocessing.Pipe()
+                process = multiprocessing.Process(
+                    target=_gradient_worker, daemon=True,
+                    args=(memories, rows, slice(bounds[index], bounds[index + 1]), index, network,
+                          child))
+                process.start()
+                child.close()
+                processes.append(process)
+                self.connections.append(parent)
+            logger.debug('Started %d data parallel workers', workers)
+            yield self
+        finally:
+            for connection in self.connections:
+                connection.send(None)
+                connection.close()
+            for process in processes:
+                process.join()
+            self.connections = []
+
+            # back to private copies of the weights
+            self.weights = [w.copy() for w in self.weights]
+            self.biases = [b.copy() for b in self.biases]
+            self.weight_gradients = [g.copy() for g in self.weight_gradients]
+            self.bias_gradients = [g.copy() for g in self.bias_gradients]
+            self.slots = self.flat_gradients = None
+            for memory in memories:
+                memory.close()
+                memory.unlink()
+
+    def train_network(self, training_inputs, training_ouputs, learning_rate, loss=True):
+        """ one training step of the workers on the data they were started with,
+        returns the sum of squared errors (if loss is set)
+        """
+        if not self.connections:
+            return super().train_network(training_inputs, training_ouputs, learning_rate, loss)
+        start = time.perf_counter()
+        for connection in self.connections:
+            connection.send(loss)
+        errors = [connection.recv() for connection in self.connections]
+        gradients = time.perf_counter()
+
+        # reduce the gradients of the shards
+        np.sum(self.slots, axis=0, out=self.flat_gradients)
+        reduce = time.perf_counter()
+        self.update_weights(learning_rate)
+        if self.profile is not None:
+            self.profile.add('gradients', gradients - start)
+            self.profile.add('reduce', reduce - gradients)
+            self.profile.add('update', time.perf_counter() - reduce)
+        return sum(errors) if loss else None
+
 
 def setup_logging(debug):
     """ Setup server logging"""
@@ -89,26 +937,222 @@ def setup_logging(debug):
     logging.basicConfig(format=fmt, level=loglevel)
 
 
-def load_csv_data(filename):
-    """ Load CSV data from file"""
-    data = list()
+def parse_csv(lines):
+    """ Parse CSV lines of numbers into a (rows x columns) array, ignoring empty rows"""
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        return np.empty((0, 0))
+    columns = lines[0].count(',') + 1
+    # the parse below only checks the total count, ragged rows could add up to full ones
+    if any(line.count(',') != columns - 1 for line in lines):
+        raise ValueError(f'expected rows of {columns} comma separated numbers')
+
+    # one vectorized parse of all the lines, stops early on anything that is not a number
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        try:
+            data = np.fromstring(','.join(lines), sep=',')
+        except (ValueError, DeprecationWarning):
+            data = None
+    if data is None or data.size != len(lines) * columns:
+        raise ValueError(f'expected rows of {columns} comma separated numbers')
+    return data.reshape(len(lines), columns)
+
+
+def load_csv_chunks(filename, chunk_rows=BUFFER_ROWS):
+    """ Load CSV data from file in blocks of at most chunk_rows rows"""
     with open(filename, 'r') as file:
-        csv_reader = csv.reader(file)
-        for row in csv_reader:
+        while True:
+            lines = list(itertools.islice(file, chunk_rows))
+            if not lines:
+                break
+            chunk = parse_csv(lines)
+            if len(chunk):
+                yield chunk
 
-            # ingore empty rows
-            if not row:
-                continue
 
-            data.append(row)
+def cache_valid(filename):
+    """ Checks if the binary copy of the CSV file exists and was made from its current version"""
+    try:
+        with open(f'{filename}{CACHE_META_SUFFIX}') as f:
+            meta = json.load(f)
+        stat = os.stat(filename)
+        os.stat(f'{filename}{CACHE_SUFFIX}')
+    except (OSError, ValueError):
+        return False
+    return meta.get('size') == stat.st_size and meta.get('mtime_ns') == stat.st_mtime_ns
+
+
+def _publish_cache(filename, tmp, stat):
+    """ Moves a binary copy made from the stat version of the CSV file to the cache"""
+    os.replace(tmp, f'{filename}{CACHE_SUFFIX}')
+    with open(f'{filename}{CACHE_META_SUFFIX}', 'w') as f:
+        json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}, f)
+
+
+def load_csv_data(filename, cache=True):
+    """ Load CSV data from file as a (rows x columns) array,
+    from (or into) a binary .npy copy next to it that is reused while the file does not change
+    """
+    if cache and cache_valid(filename):
+        logger.debug(f'Reading cached data: {filename}{CACHE_SUFFIX}')
+        return np.load(f'{filename}{CACHE_SUFFIX}', mmap_mode='r')
+
+    stat = os.stat(filename)
+    chunks = list(load_csv_chunks(filename))
+    data = np.concatenate(chunks) if chunks else np.empty((0, 0))
+    if cache:
+        tmp = f'{filename}{CACHE_SUFFIX}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                np.save(f, data)
+            _publish_cache(filename, tmp, stat)
+        except OSError as e:
+            logger.debug(f'Could not write cache for {filename}: {e}')
+            if os.path.exists(tmp):
+                os.remove(tmp)
     return data
 
 
-@click.command()
+def csv_to_memmap(filename, path=None):
+    """ Copy CSV data into a binary .npy file and open it memory-mapped,
+    with bounded memory. path defaults to the cache next to the CSV file (see load_csv_data)
+    """
+    cache = path is None
+    if cache:
+        if cache_valid(filename):
+            return np.load(f'{filename}{CACHE_SUFFIX}', mmap_mode='r')
+        path = f'{filename}{CACHE_SUFFIX}.{os.getpid()}.tmp'
+    stat = os.stat(filename)
+
+    # first pass: count the rows and columns to size the file
+    rows = 0
+    columns = 0
+    for chunk in load_csv_chunks(filename):
+        rows += len(chunk)
+        columns = chunk.shape[1]
+
+    # second pass: copy the data
+    data = np.lib.format.open_memmap(path, mode='w+', dtype=float, shape=(rows, columns))
+    start = 0
+    for chunk in load_csv_chunks(filename):
+        data[start:start + len(chunk)] = chunk
+        start += len(chunk)
+    data.flush()
+    del data
+
+    if cache:
+        _publish_cache(filename, path, stat)
+        path = f'{filename}{CACHE_SUFFIX}'
+    return np.load(path, mmap_mode='r')
+
+
+def count_columns(filename):
+    """ Number of columns of a CSV file"""
+    if cache_valid(filename):
+        return np.load(f'{filename}{CACHE_SUFFIX}', mmap_mode='r').shape[1]
+    with open(filename, 'r') as file:
+        for line in file:
+            if line.strip():
+                return line.count(',') + 1
+    return 0
+
+
+def parse_columns(ctx, param, value):
+    """ Parse comma separated column indexes and start:stop ranges (negative from the end)"""
+    if value is None:
+        return None
+    columns = []
+    try:
+        for item in value.split(','):
+            if ':' in item:
+                start, stop = item.split(':')
+                columns.append(slice(int(start) if start.strip() else None,
+                                     int(stop) if stop.strip() else None))
+            elif item.strip():
+                columns.append(int(item))
+    except ValueError:
+        raise click.BadParameter(f'expected comma separated columns (0,1 or 0:2), got: {value}')
+    if not columns:
+        raise click.BadParameter('no columns given')
+    return columns
+
+
+def resolve_columns(columns, count):
+    """ Indexes of parsed columns (see parse_columns) in a file with count columns"""
+    indexes = np.arange(count)
+    resolved = []
+    for column in columns:
+        if isinstance(column, slice):
+            resolved.extend(indexes[column].tolist())
+        elif -count <= column < count:
+            resolved.append(int(indexes[column]))
+        else:
+            raise ValueError(f'column {column} out of range, the data has {count} columns')
+    if not resolved:
+        raise ValueError('no columns selected')
+    return resolved
+
+
+def select_columns(filename, inputs=None, outputs=None):
+    """ Input and output column indexes of a CSV file,
+    by default the last column is the output and the rest are the inputs
+    """
+    count = count_columns(filename)
+    outputs = resolve_columns(outputs or [-1], count)
+    if inputs is None:
+        inputs = [i for i in range(count) if i not in outputs]
+    else:
+        inputs = resolve_columns(inputs, count)
+    if not inputs:
+        raise ValueError('no input columns left')
+    return inputs, outputs
+
+
+def shuffled_blocks(data, buffer_rows=BUFFER_ROWS):
+    """ Yields blocks of buffer_rows rows of an array (or memmap) in random order"""
+    starts = np.arange(0, len(data), buffer_rows)
+    np.random.shuffle(starts)
+    for start in starts:
+        yield np.array(data[start:start + buffer_rows])
+
+
+def shuffled_batches(blocks, batch_size, dtype=float):
+    """ Shuffles the rows of every block and splits it in batches of batch_size rows"""
+    for block in blocks:
+        block = np.asarray(block, dtype=dtype)
+        np.random.shuffle(block)
+        for start in range(0, len(block), batch_size):
+            yield block[start:start + batch_size]
+
+
+def parse_widths(ctx, param, value):
+    """ Parse comma separated layer widths"""
+    try:
+        widths = [int(v) for v in value.split(',') if v.strip()]
+    except ValueError:
+        raise click.BadParameter(f'expected comma separated widths, got: {value}')
+    if not widths or min(widths) < 1:
+        raise click.BadParameter('widths must be positive')
+    return widths
+
+
+@click.group()
+def cli():
+    """ Multilayer Neural Network with Back-Propagation"""
+
+
+@cli.command('train')
 @click.option(
     '--debug', is_flag=True, help="Show debug data")
 @click.option(
-    '--hidden', default=2, help='Number of hidden layers', type=int, show_default=True)
+    '--hidden', default='2', callback=parse_widths, show_default=True,
+    help='Number of hidden layers, comma separated widths for more than one layer (4,4)')
+@click.option(
+    '--bias/--no-bias', default=True, help='Add bias terms to every layer', show_default=True)
+@click.option(
+    '--dtype', default='float64', type=click.Choice(['float64', 'float32']),
+    help='Floating point type of the weights and activations', show_default=True)
 @click.option(
     '--error', '-e', default=0.02, help='Target error', type=float, show_default=True)
 @click.option(
@@ -116,70 +1160,403 @@ def load_csv_data(filename):
 @click.option(
     '--epochs', '-r', default=10000,
     help='Max number of epochs for learning', type=int, show_default=True)
+@click.option(
+    '--optimizer', default='sgd', type=click.Choice(list(OPTIMIZERS)),
+    help='Weight update rule', show_default=True)
+@click.option(
+    '--momentum', default=0.9, type=float, show_default=True,
+    help='Momentum of the momentum and nesterov optimizers')
+@click.option(
+    '--schedule', '-s', default='constant',
+    type=click.Choice(['constant', 'step', 'cosine', 'plateau']),
+    help='Learning rate schedule', show_default=True)
+@click.option(
+    '--step-size', default=1000, type=click.IntRange(min=1), show_default=True,
+    help='Epochs between learning rate steps of the step schedule')
+@click.option(
+    '--gamma', default=0.5, type=float, show_default=True,
+    help='Learning rate factor of the step and plateau schedules')
+@click.option(
+    '--schedule-patience', default=10, type=click.IntRange(min=1), show_default=True,
+    help='Checks without improvement before the plateau schedule reduces the learning rate')
+@click.option(
+    '--restarts', default=1, type=click.IntRange(min=1), show_default=True,
+    help='Train this many independently initialized networks at once and keep the best')
+@click.option(
+    '--restart-patience', default=100, type=click.IntRange(min=0), show_default=True,
+    help='Checks without improvement before a restart is dropped, 0 to keep them all')
+@click.option(
+    '--workers', '-w', default=1, type=click.IntRange(min=1), show_default=True,
+    help='Processes the restarts, or the shards of the training data, are split between')
+@click.option(
+    '--check-every', '-k', default=1, type=click.IntRange(min=1), show_default=True,
+    help='Compute and check the error every k epochs')
+@click.option(
+    '--patience', default=None, type=click.IntRange(min=1),
+    help='Stop when the error has not improved in this many checks')
+@click.option(
+    '--checkpoint', default=None, type=click.Path(dir_okay=False, writable=True),
+    help='Save the weights to this .npz file while training')
+@click.option(
+    '--checkpoint-every', default=100, type=click.IntRange(min=1), show_default=True,
+    help='Checks between checkpoints')
+@click.option(
+    '--batch-size', '-b', default=None, type=click.IntRange(min=1),
+    help='Stream the training data in shuffled mini-batches of this size. '
+         'If empty, load all the data and train on it as one batch')
+@click.option(
+    '--buffer-rows', default=BUFFER_ROWS, type=click.IntRange(min=1), show_default=True,
+    help='Rows read and shuffled together when streaming')
+@click.option(
+    '--memmap', is_flag=True,
+    help='Stream from a memory-mapped binary copy of the training data, '
+         'shuffling the whole file instead of one buffer at a time')
+@click.option(
+    '--inputs', '-i', default=None, callback=parse_columns,
+    help='Comma separated input columns, 0 based, start:stop for ranges and negative from '
+         'the end (0,1 or 0:2). If empty, every column but the outputs')
+@click.option(
+    '--outputs', default='-1', callback=parse_columns, show_default=True,
+    help='Comma separated output columns, like --inputs')
+@click.option(
+    '--cache/--no-cache', default=True, show_default=True,
+    help='Keep a binary copy of the training data next to it, reused while it does not change')
+@click.option(
+    '--profile', is_flag=True,
+    help='Report the time of every training phase and epochs/sec')
+@click.option(
+    '--profile-memory', is_flag=True,
+    help='Report the peak memory allocated while training too, slower')
+@click.option(
+    '--save', default=None, type=click.Path(dir_okay=False, writable=True),
+    help='Save the trained network to this .npz file')
 @click.argument('training_data', type=click.Path(exists=True))
 def run_mnn_xor(
         debug,
         hidden,
+        bias,
+        dtype,
         learning_rate,
         error,
         epochs,
+        optimizer,
+        momentum,
+        schedule,
+        step_size,
+        gamma,
+        schedule_patience,
+        restarts,
+        restart_patience,
+        workers,
+        check_every,
+        patience,
+        checkpoint,
+        checkpoint_every,
+        batch_size,
+        buffer_rows,
+        memmap,
+        inputs,
+        outputs,
+        cache,
+        profile,
+        profile_memory,
+        save,
         training_data):
     """ Run MNN with the provided test data and inputs/outputs """
 
     # setup logging
     setup_logging(debug)
 
-    # read input data row format:
-    # input_1, input2, expected_putput
-    #     int,    int,             int
-    data = load_csv_data(training_data)
-    data = np.array(data, dtype=float)
-    input_data = data[:, [0, 1]]
-    output_data = data[:, [2]]
-    mnn = MNN(input_layers=2, hidden_layers=hidden, output_layers=1)
-    logger.info(f'----------- Start -----------')
-    logger.info(f'Initial layer weights')
-    logger.info(f'Hidden Layers: \n{mnn.hidden}')
-    logger.info(f'Output Layers: \n{mnn.output}')
-    logger.info(f'-----------------------------')
+    if workers > 1 and (batch_size or (checkpoint and restarts > 1)):
+        raise click.BadParameter(
+            'training can not be split between workers when streaming, '
+            'or restarts when saving checkpoints',
+            param_hint='--workers')
+
+    # the network is sized from the input and output columns
+    try:
+        inputs, outputs = select_columns(training_data, inputs, outputs)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--inputs/--outputs')
+    logger.debug(f'Input columns: {inputs}, output columns: {outputs}')
 
-    # while we have reached the target error or max epochs
-    it = 0
-    first_error = 0
-    calculated_error = error + 1
-    while (calculated_error > error) and (it < epochs):
-        logger.debug(f'Input: \n{str(input_data)}')
-        logger.debug(f'Actual Output: \n{str(output_data)}')
+    if optimizer in ('momentum', 'nesterov'):
+        optimizer = OPTIMIZERS[optimizer](momentum)
+    else:
+        optimizer = OPTIMIZERS[optimizer]()
+    # restarts trained in other processes are profiled into copies of the profile,
+    # the network returned has the profile of its own training
+    network = dict(
+        input_layers=len(inputs), hidden_layers=hidden, output_layers=len(outputs), bias=bias,
+        dtype=dtype, optimizer=optimizer,
+        profile=Profile(memory=profile_memory) if profile or profile_memory else None)
 
-        # test network
-        o = mnn.forward_propagate(input_data)
-        logger.debug(f'Predicted Output: \n{str(o)}')
+    if restarts > 1:
+        mnn = None
+        logger.info(f'Training {restarts} networks with {workers} workers')
+    elif workers > 1:
+        mnn = DataParallel(workers, **network)
+        log_weights('Start', 'Initial layer weights', mnn)
+    else:
+        mnn = MNN(**network)
+        log_weights('Start', 'Initial layer weights', mnn)
 
-        # calculate mean sum squared error
-        calculated_error = np.mean(np.square(output_data - o))
-        logger.debug(f'Error for epoch {it}: {str(calculated_error)}')
+    # learning rate schedule
+    if schedule == 'step':
+        learning_rate = StepSchedule(learning_rate, step_size, gamma)
+    elif schedule == 'cosine':
+        learning_rate = CosineSchedule(learning_rate, epochs)
+    elif schedule == 'plateau':
+        learning_rate = PlateauSchedule(learning_rate, gamma, schedule_patience)
 
-        # keep the first error around
-        if it == 0:
-            first_error = calculated_error
+    callbacks = []
+    if patience:
+        callbacks.append(EarlyStopping(patience))
+    if checkpoint:
+        callbacks.append(Checkpoint(checkpoint, checkpoint_every))
 
-        # re-train network
-        mnn.train_network(input_data, output_data, learning_rate)
+    def train(data):
+        """ train the network, or the restarts, returns the History and the trained network"""
+        if restarts > 1:
+            return fit_restarts(
+                data, restarts, workers, restart_patience, network, learning_rate=learning_rate,
+                epochs=epochs, error=error, check_every=check_every, callbacks=callbacks)
+        return mnn.fit(data, learning_rate, epochs, error, check_every, callbacks), mnn
 
-        # increase current iteration number
-        it += 1
+    if batch_size:
+        history, mnn = run_mnn_batches(
+            train, np.dtype(dtype), batch_size, buffer_rows, memmap, training_data, inputs,
+            outputs, cache)
+    else:
+        input_data, output_data = load_training_data(
+            training_data, dtype, inputs, outputs, cache)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'Input: \n{str(input_data)}')
+            logger.debug(f'Actual Output: \n{str(output_data)}')
+
+        history, mnn = train((input_data, output_data))
 
     # print stats
+    log_results(history.first_error, history.error, history.epochs, mnn)
+    if mnn.profile is not None:
+        mnn.profile.log()
+    if save:
+        mnn.save(save)
+        logger.info(f'Network saved to: {save}')
+
+
+@cli.command('predict')
+@click.option(
+    '--debug', is_flag=True, help="Show debug data")
+@click.option(
+    '--output', '-o', default='-', type=click.Path(dir_okay=False, writable=True),
+    show_default=True,
+    help='File to write the predictions to (- for stdout), a .npy file is written memory-mapped')
+@click.option(
+    '--batch-size', '-b', default=BUFFER_ROWS, type=click.IntRange(min=1), show_default=True,
+    help='Rows predicted at a time')
+@click.option(
+    '--inputs', '-i', default=None, callback=parse_columns,
+    help='Comma separated input columns, like train --inputs. If empty, the first columns')
+@click.argument('model', type=click.Path(exists=True, dir_okay=False))
+@click.argument('input_data', type=click.Path(exists=True))
+def run_mnn_predict(debug, output, batch_size, inputs, model, input_data):
+    """ Predict the outputs of the rows of a CSV file with a network saved by train,
+    extra columns (like the expected outputs) are ignored
+    """
+    setup_logging(debug)
+    mnn = MNN.load(model)
+    try:
+        inputs = resolve_columns(inputs or [slice(0, mnn.input_size)], count_columns(input_data))
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--inputs')
+    if len(inputs) != mnn.input_size:
+        raise click.BadParameter(
+            f'the network has {mnn.input_size} inputs, got {len(inputs)} columns',
+            param_hint='--inputs')
+
+    start = time.perf_counter()
+    if output.endswith('.npy'):
+        rows = predict_memmap(mnn, input_data, output, batch_size, inputs)
+    elif output == '-':
+        rows = predict_csv(mnn, input_data, sys.stdout, batch_size, inputs)
+    else:
+        with open(output, 'w') as f:
+            rows = predict_csv(mnn, input_data, f, batch_size, inputs)
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f'Predicted {rows} rows in {elapsed:.3f}s ({rows / elapsed if elapsed else 0:.0f} rows/sec)')
+
+
+def predict_batches(mnn, input_data, batch_size, inputs=None):
+    """ Yields the predictions of the rows of a CSV file, batch_size rows at a time,
+    from the inputs columns (by default the first ones)
+    """
+    for chunk in load_csv_chunks(input_data, batch_size):
+        yield mnn.forward_propagate(
+            chunk[:, inputs] if inputs is not None else chunk[:, :mnn.input_size])
+
+
+def predict_csv(mnn, input_data, file, batch_size=BUFFER_ROWS, inputs=None):
+    """ Writes the predictions of the rows of a CSV file to a CSV file as they are computed,
+    returns the number of rows
+    """
+    rows = 0
+    for outputs in predict_batches(mnn, input_data, batch_size, inputs):
+        np.savetxt(file, outputs, delimiter=',', fmt='%.17g')
+        rows += len(outputs)
+    return rows
+
+
+def predict_memmap(mnn, input_data, path, batch_size=BUFFER_ROWS, inputs=None):
+    """ Writes the predictions of the rows of a CSV file to a memory-mapped .npy file,
+    returns the number of rows
+    """
+
+    # first pass: count the rows to size the file
+    with open(input_data, 'r') as file:
+        rows = sum(1 for line in file if line.strip())
+
+    data = np.lib.format.open_memmap(
+        path, mode='w+', dtype=mnn.dtype, shape=(rows, mnn.output_size))
+    start = 0
+    for outputs in predict_batches(mnn, input_data, batch_size, inputs):
+        data[start:start + len(outputs)] = outputs
+        start += len(outputs)
+    data.flush()
+    return rows
+
+
+@cli.command('scaling')
+@click.option(
+    '--debug', is_flag=True, help="Show debug data")
+@click.option(
+    '--hidden', default='2', callback=parse_widths, show_default=True,
+    help='Number of hidden layers, comma separated widths for more than one layer (4,4)')
+@click.option(
+    '--bias/--no-bias', default=True, help='Add bias terms to every layer', show_default=True)
+@click.option(
+    '--dtype', default='float64', type=click.Choice(['float64', 'float32']),
+    help='Floating point type of the weights and activations', show_default=True)
+@click.option(
+    '--workers', '-w', default='1,2,4,8', callback=parse_widths, show_default=True,
+    help='Comma separated worker counts')
+@click.option(
+    '--epochs', '-r', default=100, type=click.IntRange(min=1), show_default=True,
+    help='Epochs timed for every worker count')
+@click.argument('training_data', type=click.Path(exists=True))
+def run_mnn_scaling(debug, hidden, bias, dtype, workers, epochs, training_data):
+    """ Report the per-epoch scaling of data parallel training across worker counts"""
+    setup_logging(debug)
+    inputs, outputs = load_training_data(training_data, dtype)
+    network = dict(
+        input_layers=inputs.shape[1], hidden_layers=hidden, output_layers=outputs.shape[1],
+        bias=bias, dtype=dtype)
+    logger.info(f'Rows: {len(inputs)}, hidden layers: {hidden}, epochs: {epochs}')
+    for count, seconds, speedup, efficiency in measure_scaling(
+            network, inputs, outputs, workers, epochs):
+        logger.info(
+            f'Workers: {count:<4} epoch: {seconds:.6f}s speedup: {speedup:.2f}x'
+            f' efficiency: {efficiency:.0%}')
+
+
+def measure_scaling(network, inputs, outputs, worker_counts, epochs=100, learning_rate=0.5):
+    """ Times full batch epochs in one process and with DataParallel for every worker count,
+    returns a list of (workers, seconds per epoch, speedup, efficiency) against one process
+    """
+    results = []
+    serial = None
+    for workers in [1] + [w for w in worker_counts if w > 1]:
+        np.random.seed(0)
+        if workers > 1:
+            mnn = DataParallel(workers, **network)
+            context = mnn.start(inputs, outputs)
+        else:
+            mnn = MNN(**network)
+            context = contextlib.nullcontext()
+        with context:
+            # the first epoch allocates the buffers
+            mnn.train_network(inputs, outputs, learning_rate, False)
+            start = time.perf_counter()
+            for _ in range(epochs):
+                mnn.train_network(inputs, outputs, learning_rate, False)
+            seconds = (time.perf_counter() - start) / epochs
+        serial = serial or seconds
+        if workers == 1 and 1 not in worker_counts:
+            continue
+        speedup = serial / seconds
+        results.append((workers, seconds, speedup, speedup / workers))
+    return results
+
+
+def load_training_data(training_data, dtype=float, inputs=None, outputs=None, cache=True):
+    """ Load the (inputs, outputs) arrays of the training data,
+    from the input and output column indexes (see select_columns)
+    """
+    if inputs is None or outputs is None:
+        inputs, outputs = select_columns(training_data)
+    data = load_csv_data(training_data, cache)
+    return data[:, inputs].astype(dtype), data[:, outputs].astype(dtype)
+
+
+def run_mnn_batches(
+        train, dtype, batch_size, buffer_rows, memmap, training_data, inputs, outputs,
+        cache=True):
+    """ Run train(batches) streaming the training data in shuffled mini-batches,
+    with bounded memory
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        data = None
+        if memmap:
+            data = csv_to_memmap(
+                training_data, None if cache else os.path.join(directory, 'training.npy'))
+            logger.debug(f'Memory-mapped training data: {data.shape}')
+
+        def batches():
+            if memmap:
+                blocks = shuffled_blocks(data, buffer_rows)
+            else:
+                blocks = load_csv_chunks(training_data, buffer_rows)
+            for batch in shuffled_batches(blocks, batch_size, dtype):
+                yield batch[:, inputs], batch[:, outputs]
+
+        return train(batches)
+
+
+def log_weights(title, description, mnn):
+    """ Log the layer weights of the network"""
+    logger.info(f'----------- {title} -----------')
+    logger.info(description)
+    log_layers(mnn)
+    logger.info(f'-----------------------------')
+
+
+def log_layers(mnn):
+    """ Log the weights, and biases, of every layer"""
+    hidden = len(mnn.weights) - 1
+    for i, (weights, bias) in enumerate(zip(mnn.weights, mnn.biases)):
+        if i == hidden:
+            name = 'Output Layers'
+        elif hidden > 1:
+            name = f'Hidden Layers {i + 1}'
+        else:
+            name = 'Hidden Layers'
+        logger.info(f'{name}: \n{weights}')
+        if mnn.bias:
+            logger.info(f'{name} Bias: \n{bias}')
+
+
+def log_results(first_error, calculated_error, it, mnn):
+    """ Log the training stats and final weights"""
     logger.info('')
     logger.info(f'--------- Results -----------')
     logger.info(f'First batch error: {first_error}')
     logger.info(f'Last batch error: {calculated_error}')
     logger.info(f'Total number of batches: {it}')
     logger.info(f'Final layer weights')
-    logger.info(f'Hidden Layers: \n{mnn.hidden}')
-    logger.info(f'Output Layers: \n{mnn.output}')
+    log_layers(mnn)
     logger.info(f'-----------------------------')
 
 
 if __name__ == '__main__':
-    run_mnn_xor()
+    cli()
@@ -0,0 +1,260 @@
+import asyncio
+import logging
+import signal
+import struct
+
+from networking import config
+from networking.server import create_listener
+from networking.server import handle_data
+from networking.server import handle_missing
+from networking.utils import Commands
+from networking.utils import FileResponse
+from networking.utils import Header
+from networking.utils import Hello
+from networking.utils import compressed_frames
+from networking.utils import decode_message
+from networking.utils import encode_message
+from networking.utils import extract_command
+from networking.utils import pack_header
+from networking.utils import prepare_response
+from networking.utils import unpack_header
+
+logger = logging.getLogger(__name__)
+
+
+async def receive_header(reader, version=1):
+    """ Receives the header of the message, of size 0 if the client closed the connection"""
+    try:
+        data = await reader.readexactly(struct.calcsize(config.HEADER_PACKING[version]))
+    except asyncio.IncompleteReadError:
+        return Header(None, 0, 0)
+    return unpack_header(data, version)
+
+
+async def receive_message(reader, size):
+    """ Receives and decodes a message of size bytes"""
+    try:
+        data = await reader.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        logger.error(f'Could not receive message: {e}')
+        return None
+    return decode_message(data)
+
+
+def file_parts(response, version=1, request_id=0):
+    """ Yields the (offset, count, header) parts a file response is sent in:
+    the whole file after its header before version 3, then data frames of FRAME_CHUNK_SIZE bytes
+    """
+    header = pack_header(response.size, version, config.FRAME_FILE, request_id)
+    if version < 3 or not response.size:
+        yield response.offset, response.size, header
+        return
+
+    end = response.offset + response.size
+    for offset in range(response.offset, end, config.FRAME_CHUNK_SIZE):
+        count = min(config.FRAME_CHUNK_SIZE, end - offset)
+        yield offset, count, header + pack_header(count, version, config.FRAME_DATA, request_id)
+        header = b''
+
+
+async def send_part(response, writer, f, offset, count, header):
+    """ Writes a header and count bytes of the file of a response from offset,
+    from its cached contents or with loop.sendfile (os.sendfile when the platform supports it)
+    """
+    if response.data is not None:
+        # cached contents, the transport keeps a view of them until they are sent
+        view = memoryview(response.data)[offset:offset + count]
+        if count <= config.CACHE_SMALL_FILE_SIZE:
+            # one write for small files, a header sent alone can be held back
+            writer.write(header + view)
+        else:
+            writer.write(header)
+            writer.write(view)
+    else:
+        writer.write(header)
+        if count:
+            await asyncio.get_running_loop().sendfile(writer.transport, f, offset, count)
+    await writer.drain()
+
+
+async def send_compressed(response, writer, version=3, request_id=0, lock=None):
+    """ Sends a compressed file response (see compressed_frames), files compressed as a stream
+    are read and compressed in the default executor, without blocking the event loop
+    """
+    loop = asyncio.get_running_loop()
+    frames = compressed_frames(response, version, request_id)
+    while True:
+        if response.data is None:
+            frame = await loop.run_in_executor(None, next, frames, None)
+        else:
+            frame = next(frames, None)
+        if frame is None:
+            break
+        async with lock:
+            writer.write(frame)
+            await writer.drain()
+
+
+async def send_response(response, writer, version=1, request_id=0, lock=None):
+    """ Sends the response of a command, every frame is written holding the lock of the
+    connection, so the responses of other requests can be sent between the parts of a file
+    """
+    lock = lock or asyncio.Lock()
+    response = prepare_response(response, version)
+    if not isinstance(response, FileResponse):
+        async with lock:
+            writer.write(encode_message(response, version, request_id))
+            await writer.drain()
+        return
+    if response.codec:
+        await send_compressed(response, writer, version, request_id, lock)
+        return
+
+    f = open(response.path, 'rb') if response.data is None and response.size else None
+    try:
+        for offset, count, header in file_parts(response, version, request_id):
+            async with lock:
+                await send_part(response, writer, f, offset, count, header)
+    finally:
+        if f:
+            f.close()
+
+
+async def respond(data, addr_str, writer, version=1, request_id=0, lock=None, codec=None):
+    """ Handles a request and sends its response, returns the response and if the connection
+    should be closed after it
+    """
+    if codec and extract_command(data) in (Commands.GET,):
+        # files are compressed on cache misses, in the default executor
+        response, close = await asyncio.get_running_loop().run_in_executor(
+            None, handle_data, data, addr_str, codec)
+    else:
+        response, close = handle_data(data, addr_str, codec)
+    try:
+        await send_response(response, writer, version, request_id, lock)
+    except FileNotFoundError:
+        # files are opened before any of them is sent
+        await send_response(handle_missing(response), writer, version, request_id, lock)
+    return response, close
+
+
+async def respond_pipelined(data, addr_str, writer, version, request_id, lock, slots, codec=None):
+    """ Answers a pipelined request concurrently with the others of the connection"""
+    try:
+        await respond(data, addr_str, writer, version, request_id, lock, codec)
+    except ConnectionError as ce:
+        logger.error(f'There was a connection error: {ce}')
+    except Exception:
+        logger.exception(f'Something bad happened serving: {addr_str}')
+    finally:
+        slots.release()
+
+
+async def serve_client(reader, writer, counter=None):
+    """ Serve a client connection until it sends 'EXIT' or closes it,
+    since protocol version 3 its requests are answered concurrently, in any order
+    """
+    addr = writer.get_extra_info('peername')
+    addr_str = f'{addr[0]}:{addr[1]}'
+    logger.info(f'Received connection from client, address: {addr_str}')
+    if counter:
+        counter.opened()
+    # clients start with protocol version 1 without compression, until they negotiate with HELLO
+    version = 1
+    codec = None
+    lock = asyncio.Lock()
+    slots = asyncio.Semaphore(config.SERVER_PIPELINE_DEPTH)
+    requests = set()
+    try:
+        while True:
+
+            # get the size of the next data interaction
+            header = await receive_header(reader, version)
+            logger.debug(f'Next data size: {header.size}')
+
+            # client sent size 0 and ready to shutdown
+            if header.size == 0:
+                logger.info(f'Closing connection to client, address: {addr_str}')
+                break
+
+            data = await receive_message(reader, header.size)
+            if not data:
+                logger.error('Client sent no data, closing connection.')
+                break
+
+            if version >= 3 and extract_command(data) not in (Commands.EXIT, Commands.HELLO):
+                # wait for a slot, the client can not have more requests in flight
+                await slots.acquire()
+                task = asyncio.ensure_future(respond_pipelined(
+                    data, addr_str, writer, version, header.request_id, lock, slots, codec))
+                requests.add(task)
+                task.add_done_callback(requests.discard)
+                continue
+
+            # commands that change the connection are answered after the pending requests
+            await asyncio.gather(*requests)
+            response, close = await respond(
+                data, addr_str, writer, version, header.request_id, lock, codec)
+            if isinstance(response, Hello):
+                version, codec = response
+            if close:
+                break
+    except ConnectionError as ce:
+        logger.error(f'There was a connection error: {ce}')
+    except Exception:
+        logger.exception(f'Something bad happened serving: {addr_str}')
+    finally:
+        for task in requests:
+            task.cancel()
+        await asyncio.gather(*requests, return_exceptions=True)
+        writer.close()
+        if counter:
+            counter.closed()
+
+
+async def serve(host, port, sock=None, counter=None, signals=(signal.SIGINT, signal.SIGTERM)):
+    """ Serve clients concurrently on one event loop until one of signals is received,
+    at host:port or on an already listening socket
+    """
+    clients = set()
+
+    def connected(reader, writer):
+        # keep track of the client tasks to cancel them on shutdown
+        task = asyncio.ensure_future(serve_client(reader, writer, counter))
+        clients.add(task)
+        task.add_done_callback(clients.discard)
+
+    if sock is None:
+        sock = create_listener(host, port)
+        sock.setblocking(False)
+    server = await asyncio.start_server(connected, sock=sock)
+    logger.info(f'Server started, listening at: {host}:{port}')
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in signals:
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except (NotImplementedError, AttributeError):
+            # no signal handlers on this platform, KeyboardInterrupt stops the loop instead
+            pass
+
+    try:
+        await stop.wait()
+    finally:
+        logger.info('\nServer stopped, closing connections.')
+        server.close()
+        for task in clients:
+            task.cancel()
+        await asyncio.gather(*clients, return_exceptions=True)
+        await server.wait_closed()
+
+
+def run(host, port, buffer_size=config.SOCKET_BUFFER_SIZE):
+    """ Run the asyncio server"""
+    try:
+        sock = create_listener(host, port, buffer_size=buffer_size)
+        sock.setblocking(False)
+        asyncio.run(serve(host, port, sock))
+    except KeyboardInterrupt:
+        logger.info('\nServer stopped by KeyboardInterrupt.')
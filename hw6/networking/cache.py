@@ -0,0 +1,238 @@
+import collections
+import logging
+import mmap
+import os
+import stat
+import threading
+import time
+
+from networking import config
+from networking.compression import compress
+
+logger = logging.getLogger(__name__)
+
+# a file found by FileCache.find, data is its contents (bytes for small files, an mmap for
+# medium files) or None for large files, sent from disk with sendfile
+CachedFile = collections.namedtuple('CachedFile', ['path', 'size', 'data'])
+
+# the cached metadata of a requested file name, error is the message sent for missing files
+Metadata = collections.namedtuple('Metadata', ['path', 'size', 'mtime', 'error', 'checked'])
+
+
+class FileCache:
+    """ Cache of the files served from a directory:
+
+    metadata: the path, size and mtime of every requested file name (or why it can not be
+        served), the file is only stat'ed again after stat_ttl seconds, if its size or mtime
+        changed its cached contents are dropped
+    contents: the contents of files up to small_size bytes, the least recently used are
+        evicted to keep them under max_bytes
+    mmaps: files up to mmap_size bytes are mapped in memory, the max_maps least recently used
+    compressed: the contents of compressible files up to compress_size bytes compressed with
+        every codec requested, the least recently used are evicted to keep them under
+        max_compressed_bytes (so hot files are not compressed again on every request)
+
+    larger files are not cached, they are sent from disk with sendfile (or compressed as a stream)
+    """
+
+    def __init__(
+            self, directory=config.SERVER_STATIC_DIR, max_bytes=config.CACHE_MAX_BYTES,
+            small_size=config.CACHE_SMALL_FILE_SIZE, mmap_size=config.CACHE_MMAP_FILE_SIZE,
+            max_maps=config.CACHE_MAX_MMAPS, stat_ttl=config.CACHE_STAT_TTL,
+            max_entries=config.CACHE_MAX_ENTRIES,
+            max_compressed_bytes=config.CACHE_MAX_COMPRESSED_BYTES,
+            compress_size=config.CACHE_COMPRESS_FILE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.small_size = small_size
+        self.mmap_size = mmap_size
+        self.max_maps = max_maps
+        self.stat_ttl = stat_ttl
+        self.max_entries = max_entries
+        self.max_compressed_bytes = max_compressed_bytes
+        self.compress_size = compress_size
+        self.metadata = collections.OrderedDict()
+        self.contents = collections.OrderedDict()
+        self.maps = collections.OrderedDict()
+        self.compressed = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.compressed_bytes = 0
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+
+    def _stat(self, filename, now):
+        """ Stats the file, returns its metadata"""
+        path = os.path.abspath(f'{self.directory}/{filename}')
+        logger.debug(f'Processed file name: {filename}')
+        logger.debug(f'Processed file path: {path}')
+        try:
+            st = os.stat(path)
+        except OSError:
+            return Metadata(path, 0, 0, 'ERROR: no such file', now)
+        if not stat.S_ISREG(st.st_mode):
+            return Metadata(path, 0, 0, 'ERROR: not a file', now)
+        return Metadata(path, st.st_size, st.st_mtime_ns, None, now)
+
+    def _metadata(self, filename):
+        """ The metadata of the file, stat'ed again if it is older than stat_ttl"""
+        now = time.monotonic()
+        old = self.metadata.get(filename)
+        if old and now - old.checked < self.stat_ttl:
+            self.counters['stat_hits'] += 1
+            self.metadata.move_to_end(filename)
+            return old
+
+        self.counters['stat_misses'] += 1
+        meta = self._stat(filename, now)
+        if old and (old.size, old.mtime) != (meta.size, meta.mtime):
+            logger.debug(f'File changed: {meta.path}')
+            self.invalidate(meta.path)
+        self.metadata[filename] = meta
+        self.metadata.move_to_end(filename)
+        if len(self.metadata) > self.max_entries:
+            self.metadata.popitem(last=False)
+        return meta
+
+    def _contents(self, meta):
+        """ The contents of a small file, read and cached on a miss"""
+        data = self.contents.get(meta.path)
+        if data is not None and len(data) == meta.size:
+            self.counters['hits'] += 1
+            self.contents.move_to_end(meta.path)
+            return data
+
+        self.counters['misses'] += 1
+        with open(meta.path, 'rb') as f:
+            data = f.read()
+        if len(data) > self.max_bytes:
+            return data
+
+        self._drop_contents(meta.path)
+        self.contents[meta.path] = data
+        self.cached_bytes += len(data)
+        while self.cached_bytes > self.max_bytes:
+            _, evicted = self.contents.popitem(last=False)
+            self.cached_bytes -= len(evicted)
+            self.counters['evictions'] += 1
+        return data
+
+    def _map(self, meta):
+        """ A memory map of a medium file, mapped and cached on a miss"""
+        data = self.maps.get(meta.path)
+        if data is not None and len(data) == meta.size:
+            self.counters['mmap_hits'] += 1
+            self.maps.move_to_end(meta.path)
+            return data
+
+        self.counters['mmap_misses'] += 1
+        with open(meta.path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # the maps are not closed when they are dropped, responses being sent may still use them,
+        # they are unmapped when the last reference is released
+        self.maps[meta.path] = data
+        while len(self.maps) > self.max_maps:
+            self.maps.popitem(last=False)
+            self.counters['evictions'] += 1
+        return data
+
+    def _drop_contents(self, path):
+        data = self.contents.pop(path, None)
+        if data is not None:
+            self.cached_bytes -= len(data)
+
+    def _drop_compressed(self, key):
+        entry = self.compressed.pop(key, None)
+        if entry is not None:
+            self.compressed_bytes -= len(entry[1])
+
+    def invalidate(self, path):
+        """ Drops the cached contents, map and compressed contents of a file"""
+        self._drop_contents(path)
+        self.maps.pop(path, None)
+        for key in [key for key in self.compressed if key[0] == path]:
+            self._drop_compressed(key)
+
+    def _forget(self, path):
+        for filename in [name for name, meta in self.metadata.items() if meta.path == path]:
+            del self.metadata[filename]
+        self.invalidate(path)
+
+    def forget(self, path):
+        """ Drops the metadata and cached contents of a file that could not be opened (it was
+        removed since it was stat'ed), it is stat'ed again the next time it is requested
+        """
+        with self.lock:
+            self._forget(path)
+
+    def find(self, filename):
+        """ Finds a file in the directory, returns a CachedFile and None,
+        or None and an error message
+        """
+        with self.lock:
+            meta = self._metadata(filename)
+            if meta.error:
+                return None, meta.error
+
+            data = None
+            try:
+                if meta.size <= self.small_size and self.max_bytes:
+                    data = self._contents(meta)
+                elif meta.size <= self.mmap_size and self.max_maps:
+                    data = self._map(meta)
+                else:
+                    self.counters['sendfile'] += 1
+            except (OSError, ValueError) as e:
+                # the file changed or was removed since it was stat'ed, stat it again
+                # and send it from disk if it is still there
+                logger.debug(f'Could not cache file: {meta.path}: {e}')
+                self._forget(meta.path)
+                meta = self._metadata(filename)
+                if meta.error:
+                    return None, meta.error
+            size = meta.size if data is None else len(data)
+            return CachedFile(meta.path, size, data), None
+
+    def find_compressed(self, cached, codec):
+        """ The contents of a file found by find compressed with codec, compressed and cached
+        on a miss, None if the file is too large to keep compressed (it is compressed as a stream)
+        """
+        key = (cached.path, codec)
+        with self.lock:
+            if cached.size > self.compress_size or not self.max_compressed_bytes:
+                self.counters['compressed_streams'] += 1
+                return None
+
+            entry = self.compressed.get(key)
+            if entry is not None and entry[0] == cached.size:
+                self.counters['compressed_hits'] += 1
+                self.compressed.move_to_end(key)
+                return entry[1]
+            self.counters['compressed_misses'] += 1
+
+        # compressed without holding the lock, the other threads keep finding files meanwhile
+        if cached.data is not None:
+            data = compress(cached.data, codec)
+        else:
+            with open(cached.path, 'rb') as f:
+                data = compress(f.read(cached.size), codec)
+
+        with self.lock:
+            if len(data) <= self.max_compressed_bytes:
+                self._drop_compressed(key)
+                self.compressed[key] = (cached.size, data)
+                self.compressed_bytes += len(data)
+                while self.compressed_bytes > self.max_compressed_bytes:
+                    _, (_, evicted) = self.compressed.popitem(last=False)
+                    self.compressed_bytes -= len(evicted)
+                    self.counters['evictions'] += 1
+        return data
+
+    def stats(self):
+        """ The hit/miss counters and the cache sizes"""
+        with self.lock:
+            counters = dict(self.counters)
+            counters.update(
+                cached_files=len(self.contents), cached_bytes=self.cached_bytes,
+                mapped_files=len(self.maps), metadata_entries=len(self.metadata),
+                compressed_files=len(self.compressed), compressed_bytes=self.compressed_bytes)
+        return counters
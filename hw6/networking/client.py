@@ -1,10 +1,19 @@
 import click
+import functools
 import logging
 import socket
 
 from networking import config
+from networking.compression import CODECS
+from networking.pipeline import Pipeline
 from networking.utils import Commands
+from networking.utils import configure_socket
+from networking.utils import decode_message
 from networking.utils import extract_command
+from networking.utils import extract_parameters
+from networking.utils import receive_contents
+from networking.utils import receive_file
+from networking.utils import receive_header
 from networking.utils import receive_message
 from networking.utils import receive_size
 from networking.utils import send_message
@@ -22,66 +31,225 @@ def handle_help():
     logger.info('Commands you can enter are the following:')
     logger.info('HELP\t\t\tShows this menu.')
     logger.info(f'{Commands.GET} <file>\t\tGets specified file from the server.')
+    logger.info(f'{Commands.GET} <file> <offset> <length>\tGets length bytes of the file from offset.')
+    logger.info(f'{Commands.GET} <file> -o <path>\tSaves specified file from the server to path.')
+    logger.info(
+        f'{Commands.GET} <file> -o <path> -n <connections>\tDownloads the file over parallel'
+        f' connections, resuming a previous download.')
+    logger.info(f'{Commands.STATS}\t\t\tShows the hit/miss counters of the server file cache.')
     logger.info(f'{Commands.BOUNCE} <msg>\t\tThe server echos the message back to the client.')
     logger.info(f'{Commands.EXIT} [<code>]\t\tClose connection and exit with provided code.')
 
 
-def handle_bounce(data, connection):
-    """ Handle the bounce command"""
+def handle_hello(connection, version=config.PROTOCOL_VERSION, compression=None):
+    """ Negotiate the protocol version and the compression codec with the server,
+    returns the version and the codec (or None) to use, servers that do not know the HELLO
+    command only support version 1, and servers that do not compress do not answer a codec
+    """
+    offer = f' {compression}' if compression and compression != 'none' else ''
+    logger.debug(f'Sending HELLO message to server, version: {version}{offer}.')
+    send_message(f'{Commands.HELLO} {version}{offer}', connection)
+
+    # the response is sent with version 1, the version switches after it
+    size = receive_size(connection)
+    response = receive_message(connection, size) if size else None
+    codec = None
+    if response and extract_command(response) == Commands.HELLO:
+        params = extract_parameters(response)
+        version = int(params[0])
+        if len(params) > 1 and params[1] in CODECS:
+            codec = params[1]
+    else:
+        logger.debug(f'Server does not support HELLO: {response}')
+        version = 1
+    logger.debug(f'Protocol version: {version}, compression: {codec}')
+    return version, codec
+
+
+def handle_bounce(data, connection, version=1, buffer=None):
+    """ Handle the bounce command, the response is received into buffer (see receive_message)"""
 
     # first send
     logger.debug('Sending BOUNCE message to server.')
-    send_message(data, connection)
+    send_message(data, connection, version)
 
     # now wait for resonse
     logger.debug('Awaiting response from server.')
-    size = receive_size(connection)
+    size = receive_size(connection, version)
     if size != 0:
-        response = receive_message(connection, size)
+        response = receive_message(connection, size, buffer=buffer)
         logger.info(response)
     else:
         logger.info('No data sent by server...')
 
 
-def handle_get(data, connection):
-    """ Handle the get command"""
+def handle_stats(data, connection, version=1, buffer=None):
+    """ Handle the stats command, the response is received into buffer (see receive_message)"""
 
     # first send
-    logger.debug('Sending GET message to server.')
-    send_message(data, connection)
+    logger.debug('Sending STATS message to server.')
+    send_message(data, connection, version)
 
     # now wait for resonse
     logger.debug('Awaiting response from server.')
-    size = receive_size(connection)
+    size = receive_size(connection, version)
     if size != 0:
-        response = receive_message(connection, size)
+        response = receive_message(connection, size, buffer=buffer)
         logger.info(response)
     else:
         logger.info('No data sent by server...')
 
 
-def handle_exit(data, connection):
-    """ Handle the exit command"""
+def parse_get(data):
+    """ Splits the client side options from the GET command: the output path (-o <path>)
+    and the parallel connections (-n <connections>), returns the command to send,
+    the path (None to log the file) and the connections (None to use this connection)
+    """
+    params = extract_parameters(data)
+    options = {}
+    for option in ('-o', '-n'):
+        if option in params:
+            index = params.index(option)
+            if index + 1 >= len(params):
+                raise ValueError(f'no value provided for {option}')
+            options[option] = params[index + 1]
+            params = params[:index] + params[index + 2:]
+
+    output = options.get('-o')
+    connections = options.get('-n')
+    if connections is not None:
+        if not connections.isdigit() or int(connections) < 1:
+            raise ValueError(f'invalid number of connections: {connections}')
+        if not output:
+            raise ValueError('-n requires an output path (-o <path>)')
+        connections = int(connections)
+    return ' '.join([Commands.GET] + params), output, connections
+
+
+def handle_get(data, connection, version=1, connect=None, codec=None, buffer=None):
+    """ Handle the get command, with -o <path> the file is streamed to disk,
+    and with -n <connections> downloaded over new connections opened by connect,
+    compressed files are decompressed with codec as they are received,
+    messages are received into buffer (see receive_message)
+    """
+    try:
+        data, output, connections = parse_get(data)
+    except ValueError as e:
+        logger.error(f'ERROR: {e}')
+        return
+
+    if connections:
+        # imported here, it imports this module to connect to the server
+        from networking import download
+        params = extract_parameters(data)
+        download.run(connect, params[0] if params else '', output, connections, connection, version)
+        return
+
+    # first send
+    logger.debug('Sending GET message to server.')
+    send_message(data, connection, version)
+
+    # now wait for resonse
+    logger.debug('Awaiting response from server.')
+    frame, _, size = receive_header(connection, version)
+    codec = codec if frame == config.FRAME_COMPRESSED else None
+    if size == 0 and not codec:
+        logger.info('No data sent by server...')
+    elif output and frame != config.FRAME_MESSAGE:
+        # version 1 can not tell files from error messages, everything is saved
+        receive_file(connection, size, output, version=version, codec=codec)
+        logger.info(f'Saved {size} bytes to: {output}')
+    elif frame in (config.FRAME_FILE, config.FRAME_COMPRESSED):
+        logger.info(decode_message(receive_contents(connection, size, version, codec)))
+    else:
+        response = receive_message(connection, size, buffer=buffer)
+        logger.info(response)
+
+
+def handle_exit(data, connection, version=1, buffer=None):
+    """ Handle the exit command, the response is received into buffer (see receive_message)"""
 
     # first send
     logger.debug('Sending EXIT message to server.')
-    send_message(data, connection)
+    send_message(data, connection, version)
 
     # now wait for resonse
     logger.debug('Awaiting response from server.')
-    size = receive_size(connection)
+    size = receive_size(connection, version)
     if size != 0:
-        response = receive_message(connection, size)
+        response = receive_message(connection, size, buffer=buffer)
         logger.info(response)
     else:
         logger.info('No data sent by server...')
 
 
+def handle_pipelined(data, pipeline, connect=None):
+    """ Handle a command without waiting for the responses to the previous ones,
+    they are logged (or saved) by the pipeline as they arrive
+    """
+    command = extract_command(data)
+    output = None
+    if command in (Commands.GET,):
+        try:
+            data, output, connections = parse_get(data)
+        except ValueError as e:
+            logger.error(f'ERROR: {e}')
+            return
+
+        if connections:
+            # imported here, it imports this module to connect to the server
+            from networking import download
+            pipeline.wait()
+            params = extract_parameters(data)
+            download.run(connect, params[0] if params else '', output, connections)
+            return
+
+    pipeline.submit(data, output)
+    if command in (Commands.EXIT,):
+        pipeline.wait()
+
+
+def connect(
+        host, port, buffer_size=config.SOCKET_BUFFER_SIZE, protocol=config.PROTOCOL_VERSION,
+        compression=config.CLIENT_COMPRESSION, timeout=None):
+    """ Connects to the server and negotiates the protocol version and compression codec,
+    returns the socket, the version and the codec (or None)
+    """
+    s = socket.socket()
+    s.settimeout(timeout)
+    try:
+        # set before connecting, the TCP window scale is negotiated on connect
+        configure_socket(s, buffer_size)
+        # requests are sent whole with one sendall, Nagle would only hold pipelined ones back
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.connect((host, port))
+        version, codec = handle_hello(s, protocol, compression) if protocol > 1 else (1, None)
+    except Exception:
+        s.close()
+        raise
+    return s, version, codec
+
+
 @click.command()
 @click.option('--debug', is_flag=True, help="Show debug data")
 @click.option('--host', '-h', default='127.0.0.1', help='IP to bind.', type=str, show_default=True)
 @click.option('--port', '-p', default=3000, help='Port to bind.', type=int, show_default=True)
-def run(debug, host, port):
+@click.option(
+    '--buffer-size', '-b', default=config.SOCKET_BUFFER_SIZE, type=click.IntRange(min=0),
+    show_default=True, help='Socket send/receive buffer size in bytes, 0 for the OS default.')
+@click.option(
+    '--protocol', default=config.PROTOCOL_VERSION,
+    type=click.IntRange(min=1, max=config.PROTOCOL_VERSION), show_default=True,
+    help='Highest wire protocol version to negotiate with the server.')
+@click.option(
+    '--pipeline', default=config.CLIENT_PIPELINE_DEPTH, type=click.IntRange(min=1),
+    show_default=True,
+    help='Requests sent without waiting for the previous responses (protocol version 3).')
+@click.option(
+    '--compression', '-c', default=config.CLIENT_COMPRESSION,
+    type=click.Choice(('none',) + CODECS), show_default=True,
+    help='Codec offered to the server to receive compressible files (protocol version 3).')
+def run(debug, host, port, buffer_size, protocol, pipeline, compression):
 
     # validate IP address
     if not validate_ip(host):
@@ -101,14 +269,27 @@ def run(debug, host, port):
     # Create a socket object
     s = None
     try:
-        s = socket.socket()
-        s.connect((host, port))
+        s, version, codec = connect(host, port, buffer_size, protocol, compression)
         addr_str = f'{host}:{port}'
         logger.info(f'Connected to server: {addr_str}')
         logger.info('Please enter commands or type "HELP" for list of available commands')
+        # the responses of the connection are received into one buffer
+        buffer = bytearray(config.MESSAGE_BUFFER_SIZE)
+
+        # pipelined requests, their responses are received by another thread
+        if pipeline > 1 and version >= 3:
+            pipeline = Pipeline(s, version, pipeline, codec)
+        else:
+            pipeline = None
 
         while CLIENT_RUNNING:
-            input_raw = input(config.CLIENT_PROMPT_CHAR)
+            try:
+                input_raw = input(config.CLIENT_PROMPT_CHAR)
+            except EOFError:
+                # end of the piped commands, wait for the responses still in flight
+                if pipeline:
+                    pipeline.wait()
+                raise
 
             # clean the command by stripping preceeding/trailing spaces
             # and removing any trailing newline/carriage returns
@@ -126,14 +307,27 @@ def run(debug, host, port):
             # HELP command:
             if command in ('HELP',):
                 handle_help()
+            elif pipeline and command in (
+                    Commands.EXIT, Commands.GET, Commands.STATS, Commands.BOUNCE):
+                handle_pipelined(
+                    input_processed, pipeline,
+                    functools.partial(connect, host, port, buffer_size, protocol, compression))
+                if command in (Commands.EXIT,):
+                    s.close()
+                    CLIENT_RUNNING = False
             elif command in (Commands.EXIT,):
-                handle_exit(input_processed, s)
+                handle_exit(input_processed, s, version, buffer)
                 s.close()
                 CLIENT_RUNNING = False
             elif command in (Commands.GET,):
-                handle_get(input_processed, s)
+                handle_get(
+                    input_processed, s, version,
+                    functools.partial(connect, host, port, buffer_size, protocol, compression),
+                    codec, buffer)
+            elif command in (Commands.STATS,):
+                handle_stats(input_processed, s, version, buffer)
             elif command in (Commands.BOUNCE,):
-                handle_bounce(input_processed, s)
+                handle_bounce(input_processed, s, version, buffer)
             else:
                 continue
     except (KeyboardInterrupt, SystemExit):
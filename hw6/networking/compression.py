@@ -0,0 +1,90 @@
+import lzma
+import mimetypes
+import zlib
+
+from networking import config
+
+# the codecs from the standard library, by the name negotiated with HELLO:
+# zlib and gzip are deflate streams with a zlib or gzip wrapper (wbits), lzma an xz stream
+CODECS = ('zlib', 'gzip', 'lzma')
+WBITS = {'zlib': zlib.MAX_WBITS, 'gzip': zlib.MAX_WBITS | 16}
+
+
+def compressor(codec, level=config.COMPRESSION_LEVEL):
+    """ A new compressor object of the codec (compress/flush)"""
+    if codec == 'lzma':
+        return lzma.LZMACompressor(preset=level)
+    return zlib.compressobj(level, zlib.DEFLATED, WBITS[codec])
+
+
+def decompressor(codec):
+    """ A new decompressor object of the codec (decompress/eof)"""
+    if codec == 'lzma':
+        return lzma.LZMADecompressor()
+    return zlib.decompressobj(WBITS[codec])
+
+
+def compress(data, codec, level=config.COMPRESSION_LEVEL):
+    """ Compresses data (any bytes-like object) at once, returns bytes"""
+    c = compressor(codec, level)
+    return c.compress(data) + c.flush()
+
+
+def compress_file(path, offset, size, codec, block_size=config.FILE_BLOCK_SIZE):
+    """ Yields the compressed parts of size bytes of a file from offset, reading it in blocks
+    of block_size (constant memory), compressors only output data every few blocks
+    """
+    c = compressor(codec)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        remaining = size
+        while remaining:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                raise ValueError(f'file truncated with {remaining} bytes left: {path}')
+            remaining -= len(block)
+            part = c.compress(block)
+            if part:
+                yield part
+    yield c.flush()
+
+
+def inflate(d, data, limit, block_size=config.FILE_BLOCK_SIZE):
+    """ Yields the decompressed parts of data with a decompressor object, of at most block_size
+    bytes (a small compressed frame can inflate to any size, it is never decompressed at once),
+    raises ValueError if it decompresses to more than limit bytes
+    """
+    while True:
+        # one byte more than allowed tells if there is more output
+        length = min(block_size, limit + 1)
+        part = d.decompress(data, length)
+        if len(part) > limit:
+            raise ValueError(f'more than {limit} bytes of decompressed data')
+        limit -= len(part)
+        if part:
+            yield part
+        # zlib keeps the input it did not decompress in unconsumed_tail, lzma buffers it and
+        # both can have more output when they filled the length
+        data = getattr(d, 'unconsumed_tail', b'')
+        if d.eof or not data and len(part) < length:
+            return
+
+
+def negotiate(offered, supported=config.COMPRESSION_CODECS):
+    """ The first codec offered by the client that the server supports, or None"""
+    for codec in offered:
+        if codec in CODECS and codec in supported:
+            return codec
+    return None
+
+
+def compressible(path, size):
+    """ Checks if a file of size bytes is worth compressing by its media type: text and a few
+    text based formats, binary files (images, archives...) are usually compressed already
+    """
+    if size < config.COMPRESSION_MIN_SIZE:
+        return False
+    media_type, encoding = mimetypes.guess_type(path)
+    if not media_type or encoding:
+        return False
+    return media_type.startswith('text/') or media_type in config.COMPRESSIBLE_TYPES
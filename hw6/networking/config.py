@@ -7,16 +7,77 @@ import os
 
 # general config
 PACKING = '<L'
-LENGTH_BYTES = 4
+# wire protocol versions, negotiated with 'HELLO <version>' (old servers answer 'Invalid Command'):
+# 1: message length as unsigned int (PACKING)
+# 2: frame type (message or file) and length as unsigned long long, for files over 4 GiB
+# 3: frame type, request ID (unsigned int) and length, requests can be pipelined and answered
+#    out of order: a file frame announces the file length and its contents follow in data
+#    frames of up to FRAME_CHUNK_SIZE bytes, which can be interleaved with other responses
+PROTOCOL_VERSION = 3
+HEADER_PACKING = {1: PACKING, 2: '<BQ', 3: '<BIQ'}
+FRAME_MESSAGE = 0
+FRAME_FILE = 1
+FRAME_DATA = 2
+# a compressed file frame announces the uncompressed length, the compressed contents follow in
+# data frames and an empty data frame ends them (protocol version 3)
+FRAME_COMPRESSED = 3
+FRAME_CHUNK_SIZE = 1024 * 1024
+# block size of files received to disk
+FILE_BLOCK_SIZE = 1024 * 1024
+# initial size of the buffer the messages of a connection are received into, grown as needed
+MESSAGE_BUFFER_SIZE = 4096
 DATA_ENCODING = 'utf-8'
 TRANSFER_TIMEOUT = 5.0
-MAX_BUFFER_SIZE = 4 * 1024
+# kernel socket buffer sizes (SO_RCVBUF/SO_SNDBUF) in bytes, 0 keeps the OS defaults
+SOCKET_BUFFER_SIZE = int(os.environ.get('SOCKET_BUFFER_SIZE', 0))
 RETURN_KEY = '\xED\x1E\x94\x7C'
+# compression codecs, negotiated with 'HELLO <version> <codec>' (see networking.compression):
+# COMPRESSION_CODECS are the ones the server accepts, COMPRESSION_LEVEL the zlib level
+# or the lzma preset
+COMPRESSION_CODECS = os.environ.get('COMPRESSION_CODECS', 'zlib,gzip,lzma').split(',')
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 6))
+# smaller files are not compressed, the codec headers would outweigh the savings
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+# media types compressed besides text/*, other files are sent as they are (with sendfile)
+COMPRESSIBLE_TYPES = (
+    'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
 
 
 # server-specific config
 SERVER_DEFAULT_EXIT = 200
+SERVER_BACKLOG = 1024
+# requests of a connection answered concurrently by the async server (protocol version 3)
+SERVER_PIPELINE_DEPTH = 64
+WORKER_THREADS = 32
+# workers that crash within WORKER_MIN_UPTIME seconds of starting are restarted after a delay
+# doubled on every crash (from WORKER_RESTART_DELAY), the server stops after WORKER_MAX_CRASHES
+WORKER_RESTART_DELAY = 1.0
+WORKER_MIN_UPTIME = 5.0
+WORKER_MAX_CRASHES = 5
+WORKER_REPORT_INTERVAL = 10.0
 SERVER_STATIC_DIR = os.path.abspath(f'{os.path.dirname(os.path.realpath(__file__))}/static')
+# cache of the static files (see networking.cache): contents of files up to CACHE_SMALL_FILE_SIZE
+# bytes (CACHE_MAX_BYTES in total, 0 disables it), memory maps of files up to
+# CACHE_MMAP_FILE_SIZE bytes (CACHE_MAX_MMAPS at a time, 0 disables them), and the metadata of
+# CACHE_MAX_ENTRIES file names, stat'ed again after CACHE_STAT_TTL seconds
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+CACHE_SMALL_FILE_SIZE = int(os.environ.get('CACHE_SMALL_FILE_SIZE', 256 * 1024))
+CACHE_MMAP_FILE_SIZE = int(os.environ.get('CACHE_MMAP_FILE_SIZE', 64 * 1024 * 1024))
+CACHE_MAX_MMAPS = int(os.environ.get('CACHE_MAX_MMAPS', 64))
+CACHE_MAX_ENTRIES = 4096
+CACHE_STAT_TTL = float(os.environ.get('CACHE_STAT_TTL', 1.0))
+# compressed contents of compressible files up to CACHE_COMPRESS_FILE_SIZE bytes, per codec,
+# CACHE_MAX_COMPRESSED_BYTES in total (0 disables them), larger files are compressed as a stream
+CACHE_MAX_COMPRESSED_BYTES = int(os.environ.get('CACHE_MAX_COMPRESSED_BYTES', 32 * 1024 * 1024))
+CACHE_COMPRESS_FILE_SIZE = int(os.environ.get('CACHE_COMPRESS_FILE_SIZE', 8 * 1024 * 1024))
 
 # client-specific config
 CLIENT_PROMPT_CHAR = '> '
+# requests sent without waiting for the responses to the previous ones (protocol version 3)
+CLIENT_PIPELINE_DEPTH = 1
+# codec offered to the server, 'none' to receive files uncompressed
+CLIENT_COMPRESSION = os.environ.get('CLIENT_COMPRESSION', 'zlib')
+# parallel downloads are split in ranges of DOWNLOAD_RANGE_SIZE bytes, the completed ranges
+# are saved next to the output file (<output>.ranges) to resume the download
+DOWNLOAD_RANGE_SIZE = 16 * 1024 * 1024
+DOWNLOAD_STATE_SUFFIX = '.ranges'
@@ -0,0 +1,172 @@
+import concurrent.futures
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from networking import config
+from networking.utils import Commands
+from networking.utils import receive_header
+from networking.utils import receive_message
+from networking.utils import receive_size
+from networking.utils import receive_to
+from networking.utils import send_message
+
+logger = logging.getLogger(__name__)
+
+
+def request_size(connection, filename, version=1):
+    """ Asks the server the size of a file, raises ValueError with the server error"""
+    send_message(f'{Commands.SIZE} {filename}', connection, version)
+    size = receive_size(connection, version)
+    response = receive_message(connection, size) if size else None
+    try:
+        return int(response)
+    except (TypeError, ValueError):
+        raise ValueError(response or 'No data sent by server...')
+
+
+def split(size, range_size=config.DOWNLOAD_RANGE_SIZE):
+    """ Splits size bytes in (offset, length) ranges of range_size bytes"""
+    return [(offset, min(range_size, size - offset)) for offset in range(0, size, range_size)]
+
+
+def preallocate(f, size):
+    """ Allocates the disk space of the output file, a sparse file if the platform
+    (or the file system) does not support posix_fallocate
+    """
+    f.truncate(size)
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError as e:
+            logger.debug(f'Could not preallocate the output file: {e}')
+
+
+class Ranges:
+    """ The completed ranges of a download, saved next to the output file
+    (<output>.ranges) after every range to resume the download
+    """
+
+    def __init__(self, output, size):
+        self.path = output + config.DOWNLOAD_STATE_SUFFIX
+        self.size = size
+        self.completed = set()
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ Loads the completed ranges of a previous download of a file of the same size,
+        returns if they were loaded
+        """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if state.get('size') != self.size:
+            return False
+        self.completed = {tuple(r) for r in state.get('completed', [])}
+        return True
+
+    def save(self):
+        """ Saves the completed ranges, replacing the previous state at once"""
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'size': self.size, 'completed': sorted(self.completed)}, f)
+        os.replace(tmp, self.path)
+
+    def complete(self, offset, length):
+        with self.lock:
+            self.completed.add((offset, length))
+            self.save()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def fetch_ranges(connect, filename, output, pending, ranges):
+    """ Downloads ranges from the pending queue on a new connection, until it is empty,
+    each range is written at its offset of the output file
+    """
+    # servers serving one client at a time never answer, give up instead of waiting,
+    # ranges are always sent uncompressed
+    connection, version, _ = connect(timeout=config.TRANSFER_TIMEOUT)
+    with connection, open(output, 'r+b') as f:
+        while True:
+            try:
+                offset, length = pending.get_nowait()
+            except queue.Empty:
+                return
+
+            logger.debug(f'Requesting {filename}, offset: {offset}, length: {length}')
+            send_message(f'{Commands.GET} {filename} {offset} {length}', connection, version)
+            frame, _, size = receive_header(connection, version)
+            if frame == config.FRAME_MESSAGE:
+                raise ValueError(receive_message(connection, size))
+            if size != length:
+                raise ConnectionError(
+                    f'expected {length} bytes at offset {offset}, server sent {size}')
+
+            f.seek(offset)
+            receive_to(connection, size, f, version=version)
+            # the range is only saved as completed once its data is written
+            f.flush()
+            ranges.complete(offset, length)
+
+
+def download(connect, filename, output, size, connections, range_size=config.DOWNLOAD_RANGE_SIZE):
+    """ Downloads a file of size bytes to output over parallel connections opened by connect,
+    every connection fetches ranges of range_size bytes until all of them are completed,
+    resumes a previous download of the same file
+    """
+    ranges = Ranges(output, size)
+    resume = os.path.isfile(output) and os.path.getsize(output) == size and ranges.load()
+    if not resume:
+        with open(output, 'wb') as f:
+            preallocate(f, size)
+        ranges.save()
+
+    pending = queue.Queue()
+    todo = [r for r in split(size, range_size) if r not in ranges.completed]
+    for r in todo:
+        pending.put(r)
+    logger.info(
+        f'Downloading {filename} ({size} bytes) to: {output},'
+        f' {len(todo)} ranges left, {connections} connections')
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(connections) as executor:
+        futures = [
+            executor.submit(fetch_ranges, connect, filename, output, pending, ranges)
+            for _ in range(min(connections, len(todo)))]
+    errors = [f.exception() for f in futures if f.exception()]
+    if errors:
+        raise errors[0]
+
+    ranges.remove()
+    elapsed = time.perf_counter() - start
+    received = sum(length for _, length in todo)
+    logger.info(
+        f'Saved {size} bytes to: {output}, received {received} bytes in {elapsed:.2f}s'
+        f' ({received / max(elapsed, 1e-9) / 2 ** 20:.1f} MiB/s)')
+
+
+def run(connect, filename, output, connections, connection=None, version=1):
+    """ Download a file over parallel connections, the size is requested on connection,
+    or on a new one
+    """
+    try:
+        if connection is None:
+            connection, version, _ = connect(timeout=config.TRANSFER_TIMEOUT)
+            with connection:
+                size = request_size(connection, filename, version)
+        else:
+            size = request_size(connection, filename, version)
+        download(connect, filename, output, size, connections)
+    except ValueError as e:
+        logger.error(e)
+    except OSError as e:
+        logger.error(f'Download interrupted: {e}, run it again to resume')
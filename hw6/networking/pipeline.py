@@ -0,0 +1,168 @@
+import logging
+import threading
+
+from networking import config
+from networking.compression import decompressor
+from networking.compression import inflate
+from networking.utils import decode_message
+from networking.utils import receive_contents
+from networking.utils import receive_header
+from networking.utils import receive_into
+from networking.utils import receive_message
+from networking.utils import receive_to
+from networking.utils import send_message
+
+logger = logging.getLogger(__name__)
+
+# request IDs are unsigned ints, they wrap around
+MAX_REQUEST_ID = 2 ** 32 - 1
+
+
+class Response:
+    """ The response to a pipelined request, received frame by frame:
+    messages are logged, files are saved to output or logged once all their data arrived,
+    compressed files are decompressed with codec as their data frames arrive
+    """
+
+    def __init__(self, data, output=None, codec=None):
+        self.data = data
+        self.output = output
+        self.codec = codec
+        self.decompressor = None
+        self.file = None
+        self.contents = None
+        self.size = 0
+        self.remaining = 0
+
+    def _write(self, part):
+        if self.file:
+            self.file.write(part)
+        else:
+            self.contents += part
+        self.remaining -= len(part)
+
+    def _finish(self):
+        if self.file:
+            self.file.close()
+            logger.info(f'Saved {self.size} bytes to: {self.output}')
+        else:
+            logger.info(decode_message(self.contents))
+        return True
+
+    def receive(self, connection, header, buffer=None):
+        """ Receives the frame of header, returns if the response is complete,
+        messages are received into buffer (see receive_message)
+        """
+        if header.frame == config.FRAME_MESSAGE:
+            logger.info(receive_message(connection, header.size, buffer=buffer))
+            return True
+
+        if header.frame in (config.FRAME_FILE, config.FRAME_COMPRESSED):
+            self.size = self.remaining = header.size
+            if self.output:
+                self.file = open(self.output, 'wb')
+            else:
+                self.contents = bytearray()
+            if header.frame == config.FRAME_COMPRESSED:
+                # the compressed data frames end with an empty one
+                self.decompressor = decompressor(self.codec)
+                return False
+            return self._finish() if not self.remaining else False
+
+        if header.frame == config.FRAME_DATA and self.decompressor:
+            return self._inflate(connection, header)
+        if header.frame != config.FRAME_DATA or header.size > self.remaining:
+            raise ConnectionError(f'unexpected frame {header} for request: {self.data}')
+        if self.file:
+            receive_to(connection, header.size, self.file)
+        else:
+            self.contents += receive_contents(connection, header.size)
+        self.remaining -= header.size
+        return self._finish() if not self.remaining else False
+
+    def _inflate(self, connection, header):
+        """ Receives and decompresses a compressed data frame, returns if the file is complete"""
+        if not header.size:
+            if self.remaining or not self.decompressor.eof:
+                raise ConnectionError(f'compressed file ended with {self.remaining} bytes left')
+            return self._finish()
+
+        data = bytearray(header.size)
+        receive_into(connection, memoryview(data))
+        try:
+            for part in inflate(self.decompressor, data, self.remaining):
+                self._write(part)
+        except ValueError:
+            raise ConnectionError(f'compressed file larger than {self.size} bytes')
+        return False
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class Pipeline:
+    """ Sends requests without waiting for the responses to the previous ones, up to depth
+    requests in flight, a thread receives the responses (in any order, protocol version 3)
+    and hands every frame to the Response of its request ID
+    """
+
+    def __init__(self, connection, version, depth, codec=None):
+        self.connection = connection
+        self.version = version
+        self.depth = depth
+        self.codec = codec
+        self.pending = {}
+        self.next_id = 0
+        self.running = True
+        self.condition = threading.Condition()
+        self.receiver = threading.Thread(target=self.receive, name='receiver', daemon=True)
+        self.receiver.start()
+
+    def submit(self, data, output=None):
+        """ Sends a request once there are less than depth requests in flight"""
+        with self.condition:
+            while self.running and len(self.pending) >= self.depth:
+                self.condition.wait()
+            if not self.running:
+                raise ConnectionError('connection closed by the server')
+            self.next_id = self.next_id % MAX_REQUEST_ID + 1
+            request_id = self.next_id
+            self.pending[request_id] = Response(data, output, self.codec)
+
+        # sent without holding the condition, the receiver must keep reading meanwhile
+        logger.debug(f'Sending request {request_id}: {data}')
+        send_message(data, self.connection, self.version, request_id)
+
+    def wait(self):
+        """ Waits until every request in flight is answered (or the connection closed)"""
+        with self.condition:
+            while self.running and self.pending:
+                self.condition.wait()
+
+    def receive(self):
+        """ Receives the responses until the connection is closed"""
+        # the messages of the connection are received into one buffer
+        buffer = bytearray(config.MESSAGE_BUFFER_SIZE)
+        try:
+            while True:
+                header = receive_header(self.connection, self.version)
+                if header.frame is None:
+                    break
+
+                with self.condition:
+                    response = self.pending.get(header.request_id)
+                if response is None:
+                    raise ConnectionError(f'response to an unknown request: {header}')
+                if response.receive(self.connection, header, buffer):
+                    with self.condition:
+                        del self.pending[header.request_id]
+                        self.condition.notify_all()
+        except (OSError, ValueError) as e:
+            logger.error(f'There was a connection error: {e}')
+        finally:
+            with self.condition:
+                for response in self.pending.values():
+                    response.close()
+                self.running = False
+                self.condition.notify_all()
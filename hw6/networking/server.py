@@ -1,16 +1,22 @@
 import click
+import concurrent.futures
 import logging
 import os
 import socket
 
 from networking import config
+from networking.cache import FileCache
+from networking.compression import compressible
+from networking.compression import negotiate
 from networking.utils import Commands
+from networking.utils import FileResponse
+from networking.utils import Hello
+from networking.utils import configure_socket
 from networking.utils import extract_command
 from networking.utils import extract_parameters
-from networking.utils import send_message
-from networking.utils import send_file
+from networking.utils import send_response
 from networking.utils import receive_message
-from networking.utils import receive_size
+from networking.utils import receive_header
 from networking.utils import setup_logging
 from networking.utils import validate_ip
 
@@ -19,92 +25,245 @@ logger = logging.getLogger(__name__)
 # server configuration:
 SERVER_RUNNING = True
 
+# cache of the files served by GET, shared by the threads of the process
+FILE_CACHE = FileCache()
 
-def handle_invalid(command, connection):
+
+def handle_invalid(command):
     """ Handle schenarios when the command sent was invalit"""
     msg = f'Invalid Command: {command}'
     logger.debug(msg)
-    send_message(msg, connection)
+    return msg
 
 
-def handle_exit(data, address, connection):
-    """ Handle the EXIT command"""
+def handle_exit(data, address):
+    """ Handle the EXIT command, the connection is closed after the response"""
 
     # get parameters and decide what code to use
     params = extract_parameters(data)
     code = params[0] if params else config.SERVER_DEFAULT_EXIT
 
-    # log code, send goodbye message, and close connection
+    # log code and send goodbye message
     logger.info(f'Closing connection to client, address: {address}, exit code: {code}')
-    msg = f'Goodbye: {code}'
-    send_message(msg, connection)
-    connection.close()
-    pass
-
+    return f'Goodbye: {code}'
 
-def handle_get(data, connection):
-    """ Handle the GET command"""
-    # get parameters and decide what code to use
-    params = extract_parameters(data)
 
-    # handle when GET without file was sent
+def find_file(params):
+    """ Finds the file requested by the first parameter in the static directory
+    (through the file cache), returns a CachedFile, or None and an error message
+    """
+    # handle when no file was sent
     if not params:
-        msg = 'ERROR: no file provided'
-        logger.debug(msg)
-        send_message(msg, connection)
-        return
+        return None, 'ERROR: no file provided'
 
     # hanlde when the file provided does not exist or is not a file
-    filename = params[0]
-    filepath = os.path.abspath(f'{config.SERVER_STATIC_DIR}/{filename}')
-    logger.debug(f'Processed file name: {filename}')
-    logger.debug(f'Processed file path: {filepath}')
-    if not os.path.exists(filepath):
-        msg = 'ERROR: no such file'
+    return FILE_CACHE.find(params[0])
+
+
+def handle_missing(response):
+    """ Handle a file removed after it was found (its metadata is cached for CACHE_STAT_TTL),
+    it is stat'ed again on the next request
+    """
+    FILE_CACHE.forget(response.path)
+    msg = 'ERROR: no such file'
+    logger.debug(msg)
+    return msg
+
+
+def handle_get(data, codec=None):
+    """ Handle the GET command: GET <file> [<offset> [<length>]],
+    the length defaults to the rest of the file, compressible files requested without a range
+    are sent compressed with the codec of the connection
+    """
+    # get parameters and decide what code to use
+    params = extract_parameters(data)
+    cached, msg = find_file(params)
+    if not cached:
         logger.debug(msg)
-        send_message(msg, connection)
-        return
-    elif not os.path.isfile(filepath):
-        msg = 'ERROR: not a file'
+        return msg
+
+    # handle ranged requests
+    size = cached.size
+    try:
+        offset = int(params[1]) if len(params) > 1 else 0
+        length = int(params[2]) if len(params) > 2 else size - offset
+    except ValueError:
+        offset = length = -1
+    if offset < 0 or length < 0 or offset > size:
+        msg = 'ERROR: invalid range'
         logger.debug(msg)
-        send_message(msg, connection)
-        return
+        return msg
+
+    # ranged requests are sent uncompressed, even when they cover the whole file: their offsets
+    # and lengths are in the uncompressed file and the client reads them as file frames
+    if codec and len(params) == 1 and compressible(cached.path, size):
+        logger.debug(f'Sending file: {cached.path}, compressed with: {codec}')
+        response = FileResponse(cached.path, size, 0, None, codec)
+        try:
+            return response._replace(data=FILE_CACHE.find_compressed(cached, codec))
+        except OSError:
+            return handle_missing(response)
 
-    # send file using socket.sendfile
+    # the file is sent from the cache, or using socket.sendfile
     # reference: https://docs.python.org/3/library/socket.html#socket.socket.sendfile
-    logger.debug(f'Sending file: {filepath}')
-    send_file(filepath, connection)
+    logger.debug(f'Sending file: {cached.path}, offset: {offset}, length: {length}')
+    return FileResponse(cached.path, min(length, size - offset), offset, cached.data)
 
 
-def handle_bounce(data, connection):
-    """ Handle the BOUNCE command"""
+def handle_size(data):
+    """ Handle the SIZE command, the size of a file in bytes"""
+    cached, msg = find_file(extract_parameters(data))
+    if not cached:
+        logger.debug(msg)
+        return msg
+    return str(cached.size)
+
+
+def handle_stats():
+    """ Handle the STATS command, the hit/miss counters of the file cache"""
+    stats = FILE_CACHE.stats()
+    return ', '.join(f'{name}: {value}' for name, value in sorted(stats.items()))
+
+
+def handle_hello(data):
+    """ Handle the HELLO command: HELLO <version> [<codec>...], negotiates the protocol version,
+    the highest version supported by both sides, and the compression codec (version 3),
+    the first one offered that the server supports
+    """
     params = extract_parameters(data)
-    msg = ' '.join(params)
-    logger.debug(f'Sending data: {msg}')
-    send_message(msg, connection)
+    try:
+        version = min(int(params[0]), config.PROTOCOL_VERSION)
+    except (IndexError, ValueError):
+        version = 0
+    if version < 1:
+        msg = 'ERROR: invalid protocol version'
+        logger.debug(msg)
+        return msg
 
+    codec = negotiate(params[1:]) if version >= 3 else None
+    logger.debug(f'Protocol version: {version}, compression: {codec}')
+    return Hello(version, codec)
 
-@click.command()
-@click.option('--debug', is_flag=True, help="Show debug data")
-@click.option('--host', '-h', default='127.0.0.1', help='IP to bind.', type=str, show_default=True)
-@click.option('--port', '-p', default=3000, help='Port to bind.', type=int, show_default=True)
-def run(debug, host, port):
 
-    # validate IP address
-    if not validate_ip(host):
-        logger.error('Invalid IP address')
-        exit(1)
+def handle_bounce(data):
+    """ Handle the BOUNCE command"""
+    params = extract_parameters(data)
+    msg = ' '.join(params)
+    logger.debug(f'Sending data: {msg}')
+    return msg
+
+
+def handle_data(data, address, codec=None):
+    """ Handle the data sent by a client, files are compressed with codec,
+    returns the response and if the connection should be closed after it
+    """
+    logger.debug(f'Message received: {data}')
+
+    # get the command sent
+    command = extract_command(data)
+
+    # EXIT command
+    if command in (Commands.EXIT,):
+        logger.debug('EXIT command received.')
+        return handle_exit(data, address), True
+
+    # GET command
+    elif command in (Commands.GET,):
+        logger.debug('GET command received.')
+        return handle_get(data, codec), False
+
+    # SIZE command
+    elif command in (Commands.SIZE,):
+        logger.debug('SIZE command received.')
+        return handle_size(data), False
+
+    # BOUNCE command
+    elif command in (Commands.BOUNCE,):
+        logger.debug('BOUNCE command received.')
+        return handle_bounce(data), False
+
+    # STATS command
+    elif command in (Commands.STATS,):
+        logger.debug('STATS command received.')
+        return handle_stats(), False
+
+    # HELLO command
+    elif command in (Commands.HELLO,):
+        logger.debug('HELLO command received.')
+        return handle_hello(data), False
+
+    # All other commands are invalid
+    logger.debug('Unknown command received.')
+    return handle_invalid(command), False
+
+
+def serve_connection(connection, addr_str):
+    """ Serve a client connection until it sends 'EXIT' or closes it"""
+    # clients start with protocol version 1 without compression, until they negotiate with HELLO
+    version = 1
+    codec = None
+    # the messages of the connection are received into one buffer
+    buffer = bytearray(config.MESSAGE_BUFFER_SIZE)
+    while True:
+
+        # get the size of the next data interaction
+        header = receive_header(connection, version)
+        size = header.size
+        logger.debug(f'Next data size: {size}')
+
+        # client sent size 0 and ready to shutdown
+        if size == 0:
+            logger.info(f'Closing connection to client, address: {addr_str}')
+            break
+
+        # if there is data, decode it, remove any
+        # newline/carriage returns
+        data = receive_message(connection, size, buffer=buffer)
+        if not data:
+            logger.error('Client sent no data, closing connection.')
+            break
+
+        response, close = handle_data(data, addr_str, codec)
+        try:
+            send_response(response, connection, version, header.request_id)
+        except FileNotFoundError:
+            # files are opened before any of them is sent
+            send_response(handle_missing(response), connection, version, header.request_id)
+        if isinstance(response, Hello):
+            version, codec = response
+        if close:
+            break
+
+
+def create_listener(host, port, reuse_port=False, buffer_size=config.SOCKET_BUFFER_SIZE):
+    """ Create a socket listening at host:port,
+    with reuse_port several processes can listen at the same port (SO_REUSEPORT),
+    the accepted connections inherit its buffer_size (SO_RCVBUF/SO_SNDBUF)
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        # restart without waiting for the connections of the previous run (TIME_WAIT)
+        if os.name == 'posix':
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        configure_socket(s, buffer_size)
+        s.bind((host, port))
+        s.listen(config.SERVER_BACKLOG)
+    except OSError:
+        s.close()
+        raise
+    return s
+
+
+def run_sync(host, port, buffer_size=config.SOCKET_BUFFER_SIZE):
+    """ Serve one client at a time with blocking sockets"""
 
     # global server running
     global SERVER_RUNNING
 
-    # setup logging
-    setup_logging(debug)
-
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+    with create_listener(host, port, buffer_size=buffer_size) as s:
         try:
-            s.bind((host, port))
-            s.listen()
             logger.info(f'Server started, listening at: {host}:{port}')
 
             # infinite loop to wait for connections, until KeyboardInterrupt is received
@@ -118,51 +277,11 @@ def run(debug, host, port):
                         logger.info(f'Received connection from client, address: {addr_str}')
 
                         # wait for data until client sends 'EXIT'
-                        while True:
-
-                            # get the size of the next data interaction
-                            size = receive_size(connection)
-                            logger.debug(f'Next data size: {size}')
-
-                            # client sent size 0 and ready to shutdown
-                            if size == 0:
-                                logger.info(f'Closing connection to client, address: {addr_str}')
-                                break
-
-                            # if there is data, decode it, remove any
-                            # newline/carriage returns
-                            data = receive_message(connection, size)
-                            if not data:
-                                logger.error('Client sent no data, closing connection.')
-                                break
-
-                            logger.debug(f'Message received: {data}')
-
-                            # get the command sent
-                            command = extract_command(data)
-
-                            # EXIT command
-                            if command in (Commands.EXIT,):
-                                logger.debug('EXIT command received.')
-                                handle_exit(data, addr_str, connection)
-                                break
-
-                            # GET command
-                            elif command in (Commands.GET,):
-                                logger.debug('GET command received.')
-                                handle_get(data, connection)
-
-                            # BOUNCE command
-                            elif command in (Commands.BOUNCE,):
-                                logger.debug('BOUNCE command received.')
-                                handle_bounce(data, connection)
-
-                            # All other commands are invalid
-                            else:
-                                logger.debug('Unknown command received.')
-                                handle_invalid(command, connection)
+                        serve_connection(connection, addr_str)
                 except ConnectionError as ce:
                     logger.error(f'There was a connection error: {ce}')
+                except OSError as e:
+                    logger.error(f'Could not serve client: {addr_str}: {e}')
         except (KeyboardInterrupt, SystemExit):
             logger.info('\nServer stopped by KeyboardInterrupt or SystemExit.')
             SERVER_RUNNING = False
@@ -172,3 +291,68 @@ def run(debug, host, port):
             SERVER_RUNNING = False
             logger.error(f'Something bad happened: {e}')
             raise
+
+
+def serve_client(connection, addr, counter=None):
+    """ Serve a client connection in a thread of serve_threaded"""
+    addr_str = f'{addr[0]}:{addr[1]}'
+    logger.info(f'Received connection from client, address: {addr_str}')
+    if counter:
+        counter.opened()
+    try:
+        with connection:
+            serve_connection(connection, addr_str)
+    except ConnectionError as ce:
+        logger.error(f'There was a connection error: {ce}')
+    except Exception:
+        logger.exception(f'Something bad happened serving: {addr_str}')
+    finally:
+        if counter:
+            counter.closed()
+
+
+def serve_threaded(listener, threads, counter=None):
+    """ Serve the clients of a listening socket with a pool of threads,
+    one connection per thread at a time
+    """
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        while SERVER_RUNNING:
+            connection, addr = listener.accept()
+            executor.submit(serve_client, connection, addr, counter)
+
+
+@click.command()
+@click.option('--debug', is_flag=True, help="Show debug data")
+@click.option('--host', '-h', default='127.0.0.1', help='IP to bind.', type=str, show_default=True)
+@click.option('--port', '-p', default=3000, help='Port to bind.', type=int, show_default=True)
+@click.option(
+    '--mode', '-m', default='sync', type=click.Choice(['sync', 'async']), show_default=True,
+    help='Serve one client at a time (sync) or many concurrently on an asyncio event loop.')
+@click.option(
+    '--workers', '-w', default=1, type=click.IntRange(min=1), show_default=True,
+    help='Worker processes listening at the same port, restarted if they crash.')
+@click.option(
+    '--threads', default=config.WORKER_THREADS, type=click.IntRange(min=1), show_default=True,
+    help='Clients served at a time by every sync worker.')
+@click.option(
+    '--buffer-size', '-b', default=config.SOCKET_BUFFER_SIZE, type=click.IntRange(min=0),
+    show_default=True, help='Socket send/receive buffer size in bytes, 0 for the OS default.')
+def run(debug, host, port, mode, workers, threads, buffer_size):
+
+    # validate IP address
+    if not validate_ip(host):
+        logger.error('Invalid IP address')
+        exit(1)
+
+    # setup logging
+    setup_logging(debug)
+
+    # imported here, they import this module for the command handlers
+    if workers > 1:
+        from networking import workers as supervisor
+        supervisor.run(host, port, workers, mode, threads, buffer_size)
+    elif mode == 'async':
+        from networking import async_server
+        async_server.run(host, port, buffer_size)
+    else:
+        run_sync(host, port, buffer_size)
@@ -1,9 +1,13 @@
+import collections
 import logging
 import os
 import socket
 import struct
 
 from networking import config
+from networking.compression import compress_file
+from networking.compression import decompressor
+from networking.compression import inflate
 
 
 # commands names
@@ -11,6 +15,23 @@ class Commands:
     EXIT = 'EXIT'
     BOUNCE = 'BOUNCE'
     GET = 'GET'
+    HELLO = 'HELLO'
+    SIZE = 'SIZE'
+    STATS = 'STATS'
+
+
+# a file (size bytes of it from offset) to send as the response of a command, from its
+# cached contents (bytes or mmap) when data is set, messages are sent as plain strings,
+# with a codec the file is sent compressed: data is its compressed contents, or None to
+# compress it as a stream
+FileResponse = collections.namedtuple(
+    'FileResponse', ['path', 'size', 'offset', 'data', 'codec'], defaults=[0, None, None])
+
+# the response to HELLO, the protocol version and compression codec used after it
+Hello = collections.namedtuple('Hello', ['version', 'codec'], defaults=[None])
+
+# a received frame header, frame is None with protocol version 1 and request_id is 0 before 3
+Header = collections.namedtuple('Header', ['frame', 'request_id', 'size'])
 
 
 def setup_logging(debug):
@@ -45,82 +66,329 @@ def extract_parameters(data):
     return params
 
 
-def send_message(msg, connection):
-    """ Encodes and sends message through the connection using our wire protocol
-        length is sent first packed as an unsigned int, little-indian
+def pack_header(size, version=1, frame=config.FRAME_MESSAGE, request_id=0):
+    """ Packs the header of a message or file using our wire protocol:
+        version 1: length packed as an unsigned int, little-indian
+        version 2: frame type as an unsigned char, then length as an unsigned long long
+        version 3: frame type, request ID as an unsigned int, then length
+    """
+    if version == 1:
+        return struct.pack(config.HEADER_PACKING[version], size)
+    elif version == 2:
+        return struct.pack(config.HEADER_PACKING[version], frame, size)
+    return struct.pack(config.HEADER_PACKING[version], frame, request_id, size)
+
+
+def max_size(version):
+    """ Largest message or file that can be sent with the protocol version"""
+    return 256 ** struct.calcsize('<' + config.HEADER_PACKING[version][-1]) - 1
+
+
+def encode_message(msg, version=1, request_id=0):
+    """ Encodes a message using our wire protocol
+        header first (see pack_header)
         then the message
     """
     to_send = f'{msg}\r\n'.encode(config.DATA_ENCODING)
-    connection.sendall(struct.pack(config.PACKING, len(to_send)))
-    connection.sendall(to_send)
+    return pack_header(len(to_send), version, config.FRAME_MESSAGE, request_id) + to_send
 
 
-def send_file(filepath, connection):
-    """ Sends a file through the connection using our wire protocol
-        length is sent first packed as an unsigned int, little-indian
-        then the message
+def file_headers(size, version=1, request_id=0):
+    """ The headers sent before the contents of a file of size bytes sent at once,
+    since version 3 the file frame is followed by a single data frame
+    """
+    header = pack_header(size, version, config.FRAME_FILE, request_id)
+    if version >= 3 and size:
+        header += pack_header(size, version, config.FRAME_DATA, request_id)
+    return header
+
+
+def compressed_frames(response, version=3, request_id=0):
+    """ Yields the frames of a compressed file response: the compressed file frame with the
+    uncompressed size, data frames of compressed contents (chunks of FRAME_CHUNK_SIZE bytes of
+    cached ones, or the blocks of a compressed stream) and an empty data frame
+    """
+    if response.data is not None:
+        view = memoryview(response.data)
+        parts = (view[i:i + config.FRAME_CHUNK_SIZE]
+                 for i in range(0, len(view), config.FRAME_CHUNK_SIZE))
+    else:
+        parts = compress_file(response.path, response.offset, response.size, response.codec)
+
+    # a frame is only yielded once the next one is known, small files are sent at once
+    header = pack_header(response.size, version, config.FRAME_COMPRESSED, request_id)
+    frame = None
+    for part in parts:
+        if not part:
+            continue
+        if frame is not None:
+            yield frame
+        frame = header + pack_header(len(part), version, config.FRAME_DATA, request_id) + part
+        header = b''
+    yield (frame or header) + pack_header(0, version, config.FRAME_DATA, request_id)
+
+
+def decode_message(data):
+    """ Decodes a received message, removing any newline/carriage returns,
+    if there are any decoding errors, ignore the data...
     """
+    try:
+        msg = str(data, config.DATA_ENCODING)
+        return msg.strip().rstrip('\r\n')
+    except UnicodeDecodeError as e:
+        print(e)
+        return None
+
+
+def send_message(msg, connection, version=1, request_id=0):
+    """ Encodes and sends message through the connection using our wire protocol"""
+    connection.sendall(encode_message(msg, version, request_id))
 
-    # first send file size
-    size = os.path.getsize(filepath)
-    connection.sendall(struct.pack(config.PACKING, size))
+
+def send_file(filepath, connection, version=1, offset=0, size=None, request_id=0):
+    """ Sends a file, or size bytes of it from offset, through the connection
+    using our wire protocol
+        header is sent first (see pack_header)
+        then the file, with socket.sendfile
+    the file is opened before the header is sent, nothing is sent if it can not be opened
+    """
     with open(filepath, 'rb') as f:
-        connection.sendfile(f, 0)
+        # first send file size
+        if size is None:
+            size = os.fstat(f.fileno()).st_size - offset
+        connection.sendall(file_headers(size, version, request_id))
+        if size:
+            # a count of 0 would send the whole file
+            connection.sendfile(f, offset, size)
 
 
-def receive_size(connection):
-    """ Receives the size of the message"""
+def send_data(data, connection, version=1, offset=0, size=None, request_id=0):
+    """ Sends cached file contents (bytes or mmap), or size bytes of them from offset,
+    through the connection using our wire protocol
+    """
+    if size is None:
+        size = len(data) - offset
+    header = file_headers(size, version, request_id)
+    view = memoryview(data)[offset:offset + size]
+    if size <= config.CACHE_SMALL_FILE_SIZE:
+        # one send for small files, the header alone would wait for the delayed ACK (Nagle)
+        connection.sendall(header + view)
+    else:
+        connection.sendall(header)
+        connection.sendall(view)
+
+
+def send_compressed(response, connection, version=3, request_id=0):
+    """ Sends a compressed file response (see compressed_frames)"""
+    for frame in compressed_frames(response, version, request_id):
+        connection.sendall(frame)
+
+
+def prepare_response(response, version):
+    """ Replaces responses that cannot be sent with the protocol version by an error,
+    returns the response to send
+    """
+    if isinstance(response, FileResponse) and response.size > max_size(version):
+        return f'ERROR: file too large for protocol version {version}'
+    if isinstance(response, Hello) and response.codec:
+        return f'{Commands.HELLO} {response.version} {response.codec}'
+    if isinstance(response, Hello):
+        return f'{Commands.HELLO} {response.version}'
+    return response
+
+
+def send_response(response, connection, version=1, request_id=0):
+    """ Sends the response of a command, a message or a file"""
+    response = prepare_response(response, version)
+    if isinstance(response, FileResponse) and response.codec:
+        send_compressed(response, connection, version, request_id)
+    elif isinstance(response, FileResponse) and response.data is not None:
+        send_data(
+            response.data, connection, version, response.offset, response.size, request_id)
+    elif isinstance(response, FileResponse):
+        send_file(
+            response.path, connection, version, response.offset, response.size, request_id)
+    else:
+        send_message(response, connection, version, request_id)
+
+
+def configure_socket(connection, buffer_size=None):
+    """ Sets the kernel send and receive buffer sizes (SO_SNDBUF/SO_RCVBUF) of a socket,
+    0 keeps the OS defaults (and their auto-tuning). Accepted sockets inherit the sizes
+    of the listening socket.
+    """
+    if buffer_size is None:
+        buffer_size = config.SOCKET_BUFFER_SIZE
+    if buffer_size:
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+
+
+def receive_into(connection, view):
+    """ Fills a memoryview with data from the connection using recv_into,
+    raises ConnectionError if the connection is closed before
+    """
+    received = 0
+    size = len(view)
+    while received < size:
+        count = connection.recv_into(view[received:], size - received)
+        if count == 0:
+            raise ConnectionError(f'connection closed after {received} of {size} bytes')
+        received += count
+
+
+def unpack_header(data, version=1):
+    """ Unpacks a header packed with pack_header, returns a Header,
+    the frame type is None with version 1 (files and messages are not told apart)
+    """
+    if version == 1:
+        return Header(None, 0, struct.unpack(config.HEADER_PACKING[version], data)[0])
+    elif version == 2:
+        frame, size = struct.unpack(config.HEADER_PACKING[version], data)
+        return Header(frame, 0, size)
+    return Header(*struct.unpack(config.HEADER_PACKING[version], data))
+
+
+def receive_header(connection, version=1):
+    """ Receives the header of the message, returns a Header (of size 0 if the connection
+    was closed)
+    """
     try:
-        received = 0
-        chunks = []
+        data = bytearray(struct.calcsize(config.HEADER_PACKING[version]))
+        view = memoryview(data)
 
         # receive the first chunk and check if it is empty, if so, return size to 0
-        chunk = connection.recv(config.LENGTH_BYTES)
-        if chunk == b'':
+        count = connection.recv_into(view)
+        if count == 0:
             # received empty chunk return size = 0
-            return 0
-
-        received += len(chunk)
-        chunks.append(chunk)
+            return Header(None, 0, 0)
 
-        while received < config.LENGTH_BYTES:
-            chunk = connection.recv(config.LENGTH_BYTES - received)
-            received += len(chunk)
-            chunks.append(chunk)
-
-        return struct.unpack(config.PACKING, b''.join(chunks))[0]
+        receive_into(connection, view[count:])
+        return unpack_header(data, version)
     except Exception as e:
         print(f'Could not receive size: {e}')
-        return 0
+        return Header(None, 0, 0)
 
 
-def receive_message(connection, size):
-    """ Receives and decodes data from server,
-    if there are any decoding errors, ignore the data...
+def receive_size(connection, version=1):
+    """ Receives the size of the message"""
+    return receive_header(connection, version).size
+
+
+def receive_message(connection, size, decode=True, buffer=None):
+    """ Receives a message of size bytes with recv_into, returns it decoded,
+    or as raw bytes when decode is False: the bytearray it was received into,
+    or a memoryview of buffer (valid until the next message received into it).
+    buffer is the bytearray of a connection, reused between its messages and grown in place
+    to the largest one, without it every message is received into a new bytearray.
+    If there are any errors, ignore the data...
     """
     try:
-        received = 0
-        chunks = []
-        chunk = connection.recv(min(size, config.MAX_BUFFER_SIZE))
-        received += len(chunk)
-        chunks.append(chunk)
-        while received < size:
-            chunk = connection.recv(min((size - config.MAX_BUFFER_SIZE), config.MAX_BUFFER_SIZE))
-            received += len(chunk)
-            chunks.append(chunk)
-
-        try:
-            msg = b''.join(chunks)
-            msg = msg.decode(config.DATA_ENCODING)
-            msg = msg.strip().rstrip('\r\n')
-        except UnicodeDecodeError as e:
-            print(e)
-            msg = None
+        if buffer is None:
+            buffer = bytearray(size)
+        elif len(buffer) < size:
+            buffer.extend(bytes(size - len(buffer)))
+        view = memoryview(buffer)[:size]
+        receive_into(connection, view)
     except Exception as e:
         print(f'Could not receive message: {e}')
-        msg = None
+        return None
+
+    if decode:
+        return decode_message(view)
+    return buffer if len(buffer) == size else view
+
+
+def data_frames(connection, size, version=1):
+    """ Yields the lengths of the parts of a file of size bytes, as they are received:
+    the whole file before version 3, then the length of every data frame
+    (the connection must not have other requests in flight)
+    """
+    if version < 3:
+        if size:
+            yield size
+        return
+
+    remaining = size
+    while remaining:
+        header = receive_header(connection, version)
+        if header.frame != config.FRAME_DATA or not 0 < header.size <= remaining:
+            raise ConnectionError(f'unexpected frame {header} with {remaining} bytes left')
+        yield header.size
+        remaining -= header.size
+
+
+def inflate_frames(connection, size, codec, version=3):
+    """ Yields the decompressed parts of a compressed file of size bytes, decompressing its
+    data frames as they are received, until the empty data frame that ends them
+    """
+    d = decompressor(codec)
+    buffer = bytearray(config.FRAME_CHUNK_SIZE)
+    remaining = size
+    while True:
+        header = receive_header(connection, version)
+        if header.frame != config.FRAME_DATA:
+            raise ConnectionError(f'unexpected frame {header} with {remaining} bytes left')
+        if not header.size:
+            break
+
+        if header.size > len(buffer):
+            buffer = bytearray(header.size)
+        view = memoryview(buffer)[:header.size]
+        receive_into(connection, view)
+        try:
+            for part in inflate(d, view, remaining):
+                remaining -= len(part)
+                yield part
+        except ValueError:
+            raise ConnectionError(f'compressed file larger than {size} bytes')
+
+    if remaining or not d.eof:
+        raise ConnectionError(f'compressed file ended with {remaining} bytes left')
+
+
+def receive_to(connection, size, f, block_size=config.FILE_BLOCK_SIZE, version=1, codec=None):
+    """ Receives a file of size bytes to the current position of the binary file f, in blocks
+    of block_size received with recv_into (constant memory, no decoding),
+    with a codec the file is decompressed as it is received
+    """
+    if codec:
+        for part in inflate_frames(connection, size, codec, version):
+            f.write(part)
+        return
+
+    block = memoryview(bytearray(min(block_size, size) or 1))
+    for part in data_frames(connection, size, version):
+        remaining = part
+        while remaining:
+            count = connection.recv_into(block, min(len(block), remaining))
+            if count == 0:
+                raise ConnectionError(f'connection closed with {remaining} bytes left')
+            f.write(block[:count])
+            remaining -= count
+
+
+def receive_file(
+        connection, size, path, block_size=config.FILE_BLOCK_SIZE, version=1, codec=None):
+    """ Receives a file of size bytes straight to the file at path (see receive_to)"""
+    with open(path, 'wb') as f:
+        receive_to(connection, size, f, block_size, version, codec)
+
+
+def receive_contents(connection, size, version=1, codec=None):
+    """ Receives a file of size bytes in memory, returns a bytearray,
+    with a codec the file is decompressed as it is received
+    """
+    if codec:
+        return bytearray().join(inflate_frames(connection, size, codec, version))
 
-    return msg
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    for part in data_frames(connection, size, version):
+        receive_into(connection, view[received:received + part])
+        received += part
+    return data
 
 
 def validate_ip(addr):
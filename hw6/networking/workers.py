@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+from networking import config
+from networking.server import create_listener
+from networking.server import serve_threaded
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionCounter:
+    """ Open and total connections of a worker, in memory shared with the supervisor"""
+
+    def __init__(self, counts, index):
+        self.counts = counts
+        self.index = index
+
+    def opened(self):
+        with self.counts.get_lock():
+            self.counts[2 * self.index] += 1
+            self.counts[2 * self.index + 1] += 1
+
+    def closed(self):
+        with self.counts.get_lock():
+            self.counts[2 * self.index] -= 1
+
+
+def reuse_port_supported():
+    """ Checks if several sockets can listen at the same port (SO_REUSEPORT)"""
+    return hasattr(socket, 'SO_REUSEPORT')
+
+
+def check_port(host, port):
+    """ Checks that the workers can listen at host:port with SO_REUSEPORT, raises OSError
+    when the port is taken by a socket without it (every worker would crash on start)
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        if os.name == 'posix':
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind((host, port))
+
+
+def worker(index, host, port, mode, threads, counts, listener=None, buffer_size=0):
+    """ Worker process: serves clients of its own listening socket (SO_REUSEPORT),
+    or of a listening socket shared by all the workers
+    """
+    # CTRL+C is handled by the supervisor, it stops the workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    counter = ConnectionCounter(counts, index)
+    if listener is None:
+        listener = create_listener(host, port, reuse_port=True, buffer_size=buffer_size)
+    logger.debug(f'Worker {index} started, pid: {os.getpid()}')
+
+    with listener:
+        if mode == 'async':
+            # imported here, it imports the server module for the command handlers
+            from networking import async_server
+            listener.setblocking(False)
+            asyncio.run(async_server.serve(host, port, listener, counter, (signal.SIGTERM,)))
+        else:
+            serve_threaded(listener, threads, counter)
+
+
+class Supervisor:
+    """ Starts the worker processes, restarts them when they crash
+    and reports their connection counts, workers that keep crashing right after they start
+    are restarted with an exponential backoff, the server stops after WORKER_MAX_CRASHES
+    """
+
+    def __init__(self, host, port, workers, mode, threads, buffer_size=config.SOCKET_BUFFER_SIZE):
+        self.host = host
+        self.port = port
+        self.buffer_size = buffer_size
+        self.mode = mode
+        self.threads = threads
+        self.processes = [None] * workers
+        self.restarts = [0] * workers
+        self.started = [0.0] * workers
+        # crashes in a row right after starting, and when the crashed workers are restarted
+        self.crashes = [0] * workers
+        self.restart_at = [None] * workers
+        self.failed = False
+        self.counts = multiprocessing.Array('q', 2 * workers)
+        self.running = True
+        self.listener = None
+        if not reuse_port_supported():
+            # the workers share one listening socket instead
+            self.listener = create_listener(host, port, buffer_size=buffer_size)
+        else:
+            check_port(host, port)
+
+    def start(self, index):
+        """ Starts (or restarts) the worker index"""
+        with self.counts.get_lock():
+            self.counts[2 * index] = 0
+        process = multiprocessing.Process(
+            target=worker, name=f'worker-{index}', daemon=True,
+            args=(index, self.host, self.port, self.mode, self.threads, self.counts,
+                  self.listener, self.buffer_size))
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+        self.restart_at[index] = None
+
+    def crashed(self, index):
+        """ Schedules the restart of the worker index after it exited, returns False
+        if it crashed WORKER_MAX_CRASHES times in a row right after starting
+        """
+        process = self.processes[index]
+        now = time.monotonic()
+        if now - self.started[index] < config.WORKER_MIN_UPTIME:
+            self.crashes[index] += 1
+        else:
+            self.crashes[index] = 0
+        if self.crashes[index] >= config.WORKER_MAX_CRASHES:
+            logger.error(
+                f'Worker {index} (pid {process.pid}) exited with code {process.exitcode},'
+                f' it crashed {self.crashes[index]} times in a row after starting, stopping')
+            return False
+
+        delay = config.WORKER_RESTART_DELAY * 2 ** max(self.crashes[index] - 1, 0)
+        logger.error(
+            f'Worker {index} (pid {process.pid}) exited with code {process.exitcode},'
+            f' restarting it in {delay:g}s')
+        self.restart_at[index] = now + delay
+        return True
+
+    def stop(self, *args):
+        self.running = False
+
+    def report(self):
+        """ Logs the connection counts of every worker"""
+        for index, process in enumerate(self.processes):
+            logger.info(
+                f'Worker {index} (pid {process.pid}): {self.counts[2 * index]} open,'
+                f' {self.counts[2 * index + 1]} total connections, {self.restarts[index]} restarts')
+
+    def run(self):
+        """ Supervise the workers until SIGINT or SIGTERM"""
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for index in range(len(self.processes)):
+            self.start(index)
+        logger.info(
+            f'Server started, listening at: {self.host}:{self.port}'
+            f' with {len(self.processes)} {self.mode} workers')
+
+        last_report = time.monotonic()
+        last_counts = None
+        try:
+            while self.running:
+                time.sleep(config.WORKER_RESTART_DELAY)
+                for index, process in enumerate(self.processes):
+                    if not self.running or process.is_alive():
+                        continue
+                    if self.restart_at[index] is None:
+                        if not self.crashed(index):
+                            self.failed = True
+                            self.running = False
+                    elif self.restart_at[index] <= time.monotonic():
+                        self.restarts[index] += 1
+                        self.start(index)
+
+                # report the connection counts when they change
+                if time.monotonic() - last_report >= config.WORKER_REPORT_INTERVAL:
+                    last_report = time.monotonic()
+                    counts = list(self.counts) + self.restarts
+                    if counts != last_counts:
+                        last_counts = counts
+                        self.report()
+        finally:
+            logger.info('\nServer stopped, stopping workers.')
+            for process in self.processes:
+                if process.is_alive():
+                    process.terminate()
+            for process in self.processes:
+                process.join()
+            self.report()
+            if self.listener:
+                self.listener.close()
+
+
+def run(host, port, workers, mode, threads=config.WORKER_THREADS,
+        buffer_size=config.SOCKET_BUFFER_SIZE):
+    """ Run the server in worker processes"""
+    try:
+        supervisor = Supervisor(host, port, workers, mode, threads, buffer_size)
+    except OSError as e:
+        logger.error(f'Could not listen at: {host}:{port}: {e}')
+        exit(1)
+    supervisor.run()
+    if supervisor.failed:
+        exit(1)
@@ -0,0 +1,41 @@
+import socket
+import unittest
+
+from networking import config
+from networking.compression import CODECS
+from networking.compression import compress
+from networking.compression import decompressor
+from networking.compression import inflate
+from networking.utils import inflate_frames
+from networking.utils import pack_header
+
+DATA = b'0123456789abcdef' * 1024
+
+
+class InflateTest(unittest.TestCase):
+    """ Decompression is capped at the expected size, whatever the compressed size"""
+
+    def test_exact_size(self):
+        for codec in CODECS:
+            parts = list(inflate(decompressor(codec), compress(DATA, codec), len(DATA), 1000))
+            self.assertEqual(b''.join(parts), DATA, codec)
+            self.assertLessEqual(max(map(len, parts)), 1000, codec)
+
+    def test_larger_than_limit(self):
+        for codec in CODECS:
+            with self.assertRaises(ValueError, msg=codec):
+                list(inflate(decompressor(codec), compress(DATA, codec), len(DATA) - 1))
+
+    def test_frame_larger_than_file(self):
+        """ a small frame that inflates to far more than the file is a protocol error"""
+        bomb = compress(bytes(64 * 1024 * 1024), 'zlib')
+        client, server = socket.socketpair()
+        with client, server:
+            server.sendall(pack_header(len(bomb), 3, config.FRAME_DATA) + bomb)
+            with self.assertRaises(ConnectionError):
+                for _ in inflate_frames(client, 10, 'zlib'):
+                    pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import functools
+import os
+import tempfile
+import threading
+import unittest
+
+from networking import config
+from networking import download
+from networking.client import connect
+from networking.server import create_listener
+from networking.server import serve_threaded
+from networking.utils import receive_header
+from networking.utils import receive_to
+from networking.utils import send_message
+
+FILENAME = 'moby-dick.txt'
+
+
+class DownloadTest(unittest.TestCase):
+    """ Parallel downloads of a compressible file, from connections that negotiated compression"""
+
+    @classmethod
+    def setUpClass(cls):
+        # a threaded server on a free port, it serves several connections at a time
+        cls.listener = create_listener('127.0.0.1', 0)
+        cls.port = cls.listener.getsockname()[1]
+        threading.Thread(target=serve_threaded, args=(cls.listener, 4), daemon=True).start()
+        with open(os.path.join(config.SERVER_STATIC_DIR, FILENAME), 'rb') as f:
+            cls.expected = f.read()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.listener.close()
+
+    def connect(self, **kwargs):
+        return functools.partial(
+            connect, '127.0.0.1', self.port, protocol=config.PROTOCOL_VERSION,
+            compression='zlib', **kwargs)
+
+    def test_parallel_download(self):
+        """ GET <file> -o <output> -n 2 saves the whole file and removes the ranges state,
+        files up to DOWNLOAD_RANGE_SIZE bytes are requested as a single range
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, FILENAME)
+            download.download(self.connect(), FILENAME, output, len(self.expected), 2)
+            with open(output, 'rb') as f:
+                self.assertEqual(f.read(), self.expected)
+            self.assertFalse(os.path.exists(output + config.DOWNLOAD_STATE_SUFFIX))
+
+    def test_full_range_not_compressed(self):
+        """ a range covering the whole file is sent as a file frame, not compressed"""
+        connection, version, codec = self.connect(timeout=config.TRANSFER_TIMEOUT)()
+        with connection, tempfile.TemporaryFile() as f:
+            self.assertEqual(codec, 'zlib')
+            send_message(f'GET {FILENAME} 0 {len(self.expected)}', connection, version)
+            frame, _, size = receive_header(connection, version)
+            self.assertEqual(frame, config.FRAME_FILE)
+            receive_to(connection, size, f, version=version)
+            f.seek(0)
+            self.assertEqual(f.read(), self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from networking import server
+from networking.cache import FileCache
+from networking.utils import receive_contents
+from networking.utils import receive_header
+from networking.utils import receive_message
+from networking.utils import send_message
+
+FILENAME = 'removed.txt'
+
+
+class RemovedFileTest(unittest.TestCase):
+    """ Files removed while their metadata is cached (for CACHE_STAT_TTL) are answered with
+    an error, the connection and the server keep working
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, FILENAME)
+        self.directory = directory.name
+
+    def serve(self, cache):
+        """ Serves one connection of a socketpair with cache, returns the client socket"""
+        patcher = mock.patch.object(server, 'FILE_CACHE', cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        client, connection = socket.socketpair()
+        self.addCleanup(client.close)
+        thread = threading.Thread(target=server.serve_connection, args=(connection, 'socketpair'))
+        thread.start()
+
+        def stop():
+            send_message('EXIT', client)
+            thread.join()
+            connection.close()
+
+        self.addCleanup(stop)
+        return client
+
+    def get(self, client):
+        send_message(f'GET {FILENAME}', client)
+        size = receive_header(client).size
+        return bytes(receive_contents(client, size))
+
+    def check_removed(self, cache):
+        with open(self.path, 'wb') as f:
+            f.write(b'contents\n')
+        client = self.serve(cache)
+        self.assertEqual(self.get(client), b'contents\n')
+        os.remove(self.path)
+        self.assertEqual(self.get(client), b'ERROR: no such file\r\n')
+        send_message('BOUNCE still here', client)
+        self.assertEqual(receive_message(client, receive_header(client).size), 'still here')
+
+    def test_removed_sendfile(self):
+        self.check_removed(FileCache(self.directory, small_size=0, max_maps=0))
+
+    def test_removed_small_file(self):
+        # the contents are larger than max_bytes, they are read again on every request
+        self.check_removed(FileCache(self.directory, max_bytes=1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+import socket
+import unittest
+
+from networking.utils import encode_message
+from networking.utils import receive_header
+from networking.utils import receive_message
+
+
+class ReceiveMessageTest(unittest.TestCase):
+    """ The messages of a connection are received into one buffer, grown in place"""
+
+    def test_reused_buffer(self):
+        buffer = bytearray(8)
+        messages = ['short', 'a message longer than the buffer', 'again']
+        client, server = socket.socketpair()
+        with client, server:
+            server.sendall(b''.join(encode_message(msg) for msg in messages))
+            for msg in messages:
+                size = receive_header(client).size
+                self.assertEqual(receive_message(client, size, buffer=buffer), msg)
+        self.assertEqual(len(buffer), len(encode_message(messages[1])) - 4)
+
+
+if __name__ == '__main__':
+    unittest.main()